@@ -1,14 +1,18 @@
+import time
 import logging
+from typing import Optional
 from datetime import datetime
 
-from sqlalchemy.orm import Session
 from fastapi import HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from cryptography.fernet import Fernet, InvalidToken
 from twilio.request_validator import RequestValidator
 
 from core import settings
-from common.sql_utils import get_db_conn
+from core.settings import SessionLocal
 from common.redis_utils import get_redis_conn
+from common.phase_timer import timed_phase
+from access_management.token_cache import TOKEN_CACHE
 from schemas.auth import TokenData
 from schemas.sql_db import DjangoSession, AuthUser
 from schemas.redis_db import (
@@ -20,84 +24,138 @@ logger = logging.getLogger("APP_API_"+__name__)
 fernet_cipher = Fernet(settings.CRYPT_SECRET_KEY_WEB)
 
 
-async def verify_token(
-    req: Request,
-    redis_conn=Depends(get_redis_conn),
-    db: Session = Depends(get_db_conn)
-) -> TokenData:
+def get_session_expire_date(
+    session_key: str, username: str
+) -> Optional[datetime]:
+    """
+    Blocking, run it in the thread pool. Returns None if the session or the
+    user does not exist.
+    """
+    db = SessionLocal()
     try:
-        if not req.headers.get("Authorization"):
-            raise HTTPException(
-                status_code=401, detail="Missing Authorization header"
-            )
-        elif req.headers["Authorization"].count(" ") != 1:
-            raise HTTPException(
-                status_code=401, detail="Invalid Authorization header format"
-            )
-
-        token_type, token = req.headers["Authorization"].split(" ")
-
-        if token_type.lower() != "bearer":
-            logger.error(f"Invalid token type, not bearer: {token_type}")
-            raise HTTPException(status_code=401, detail="Invalid token type")
-
-        username = await redis_conn.get(
-            REDIS_KEY_USER_GENERATED_TOKEN.format(token=token)
-        )
-        if username:
-            return TokenData(
-                access_token=token,
-                username=username.decode(),
-                generated_by="user",
-                ttl=await redis_conn.ttl(token),
-            )
-
-        # openai oauth token
-        username = await redis_conn.get(
-            REDIS_OPENAI_OAUTH_USER_GENERATED_TOKEN.format(token=token)
+        row = (
+            db.query(DjangoSession.expire_date)
+            .join(AuthUser, AuthUser.username == username)
+            .filter(DjangoSession.session_key == session_key)
+            .first()
         )
+    finally:
+        db.close()
+
+    return row.expire_date if row else None
+
+
+async def resolve_token(
+    redis_conn, token: str
+) -> tuple[TokenData, Optional[float]]:
+    """
+    Returns the token data and for how many more seconds the token is valid,
+    None if it does not expire.
+    """
+    user_token_key = REDIS_KEY_USER_GENERATED_TOKEN.format(token=token)
+    openai_token_key = REDIS_OPENAI_OAUTH_USER_GENERATED_TOKEN.format(
+        token=token
+    )
+
+    TOKEN_CACHE.redis_lookups += 1
+    pipeline = redis_conn.pipeline(transaction=False)
+    pipeline.get(user_token_key)
+    pipeline.ttl(user_token_key)
+    pipeline.get(openai_token_key)
+    pipeline.ttl(openai_token_key)
+    username, ttl, openai_username, openai_ttl = await pipeline.execute()
+
+    if username:
+        return TokenData(
+            access_token=token,
+            username=username.decode(),
+            generated_by="user",
+            ttl=ttl,
+        ), ttl if ttl >= 0 else None
 
-        if username:
-            return TokenData(
-                access_token=token,
-                username=username.decode(),
-                generated_by="openai_oauth",
-                ttl=await redis_conn.ttl(token),
-            )
+    # openai oauth token
+    if openai_username:
+        return TokenData(
+            access_token=token,
+            username=openai_username.decode(),
+            generated_by="openai_oauth",
+            ttl=openai_ttl,
+        ), openai_ttl if openai_ttl >= 0 else None
 
+    try:
         # session_key:username
         session_key, username = (
             fernet_cipher.decrypt(token.encode()).decode().split(":")
         )
-
-        db_session = (
-            db.query(DjangoSession)
-            .filter(DjangoSession.session_key == session_key)
-            .first()
+    except ValueError:
+        raise HTTPException(
+            status_code=401, detail="Invalid Authorization header format"
         )
-        if db_session.expire_date < datetime.utcnow():
-            raise HTTPException(status_code=403, detail="Session has expired")
+    except InvalidToken:
+        raise HTTPException(status_code=401, detail="Invalid token")
 
-        db_user = db.query(AuthUser).filter(AuthUser.username == username).first()
+    TOKEN_CACHE.db_lookups += 1
+    expire_date = await run_in_threadpool(
+        get_session_expire_date, session_key, username
+    )
+    if expire_date is None:
+        raise HTTPException(status_code=404, detail="User not found")
 
-        if not all([db_session, db_user]):
-            raise HTTPException(status_code=404, detail="User not found")
+    expires_in = (expire_date - datetime.utcnow()).total_seconds()
+    if expires_in < 0:
+        raise HTTPException(status_code=403, detail="Session has expired")
 
-    except ValueError:
+    return TokenData(
+        access_token=token,
+        username=username,
+        generated_by="system",
+        ttl=None,
+    ), expires_in
+
+
+@timed_phase("auth")
+async def verify_token(
+    req: Request,
+    redis_conn=Depends(get_redis_conn),
+) -> TokenData:
+    """
+    Tokens are resolved through the worker's TOKEN_CACHE, only a miss goes to
+    Redis (one pipelined round trip) and, for session tokens, to the DB.
+    """
+    if not req.headers.get("Authorization"):
+        raise HTTPException(
+            status_code=401, detail="Missing Authorization header"
+        )
+    elif req.headers["Authorization"].count(" ") != 1:
         raise HTTPException(
             status_code=401, detail="Invalid Authorization header format"
         )
 
-    except InvalidToken:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    token_type, token = req.headers["Authorization"].split(" ")
 
-    else:
-        return TokenData(
-            access_token=token,
-            username=username,
-            generated_by="system",
-            ttl=None,
+    if token_type.lower() != "bearer":
+        logger.error(f"Invalid token type, not bearer: {token_type}")
+        raise HTTPException(status_code=401, detail="Invalid token type")
+
+    cached = TOKEN_CACHE.get(token)
+    if isinstance(cached, HTTPException):
+        raise cached
+    elif cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    try:
+        token_data, expires_in = await resolve_token(
+            redis_conn=redis_conn, token=token
         )
+    except HTTPException as e:
+        TOKEN_CACHE.set_invalid(token=token, error=e)
+        raise e
+    finally:
+        TOKEN_CACHE.resolve_seconds += time.perf_counter() - start
+
+    TOKEN_CACHE.set(token_data=token_data, ttl=expires_in)
+    return token_data
 
 validator = RequestValidator(settings.TWILIO_AUTH_TOKEN)
 
@@ -0,0 +1,134 @@
+"""
+Per user, per API rate limit for the paid endpoints, added as a dependency to
+the routers. The limits by plan come from RATE_LIMIT_DEFAULT and can be
+changed per endpoint in `CloudRunAPIEndpoint.other`, ex:
+    other={"rate_limit": {"period": 60, "free": 5, "subscription": 10}}
+    other={"rate_limit": False}  # no limit, ex: webhooks
+"""
+import math
+import logging
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Request, status
+
+from core import settings
+from common.redis_utils import get_redis_conn, get_redis_script
+from common.redis_scripts import RATE_LIMIT_GCRA_LUA
+from common.batch import BATCH_URL_PREFIX
+from access_management.api_auth import verify_token
+from schemas.redis_db import (
+    REDIS_KEY_USER_API_RATE_LIMIT,
+    REDIS_KEY_METERED_SUBSCRIPTION_USERS,
+    REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
+)
+
+logger = logging.getLogger("APP_API_" + __name__)
+
+# {(method, api_url): (api_name, limits)}, built on first use from `core.urls`
+_RATE_LIMITED_ENDPOINTS: Optional[dict[tuple[str, str], tuple[str, dict]]] = None
+
+
+def get_rate_limited_endpoint(
+        method: str, path: str
+) -> Optional[tuple[str, dict]]:
+    global _RATE_LIMITED_ENDPOINTS
+    if _RATE_LIMITED_ENDPOINTS is None:
+        from core.urls import urls
+
+        _RATE_LIMITED_ENDPOINTS = {
+            (data.method, data.api_url): (
+                "/".join([app_name, app_version, app_endpoint]),
+                {
+                    **settings.RATE_LIMIT_DEFAULT,
+                    **((data.other or {}).get("rate_limit") or {}),
+                },
+            )
+            for app_name, app_versions in urls.items()
+            for app_version, app_endpoints in app_versions.items()
+            for app_endpoint, data in app_endpoints.items()
+            if (data.other or {}).get("rate_limit") is not False
+        }
+
+    # the OpenAI GPT views share the limit of the API they wrap, a batch
+    # counts as one request
+    if path.endswith(settings.ENDS_WITH_OPENAI):
+        path = path[:-len(settings.ENDS_WITH_OPENAI)]
+    elif path.startswith(BATCH_URL_PREFIX):
+        path = path[len(BATCH_URL_PREFIX):]
+
+    return _RATE_LIMITED_ENDPOINTS.get((method, path))
+
+
+def get_rate_limit_headers(
+        limit: int, period: int, remaining: int, reset_ms: int
+) -> dict:
+    return {
+        "RateLimit-Limit": str(limit),
+        "RateLimit-Remaining": str(remaining),
+        "RateLimit-Reset": str(math.ceil(reset_ms / 1000)),
+        "RateLimit-Policy": f"{limit};w={period}",
+    }
+
+
+async def rate_limit(request: Request, redis_conn=Depends(get_redis_conn)):
+    """
+    Raises a 429 with a Retry-After header when the user is over the limit,
+    otherwise the RateLimit-* headers are added to the response by the
+    `add_rate_limit_headers` middleware.
+    """
+    endpoint = get_rate_limited_endpoint(request.method, request.url.path)
+    if endpoint is None:
+        return
+
+    api_name, limits = endpoint
+    token_data = await verify_token(req=request, redis_conn=redis_conn)
+    check_rate_limit = get_redis_script(redis_conn, RATE_LIMIT_GCRA_LUA)
+
+    try:
+        allowed, limit, remaining, reset_ms, retry_after_ms = (
+            await check_rate_limit(
+                keys=[
+                    REDIS_KEY_USER_API_RATE_LIMIT.format(
+                        username=token_data.username, api_name=api_name
+                    ),
+                    REDIS_KEY_METERED_SUBSCRIPTION_USERS.format(
+                        username=token_data.username
+                    ),
+                    REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(
+                        username=token_data.username
+                    ),
+                ],
+                args=[
+                    limits["period"] * 1000,
+                    limits["free"],
+                    limits["subscription"],
+                    limits["metered"],
+                ],
+                client=redis_conn,
+            )
+        )
+    except Exception as e:
+        # the daily call limit and the call slots still apply
+        logger.error(f"Could not check the rate limit of {api_name}: {e}")
+        return
+
+    headers = get_rate_limit_headers(
+        limit=limit,
+        period=limits["period"],
+        remaining=remaining,
+        reset_ms=reset_ms,
+    )
+    if not allowed:
+        logger.warning(
+            f"User {token_data.username} is over the rate limit of {api_name}"
+        )
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests.",
+            headers={
+                **headers,
+                "Retry-After": str(max(math.ceil(retry_after_ms / 1000), 1)),
+            },
+        )
+
+    request.state.rate_limit_headers = headers
@@ -0,0 +1,54 @@
+"""
+Bearer tokens for the calls from App_API to the Cloud Run containers.
+
+The token is EXPECTED_TOKEN_CLOUD_RUN encrypted with CRYPT_SECRET_KEY_G_CLOUD_RUN,
+it is minted once and reused for SERVICE_TOKEN_REFRESH_INTERVAL seconds
+instead of on every request. The containers accept a token for
+SERVICE_TOKEN_MAX_AGE seconds, which must be larger than the refresh interval.
+
+CRYPT_SECRET_KEY_G_CLOUD_RUN can hold several comma separated keys, new tokens
+are encrypted with the first one, see "How to rotate the Cloud Run key" in
+the ReadMe.
+"""
+import time
+from typing import Optional
+
+from cryptography.fernet import Fernet, MultiFernet
+
+from core import settings
+
+
+def build_cipher(keys: str) -> MultiFernet:
+    return MultiFernet([Fernet(key.strip()) for key in keys.split(",")])
+
+
+class ServiceTokenMinter:
+    def __init__(self, keys: str, expected_token: str, refresh_interval: int):
+        self._keys = keys
+        self._expected_token = expected_token
+        self.refresh_interval = refresh_interval
+        self._cipher: Optional[MultiFernet] = None
+        self._token: Optional[str] = None
+        self._minted_at: float = 0
+
+    def get_token(self) -> str:
+        now = time.time()
+        if self._token is None or now - self._minted_at >= self.refresh_interval:
+            if self._cipher is None:
+                self._cipher = build_cipher(self._keys)
+            self._token = self._cipher.encrypt_at_time(
+                self._expected_token.encode(), int(now)
+            ).decode()
+            self._minted_at = now
+        return self._token
+
+
+SERVICE_TOKEN_MINTER = ServiceTokenMinter(
+    keys=settings.CRYPT_SECRET_KEY_G_CLOUD_RUN or "",
+    expected_token=settings.EXPECTED_TOKEN_CLOUD_RUN or "",
+    refresh_interval=settings.SERVICE_TOKEN_REFRESH_INTERVAL,
+)
+
+
+def get_service_auth_headers() -> dict:
+    return {"Authorization": f"Bearer {SERVICE_TOKEN_MINTER.get_token()}"}
@@ -0,0 +1,141 @@
+"""
+Per worker LRU of the tokens resolved by `verify_token`.
+
+Valid tokens are kept for TOKEN_CACHE_TTL seconds (never longer than the
+token itself lives), so a token revoked in the Web App can still be used for
+up to that long on a worker that has seen it. Invalid tokens are kept for
+TOKEN_CACHE_NEGATIVE_TTL seconds in a separate LRU, so that a client retrying
+a bad token does not hit Redis and the DB every time and can't evict the
+valid tokens.
+"""
+import time
+from typing import Optional, Union
+from collections import OrderedDict
+
+from fastapi import HTTPException
+
+from core import settings
+from schemas.auth import TokenData
+
+
+class _LRU:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value, ttl: float) -> None:
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class TokenCache:
+    def __init__(
+            self,
+            ttl: int = settings.TOKEN_CACHE_TTL,
+            negative_ttl: int = settings.TOKEN_CACHE_NEGATIVE_TTL,
+            max_size: int = settings.TOKEN_CACHE_MAX_SIZE,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._valid = _LRU(max_size=max_size)
+        self._invalid = _LRU(max_size=max_size)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.redis_lookups = 0
+        self.db_lookups = 0
+        self.resolve_seconds = 0.0
+
+    def get(self, token: str) -> Optional[Union[TokenData, HTTPException]]:
+        """Returns the cached TokenData, the cached error or None."""
+        cached = self._valid.get(token)
+        if cached is not None:
+            self.hits += 1
+            token_data, token_expires_at = cached
+            if token_expires_at is None:
+                return token_data
+            return token_data.copy(
+                update={"ttl": max(int(token_expires_at - time.monotonic()), 0)}
+            )
+
+        error = self._invalid.get(token)
+        if error is not None:
+            self.negative_hits += 1
+            return HTTPException(
+                status_code=error.status_code, detail=error.detail
+            )
+
+        self.misses += 1
+        return None
+
+    def set(self, token_data: TokenData, ttl: Optional[float] = None) -> None:
+        """
+        :param ttl: seconds the token itself is still valid, None if unknown
+        """
+        token_expires_at = None
+        cache_ttl = self.ttl
+        if token_data.ttl is not None and token_data.ttl > 0:
+            token_expires_at = time.monotonic() + token_data.ttl
+        if ttl is not None:
+            cache_ttl = min(cache_ttl, ttl)
+        if cache_ttl <= 0:
+            return
+
+        self._valid.set(
+            token_data.access_token, (token_data, token_expires_at), cache_ttl
+        )
+
+    def set_invalid(self, token: str, error: HTTPException) -> None:
+        self._invalid.set(token, error, self.negative_ttl)
+
+    def clear(self) -> None:
+        self._valid.clear()
+        self._invalid.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._valid),
+            "negative_size": len(self._invalid),
+            "hits_total": self.hits,
+            "negative_hits_total": self.negative_hits,
+            "misses_total": self.misses,
+            "hit_ratio": round(
+                (self.hits + self.negative_hits) / lookups, 4
+            ) if lookups else 0,
+            "evictions_total": self._valid.evictions + self._invalid.evictions,
+            "redis_lookups_total": self.redis_lookups,
+            "db_lookups_total": self.db_lookups,
+            # time spent resolving the tokens that were not cached
+            "resolve_seconds_total": round(self.resolve_seconds, 6),
+        }
+
+
+TOKEN_CACHE = TokenCache()
+
+
+def get_token_cache_stats() -> dict:
+    return TOKEN_CACHE.stats()
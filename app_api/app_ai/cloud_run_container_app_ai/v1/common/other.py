@@ -1,11 +1,22 @@
 import random
 import string
+import tempfile
+from typing import Optional
 from urllib.parse import urlparse, urljoin
 
 import requests
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 
-from core.settings import TEMP_API_FILES_BUCKET, BUKET_BASE_URL
+from core.settings import (
+	TEMP_API_FILES_BUCKET,
+	BUKET_BASE_URL,
+	TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD,
+	TEMP_API_FILES_UPLOAD_CHUNK_SIZE,
+	TEMP_API_FILES_UPLOAD_WORKERS,
+)
+
+_STORAGE_CLIENT: Optional[storage.Client] = None
 
 
 def is_valid_url(url: str) -> bool:
@@ -42,16 +53,39 @@ def download_image(url: str) -> tuple[bytes, str]:
 	return response.content, mime_type
 
 
+def get_temp_bucket() -> storage.Bucket:
+	"""The client (and its credentials) is created once per process."""
+	global _STORAGE_CLIENT
+	if _STORAGE_CLIENT is None:
+		_STORAGE_CLIENT = storage.Client()
+	return _STORAGE_CLIENT.bucket(TEMP_API_FILES_BUCKET)
+
+
 def upload_resp_file_content_to_bucket(
 		resp_file_content: bytes, filename: str, content_type: str,
 ) -> str:
+	"""
+	Big files (ex: videos) are uploaded in chunks sent at the same time, the
+	chunks are read from a temporary file by the upload threads.
+	"""
 	folder_name = random_name_generator(length=10)
 
 	blob_name = f"temp/{folder_name}/{filename}"
 
-	storage_client = storage.Client()
-	bucket = storage_client.bucket(TEMP_API_FILES_BUCKET)
-	blob = bucket.blob(blob_name)
-	blob.upload_from_string(resp_file_content, content_type=content_type)
+	blob = get_temp_bucket().blob(blob_name)
+	if len(resp_file_content) < TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD:
+		blob.upload_from_string(resp_file_content, content_type=content_type)
+	else:
+		with tempfile.NamedTemporaryFile() as f:
+			f.write(resp_file_content)
+			f.flush()
+			transfer_manager.upload_chunks_concurrently(
+				f.name,
+				blob,
+				content_type=content_type,
+				chunk_size=TEMP_API_FILES_UPLOAD_CHUNK_SIZE,
+				max_workers=TEMP_API_FILES_UPLOAD_WORKERS,
+				worker_type=transfer_manager.THREAD,
+			)
 
 	return urljoin(BUKET_BASE_URL, blob_name)
@@ -23,11 +23,35 @@ REDIS_KEY_UNKNOWN_USER_WHATSAPP_TIMESTAMP = (
 REDIS_KEY_USER_PHONE_NUMBER = "user_phone_number:{number}"
 
 # Common Keys with App_API
+# legacy, one key per API call, written while REDIS_USAGE_COUNTERS_MODE is
+# "legacy" or "dual"
 REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER = (
 	"credits_used_per_api_endpoint_by_user:{date}:{username}:{api_name}:"
 	"{timestamp}:{random_char}"
 )
+"""
+Usage counters, written while REDIS_USAGE_COUNTERS_MODE is "dual" or "counters"
+credits_used_per_day:{username}:{date} -> hash
+	{"{api_name}:credits": 12, "{api_name}:calls": 3}
+credits_used_per_day_users:{date} -> set of the usernames with a hash that day
+credits_used_timeline:{username}:{date} -> sorted set, score is the timestamp
+	{"{timestamp}:{api_name}:{credits}:{random_char}": timestamp}
+"""
+REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER = "credits_used_per_day:{username}:{date}"
+REDIS_KEY_CREDITS_USED_PER_DAY_USERS = "credits_used_per_day_users:{date}"
+REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER = (
+	"credits_used_timeline:{username}:{date}"
+)
+REDIS_CREDITS_USED_TIMELINE_MEMBER = (
+	"{timestamp}:{api_name}:{credits}:{random_char}"
+)
+# hash {"<CustomerCreditsBought id>": <credits remaining>}, see redis_scripts
+REDIS_KEY_USER_CREDIT_LEDGER = "user_credit_ledger:{username}"
+# legacy, one key per `CustomerCreditsBought` {id}, moved into the ledger by
+# the ledger scripts, the flag is set once the user's keys were moved
 REDIS_KEY_USER_CREDIT_BOUGHT = "user_credit_bought:{username}:{id}"
+REDIS_KEY_USER_CREDIT_LEDGER_FOLDED = "user_credit_ledger_folded:{username}"
+REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION = "user_has_active_subscription:{username}"
 REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING = (
 	"subscriptions_monthly_credit_remaining:{username}"
 )
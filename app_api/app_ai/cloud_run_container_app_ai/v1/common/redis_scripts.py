@@ -0,0 +1,144 @@
+"""
+Lua scripts shared with App_API. They are executed with EVALSHA so a credit
+check or a debit is a single round trip and is atomic across workers.
+
+The credit ledger (REDIS_KEY_USER_CREDIT_LEDGER) is a hash:
+	{"<CustomerCreditsBought id>": <credits remaining>}
+Credits are consumed FIFO, the oldest purchase (lowest id) first.
+"""
+
+"""
+Credits bought before the ledger are in the legacy
+`user_credit_bought:{username}:{id}` keys. The scripts that read the ledger
+start with this function: the first time a user's ledger is read the legacy
+keys are moved into it, REDIS_KEY_USER_CREDIT_LEDGER_FOLDED then marks it as
+done. The key names are built from the ledger key (keep them in sync with
+redis_schemas), the legacy keys are found with SCAN so they are not in KEYS.
+`force` scans again even if the ledger is marked.
+Returns the number of legacy keys moved.
+"""
+CREDIT_LEDGER_FOLD_LEGACY_LUA = """
+local function fold_legacy_credits(ledger_key, force)
+	local username = string.sub(ledger_key, #"user_credit_ledger:" + 1)
+	local folded_key = "user_credit_ledger_folded:" .. username
+	if not force and redis.call("EXISTS", folded_key) == 1 then
+		return 0
+	end
+
+	local prefix = "user_credit_bought:" .. username .. ":"
+	local pattern = string.gsub(prefix, "[%*%?%[%]\\\\]", "\\\\%0") .. "*"
+	local folded = 0
+	local cursor = "0"
+	repeat
+		local result = redis.call("SCAN", cursor, "MATCH", pattern, "COUNT", 1000)
+		cursor = result[1]
+		for _, key in ipairs(result[2]) do
+			local id = string.sub(key, #prefix + 1)
+			local credits = redis.call("GET", key)
+			if string.match(id, "^%d+$") and credits then
+				redis.call("HSET", ledger_key, id, credits)
+				redis.call("DEL", key)
+				folded = folded + 1
+			end
+		end
+	until cursor == "0"
+
+	redis.call("SET", folded_key, 1)
+	return folded
+end
+"""
+
+"""
+KEYS[1] credit ledger, KEYS[2] subscription monthly credits remaining,
+KEYS[3] (optional) has active subscription flag.
+If KEYS[3] is given the subscription credits only count while it is not 0.
+Returns {credits_bought_remaining, subscription_credits_remaining}
+"""
+CREDIT_LEDGER_BALANCE_LUA = CREDIT_LEDGER_FOLD_LEGACY_LUA + """
+fold_legacy_credits(KEYS[1], false)
+
+local bought = 0
+for _, value in ipairs(redis.call("HVALS", KEYS[1])) do
+	bought = bought + tonumber(value)
+end
+
+local subscription = tonumber(redis.call("GET", KEYS[2]) or "0")
+if KEYS[3] and tonumber(redis.call("GET", KEYS[3]) or "0") == 0 then
+	subscription = 0
+end
+
+return {bought, subscription}
+"""
+
+"""
+KEYS as for CREDIT_LEDGER_BALANCE_LUA.
+ARGV[1] cost, ARGV[2] use bought credits (1/0),
+ARGV[3] fall back to the subscription credits (1/0),
+ARGV[4] check the balance first (1/0),
+ARGV[5] (optional) take all that the bought credits don't cover from the
+subscription credits, even if they go below 0 (1/0).
+Returns the part of the cost that could not be covered, or -1 if the balance
+check failed, in which case nothing was debited.
+"""
+CREDIT_LEDGER_DEBIT_LUA = CREDIT_LEDGER_FOLD_LEGACY_LUA + """
+fold_legacy_credits(KEYS[1], false)
+
+local remaining = tonumber(ARGV[1])
+local use_bought = ARGV[2] == "1"
+local use_subscription = ARGV[3] == "1"
+local check_balance = ARGV[4] == "1"
+local overdraw = ARGV[5] == "1"
+
+local entries = {}
+if use_bought then
+	local flat = redis.call("HGETALL", KEYS[1])
+	for i = 1, #flat, 2 do
+		entries[#entries + 1] = {flat[i], tonumber(flat[i + 1])}
+	end
+	table.sort(entries, function(a, b)
+		return tonumber(a[1]) < tonumber(b[1])
+	end)
+end
+
+local subscription = 0
+if use_subscription then
+	subscription = tonumber(redis.call("GET", KEYS[2]) or "0")
+	if KEYS[3] and tonumber(redis.call("GET", KEYS[3]) or "0") == 0 then
+		subscription = 0
+	end
+end
+
+if check_balance then
+	local available = math.max(subscription, 0)
+	for _, entry in ipairs(entries) do
+		available = available + entry[2]
+	end
+	if available < remaining then
+		return -1
+	end
+end
+
+for _, entry in ipairs(entries) do
+	if remaining <= 0 then
+		break
+	end
+	if entry[2] > remaining then
+		redis.call("HINCRBY", KEYS[1], entry[1], -remaining)
+		remaining = 0
+	else
+		redis.call("HDEL", KEYS[1], entry[1])
+		remaining = remaining - entry[2]
+	end
+end
+
+if remaining > 0 and use_subscription and overdraw then
+	redis.call("DECRBY", KEYS[2], remaining)
+	remaining = 0
+elseif remaining > 0 and subscription > 0 then
+	local taken = math.min(subscription, remaining)
+	redis.call("DECRBY", KEYS[2], taken)
+	remaining = remaining - taken
+end
+
+return remaining
+"""
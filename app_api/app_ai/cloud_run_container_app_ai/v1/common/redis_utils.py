@@ -11,9 +11,12 @@ from core import settings
 from common.redis_schemas import (
 	REDIS_KEY_USER_WHATSAPP_MSG, REDIS_KEY_UNKNOWN_USER_WHATSAPP_TIMESTAMP,
 	REDIS_KEY_USER_PHONE_NUMBER, REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER,
-	REDIS_KEY_USER_CREDIT_BOUGHT, REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
-	ENTERPRISE_USER_MAX_CREDITS_LIMIT_PER_MONTH
+	REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER, REDIS_KEY_CREDITS_USED_PER_DAY_USERS,
+	REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER, REDIS_CREDITS_USED_TIMELINE_MEMBER,
+	REDIS_KEY_USER_CREDIT_LEDGER, REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
+	REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION, ENTERPRISE_USER_MAX_CREDITS_LIMIT_PER_MONTH
 )
+from common.redis_scripts import CREDIT_LEDGER_DEBIT_LUA
 from common.pub_sub_schema import LLMCost
 from common.twilio_utils import send_whatsapp_message
 
@@ -273,94 +276,141 @@ def check_phone_numer_belongs_to_user(
 
 
 # COST LOGIC
-def decrement_user_bought_credits(username: str, call_cost: int) -> int:
+def decrement_user_bought_credits(
+		username: str, call_cost: int, fallback_to_subscription: bool = False,
+) -> int:
 	"""
 	This function will decrement the user's bought credits by the call_cost
-	amount. If the user has enough credits, it will decrement the credits
-	and return 0. If the user doesn't have enough credits, it will return
-	the remaining number of credits that the user needs to pay.
+	amount, oldest purchase first. If the user has enough credits, it will
+	decrement the credits and return 0. If the user doesn't have enough credits,
+	it will return the remaining number of credits that the user needs to pay.
+	With `fallback_to_subscription` the remainder is taken from the monthly
+	subscription credits in the same atomic script.
 	"""
-	key_pattern = REDIS_KEY_USER_CREDIT_BOUGHT.format(username=username, id="*")
 	with RedisClient() as redis_conn:
-		keys = [key for key in redis_conn.scan_iter(match=key_pattern)]
-		sorted_keys = sorted(
-			# sort keys based on 'id'
-			keys, key=lambda k: int(k.decode("utf-8").split(":")[-1])
+		debit_script = redis_conn.register_script(CREDIT_LEDGER_DEBIT_LUA)
+		return int(
+			debit_script(
+				keys=[
+					REDIS_KEY_USER_CREDIT_LEDGER.format(username=username),
+					REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
+						username=username
+					),
+					REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(
+						username=username
+					),
+				],
+				args=[call_cost, 1, int(fallback_to_subscription), 0],
+			)
 		)
 
-		for key in sorted_keys:
-			current_key_value = int(redis_conn.get(key))
-	
-			if current_key_value > call_cost:
-				redis_conn.decr(key, call_cost)
-				return 0
-			else:
-				# if the current key value is less than the call_cost
-				# decrement the call_cost and delete the key
-				call_cost -= current_key_value
-				redis_conn.delete(key)
-	
-				if call_cost <= 0:
-					return 0
-	
-		return call_cost
-
 
 def update_user_credits(username: str, call_cost: int) -> None:
 	remaining_call_cost = decrement_user_bought_credits(
-		username=username, call_cost=call_cost,
+		username=username, call_cost=call_cost, fallback_to_subscription=True,
 	)
 
-	if remaining_call_cost == 0:
-		return
-	
-	subs_remaining_key = REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
-		username=username
-	)
-	with RedisClient() as redis_conn:
-		subs_remaining_value = redis_conn.get(subs_remaining_key)
-		
-		if subs_remaining_value:
-			value = int(subs_remaining_value)
-			if value >= remaining_call_cost:
-				redis_conn.decr(
-					name=subs_remaining_key, amount=remaining_call_cost)
-			else:
-				redis_conn.set(name=subs_remaining_key, value=0)
-			
+	if remaining_call_cost > 0:
+		logger.warning(
+			f"User {username} ran out of credits, {remaining_call_cost} "
+			f"credits were not charged."
+		)
 
 
 def log_credits_used_per_api_endpoint_by_user(
 	username: str, api_name: str, call_cost: int, current_date: str,
 	timestamp: int,
 ):
+	"""
+	Depending on `REDIS_USAGE_COUNTERS_MODE` stores one legacy key per call
+	and/or increments the per day counters of the user, in one transaction.
+	"""
 	characters = string.ascii_letters + string.digits
+	random_char = "".join(random.choice(characters) for _ in range(5))
 	with RedisClient() as redis_conn:
-		key = REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.format(
-			date=current_date,
-			username=username,
-			api_name=api_name,
-			timestamp=timestamp,
-			random_char="".join(random.choice(characters) for _ in range(5))
-		)
-		redis_conn.set(
-			name=key,
-			value=call_cost,
-			ex=settings.REDIS_KEY_TTL_MAX,
-		)
+		pipeline = redis_conn.pipeline(transaction=True)
+
+		if settings.REDIS_USAGE_COUNTERS_MODE in ("legacy", "dual"):
+			pipeline.set(
+				name=REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.format(
+					date=current_date,
+					username=username,
+					api_name=api_name,
+					timestamp=timestamp,
+					random_char=random_char,
+				),
+				value=call_cost,
+				ex=settings.REDIS_KEY_TTL_MAX,
+			)
+
+		if settings.REDIS_USAGE_COUNTERS_MODE in ("dual", "counters"):
+			day_key = REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER.format(
+				username=username, date=current_date
+			)
+			users_key = REDIS_KEY_CREDITS_USED_PER_DAY_USERS.format(
+				date=current_date
+			)
+			timeline_key = REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER.format(
+				username=username, date=current_date
+			)
+			pipeline.hincrby(day_key, f"{api_name}:credits", call_cost)
+			pipeline.hincrby(day_key, f"{api_name}:calls", 1)
+			pipeline.sadd(users_key, username)
+			pipeline.zadd(
+				timeline_key,
+				{
+					REDIS_CREDITS_USED_TIMELINE_MEMBER.format(
+						timestamp=timestamp,
+						api_name=api_name,
+						credits=call_cost,
+						random_char=random_char,
+					): timestamp
+				},
+			)
+			for key in (day_key, users_key, timeline_key):
+				pipeline.expire(key, settings.REDIS_KEY_TTL_MAX)
+
+		pipeline.execute()
 
 
 def get_credits_used_by_user_x_days_ago(days: int, username: str) -> int:
 	"""
 	Get the credits used by the user X days ago
 	"""
-	
+	dates = [
+		(datetime.now() - timedelta(days=i)).strftime("%d-%m-%Y")
+		for i in range(days)
+	]
+
+	if settings.REDIS_USAGE_COUNTERS_MODE != "counters":
+		return _get_credits_used_by_user_from_legacy_keys(
+			dates=dates, username=username
+		)
+
+	with RedisClient() as client:
+		pipeline = client.pipeline(transaction=False)
+		for current_date in dates:
+			pipeline.hgetall(
+				REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER.format(
+					username=username, date=current_date
+				)
+			)
+		results = pipeline.execute()
+
+	return sum(
+		int(value)
+		for day_counters in results
+		for field, value in day_counters.items()
+		if field.endswith(b":credits")
+	)
+
+
+def _get_credits_used_by_user_from_legacy_keys(
+		dates: list[str], username: str
+) -> int:
 	total_credits_used = 0
 	with RedisClient() as client:
-		for i in range(days):
-			current_date = (
-					datetime.now() - timedelta(days=i)).strftime("%d-%m-%Y")
-			
+		for current_date in dates:
 			key_pattern = (
 				f"credits_used_per_api_endpoint_by_user:{current_date}:"
 				f"{username}:*"
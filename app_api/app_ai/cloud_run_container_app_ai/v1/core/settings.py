@@ -201,6 +201,11 @@ MEDIA_FILE_HUMAN_MSG_FORMAT = (
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
 REDIS_DB_DEFAULT = os.getenv("REDIS_DB_DEFAULT")
+# how the credits used per API call are stored, see `redis_schemas`:
+# "legacy" one key per call, "counters" per day hashes and timelines,
+# "dual" writes both and still reads the legacy keys (while migrating), switch
+# every app to "counters" once `migrate_usage_counters` has backfilled them
+REDIS_USAGE_COUNTERS_MODE = os.getenv("REDIS_USAGE_COUNTERS_MODE", "dual")
 # ------------ REDIS end
 
 # ------------ Twilio start
@@ -234,6 +239,19 @@ ZENDESK_GROUP_SETTINGS_KEY = ast.literal_eval(
 TEMP_API_FILES_BUCKET = os.getenv("TEMP_API_FILES_BUCKET")
 BUKET_BASE_URL = os.getenv("BUKET_BASE_URL")
 BUKET_GCP_URL = os.getenv("BUKET_GCP_URL")
+# files this big are uploaded in chunks of TEMP_API_FILES_UPLOAD_CHUNK_SIZE,
+# TEMP_API_FILES_UPLOAD_WORKERS at a time
+TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD = int(
+	os.getenv(
+		"TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD", str(32 * 1024 * 1024)
+	)
+)
+TEMP_API_FILES_UPLOAD_CHUNK_SIZE = int(
+	os.getenv("TEMP_API_FILES_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))
+)
+TEMP_API_FILES_UPLOAD_WORKERS = int(
+	os.getenv("TEMP_API_FILES_UPLOAD_WORKERS", "8")
+)
 # ------------ TEMP Bucket end
 
 # ------------ VertexAI GCP
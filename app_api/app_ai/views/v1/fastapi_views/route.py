@@ -1,3 +1,5 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 
-v1_view_ai_router = APIRouter(tags=["AI"])
+from access_management.rate_limit import rate_limit
+
+v1_view_ai_router = APIRouter(tags=["AI"], dependencies=[Depends(rate_limit)])
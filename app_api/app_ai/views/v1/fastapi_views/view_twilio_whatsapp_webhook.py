@@ -13,8 +13,7 @@ from common.external_resources import publish_whatsapp_msg_to_pubsub
 from common.redis_utils import (
 	get_redis_key_value, get_redis_conn, rate_limit_twilio_whatsapp_msg,
 	check_if_user_has_metered_subscription, get_all_llm_costs, log_api_call,
-	check_if_user_has_exceeded_daily_api_call_limit, sum_user_credits_bought,
-	get_user_subscriptions_monthly_credit_remaining
+	check_if_user_has_exceeded_daily_api_call_limit, get_user_credit_balance,
 )
 from app_ai.cloud_run_container_app_ai.v1.common.pub_sub_schema import (
 	TwilioPublisherMsg, LLMCost
@@ -81,22 +80,17 @@ async def v1_twilio_whatsapp_webhook(
 				username=username,
 			)
 		)
-		twilio_publisher_msg.user_credits_bought_remaining = (
-			await sum_user_credits_bought(
-				redis_conn=redis_conn,
-				username=username,
-			)
-		)
-		twilio_publisher_msg.subscriptions_monthly_credit_remaining = (
-			await get_user_subscriptions_monthly_credit_remaining(
-				redis_conn=redis_conn,
-				username=username,
-			)
+		(
+			twilio_publisher_msg.user_credits_bought_remaining,
+			twilio_publisher_msg.subscriptions_monthly_credit_remaining,
+		) = await get_user_credit_balance(
+			redis_conn=redis_conn,
+			username=username,
 		)
 		all_llm_costs = await get_all_llm_costs(redis_conn)
 		twilio_publisher_msg.all_llm_costs = LLMCost(**all_llm_costs)
 
-	resp = publish_whatsapp_msg_to_pubsub(input_data=twilio_publisher_msg)
+	resp = await publish_whatsapp_msg_to_pubsub(input_data=twilio_publisher_msg)
 
 	if resp:
 		return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -18,5 +18,7 @@ app_ai_v1_urls = {
 			)
 		),
 		is_active=True,
+		# Twilio authenticates with its signature, not with a user token
+		other={"rate_limit": False},
 	),
 }
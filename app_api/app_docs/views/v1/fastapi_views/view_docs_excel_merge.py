@@ -9,7 +9,7 @@ from schemas.urls import CloudRunAPIEndpoint
 from access_management.api_auth import verify_token
 from common.cloud_run import async_request
 from common.file_validation import (
-	validate_file_type, validate_file_size_mb
+	validate_file_type, validate_file_size_mb, get_upload_file_size,
 )
 from common.cost_management import cost_setup, cost_teardown
 from common.redis_utils import get_redis_conn
@@ -82,12 +82,7 @@ async def view_docs_excel_merge(
 		)
 
 		# Validate file size and extension
-		file_sizes = 0
-
-		for f in files:
-			contents = await f.read()
-			await f.seek(0)
-			file_sizes += len(contents)
+		file_sizes = sum(get_upload_file_size(f) for f in files)
 
 		if file_sizes > URL_DATA.other["max_files_size_mb"] * 1024 * 1024:
 			raise HTTPException(
@@ -1,3 +1,7 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 
-v1_view_epub_router = APIRouter(tags=["App ePub"])
+from access_management.rate_limit import rate_limit
+
+v1_view_epub_router = APIRouter(
+    tags=["App ePub"], dependencies=[Depends(rate_limit)]
+)
@@ -6,9 +6,11 @@ from fastapi import UploadFile, File, status, Depends, HTTPException, Form
 
 from core.urls import urls
 from schemas.auth import TokenData
+from schemas.jobs import JobOptions
 from schemas.urls import CloudRunAPIEndpoint
 from access_management.api_auth import verify_token
 from common.cloud_run import async_request
+from common.jobs import get_job_options, submit_job
 from common.file_validation import validate_file_size_mb
 from common.cost_management import cost_setup, cost_teardown
 from common.redis_utils import get_redis_conn
@@ -28,9 +30,21 @@ URL_DATA: CloudRunAPIEndpoint = urls[APP_NAME][VERSION][API]
 async def view_epub_convert(
 		token_data: TokenData = Depends(verify_token),
 		redis_conn=Depends(get_redis_conn),
+		job_options: JobOptions = Depends(get_job_options),
 		output_format: Literal['pdf', 'epub', 'docx'] = Form(...),
 		file: UploadFile = File(...),
 ):
+	if job_options.respond_async:
+		return await submit_job(
+			redis_conn=redis_conn,
+			token_data=token_data,
+			api_name=API_NAME,
+			job_options=job_options,
+			files=[("file", file)],
+			max_size_mb=URL_DATA.other["file_size_mb"],
+			data={"output_format": output_format},
+		)
+
 	# Necessary variables
 	date_time_now = datetime.now()
 	current_date = datetime.now().strftime("%d-%m-%Y")
@@ -19,6 +19,6 @@ app_epub_v1_urls = {
 			)
 		),
 		is_active=False,
-		other={"file_size_mb": 10},
+		other={"file_size_mb": 10, "timeout": 120},
 	),
 }
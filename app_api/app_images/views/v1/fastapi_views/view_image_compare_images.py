@@ -67,8 +67,8 @@ async def view_image_compare_images(
 		)
 
 		override_files = [
-			("img_1", (img_1.filename, await img_1.read(), img_1.content_type)),
-			("img_2", (img_2.filename, await img_2.read(), img_2.content_type)),
+			("img_1", (img_1.filename, img_1.file, img_1.content_type)),
+			("img_2", (img_2.filename, img_2.file, img_2.content_type)),
 		]
 		resp = await async_request(
 				url=URL_DATA.url_target,
@@ -115,7 +115,7 @@ async def view_image_create_gif(
 			override_files = [
 				(
 					"img_files",
-					(img.filename, await img.read(), img.content_type)
+					(img.filename, img.file, img.content_type)
 				)
 				for img in img_files
 			]
@@ -125,7 +125,7 @@ async def view_image_create_gif(
 				(
 					"movie_file",
 					(
-						movie_file.filename, await movie_file.read(),
+						movie_file.filename, movie_file.file,
 						movie_file.content_type
 					)
 				)
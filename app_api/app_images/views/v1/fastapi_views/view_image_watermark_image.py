@@ -90,7 +90,7 @@ async def view_image_watermark_image(
 				"background_image",
 				(
 					background_image.filename,
-					await background_image.read(),
+					background_image.file,
 					background_image.content_type
 				)
 			),
@@ -98,7 +98,7 @@ async def view_image_watermark_image(
 				"watermark_image",
 				(
 					watermark_image.filename,
-					await watermark_image.read(),
+					watermark_image.file,
 					watermark_image.content_type
 				)
 			),
@@ -116,7 +116,7 @@ async def view_image_watermark_text(
 				"background_image",
 				(
 					background_image.filename,
-					await background_image.read(),
+					background_image.file,
 					background_image.content_type
 				)
 			),
@@ -128,7 +128,7 @@ async def view_image_watermark_text(
 					"font_file",
 					(
 						font_file.filename,
-						await font_file.read(),
+						font_file.file,
 						font_file.content_type
 					)
 				)
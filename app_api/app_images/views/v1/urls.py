@@ -86,7 +86,9 @@ app_images_v1_urls = {
 		is_active=True,
 		other={
 			"media_type": ["image/jpeg", "image/jpg", "image/png"],
-			"file_size_mb": 10
+			"file_size_mb": 10,
+			"batch": True,
+			"cache": True,
 		},
 	),
 	"view_image_create_ico": CloudRunAPIEndpoint(
@@ -120,6 +122,8 @@ app_images_v1_urls = {
 		other={
 			"media_type": ["image/png"],
 			"file_size_mb": 2,
+			"cache": True,
+			"hedge": True,
 		},
 	),
 	"view_image_create_barcode": CloudRunAPIEndpoint(
@@ -134,7 +138,7 @@ app_images_v1_urls = {
 			)
 		),
 		is_active=True,
-		other={},
+		other={"cache": True, "hedge": True},
 	),
 	"view_image_decode_qr_and_barcodes": CloudRunAPIEndpoint(
 		api_url=join(
@@ -203,6 +207,8 @@ app_images_v1_urls = {
 		other={
 			"media_type": ["image/jpeg", "image/jpg", "image/png"],
 			"file_size_mb": 30,
+			"batch": True,
+			"cache": True,
 		},
 	),
 	"view_image_cartoonify": CloudRunAPIEndpoint(
@@ -238,7 +244,9 @@ app_images_v1_urls = {
 		is_active=True,
 		other={
 			"media_type": ["image/jpeg", "image/jpg", "image/png"],
-			"file_size_mb": 10
+			"file_size_mb": 10,
+			# the model runs on CPU, keep the bursts small
+			"rate_limit": {"period": 60, "free": 5, "subscription": 15},
 		},
 	),
 	"view_image_watermark_text": CloudRunAPIEndpoint(
@@ -292,6 +300,8 @@ app_images_v1_urls = {
 		other={
 			"file_size_mb": 30,
 			"media_type": ["image/jpeg", "image/jpg", "image/png"],
+			"batch": True,
+			"cache": True,
 		},
 	),
 	"view_image_convert_to_gray": CloudRunAPIEndpoint(
@@ -308,6 +318,8 @@ app_images_v1_urls = {
 		other={
 			"file_size_mb": 30,
 			"media_type": ["image/jpeg", "image/jpg", "image/png"],
+			"batch": True,
+			"cache": True,
 		},
 	),
 	"view_image_convert_dicom_to_jpg": CloudRunAPIEndpoint(
@@ -339,6 +351,8 @@ app_images_v1_urls = {
 		is_active=True,
 		other={
 			"file_size_mb": 30,
+			"batch": True,
+			"cache": True,
 		},
 	),
 }
@@ -1,10 +1,14 @@
 import os
 import json
+import time
+import base64
+import struct
 import logging
+from collections import OrderedDict
 
 from google.cloud import secretmanager
 from fastapi import HTTPException, Request
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
 
 logger = logging.getLogger("APP_PDF_V1_"+__name__)
@@ -31,8 +35,42 @@ if os.getenv("ENV_MODE") != "local":
         logger.error(msg)
         raise ValueError(msg)
 
-FERNET_CIPHER = Fernet(os.environ.get("CRYPT_SECRET_KEY_G_CLOUD_RUN"))
+# comma separated, the first key is the newest one, see "How to rotate the
+# Cloud Run key" in the App_API ReadMe
+FERNET_CIPHER = MultiFernet([
+    Fernet(key.strip())
+    for key in os.environ.get("CRYPT_SECRET_KEY_G_CLOUD_RUN").split(",")
+])
 EXPECTED_TOKEN_CLOUD_RUN = os.environ.get("EXPECTED_TOKEN_CLOUD_RUN")
+# App_API reuses its token for SERVICE_TOKEN_REFRESH_INTERVAL seconds
+SERVICE_TOKEN_MAX_AGE = int(os.getenv("SERVICE_TOKEN_MAX_AGE", "900"))
+VERIFIED_TOKENS_MAX_SIZE = 128
+
+# {token: time.time() after which it is no longer accepted}
+VERIFIED_TOKENS: OrderedDict = OrderedDict()
+
+
+def is_verified_token(token: str) -> bool:
+    expires_at = VERIFIED_TOKENS.get(token)
+    if expires_at is None:
+        return False
+    if expires_at <= time.time():
+        del VERIFIED_TOKENS[token]
+        return False
+
+    VERIFIED_TOKENS.move_to_end(token)
+    return True
+
+
+def add_verified_token(token: str) -> None:
+    # bytes 1-8 of a Fernet token are the big-endian timestamp it was minted at
+    issued_at = struct.unpack(
+        ">Q", base64.urlsafe_b64decode(token.encode())[1:9]
+    )[0]
+    VERIFIED_TOKENS[token] = issued_at + SERVICE_TOKEN_MAX_AGE
+    VERIFIED_TOKENS.move_to_end(token)
+    while len(VERIFIED_TOKENS) > VERIFIED_TOKENS_MAX_SIZE:
+        VERIFIED_TOKENS.popitem(last=False)
 
 
 async def verify_token(req: Request) -> bool:
@@ -55,12 +93,17 @@ async def verify_token(req: Request) -> bool:
     if token_type.lower() != "bearer":
         raise HTTPException(status_code=401, detail="Invalid token type")
 
+    if is_verified_token(token):
+        return True
+
     try:
         if (
                 EXPECTED_TOKEN_CLOUD_RUN == FERNET_CIPHER.decrypt(
-                                                token.encode()
+                                                token.encode(),
+                                                ttl=SERVICE_TOKEN_MAX_AGE,
                                             ).decode()
         ):
+            add_verified_token(token)
             return True
         else:
             raise HTTPException(
@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 from datetime import datetime
 
 import redis.asyncio as redis
@@ -6,9 +7,11 @@ from fastapi import UploadFile, status, HTTPException
 
 from core.urls import urls
 from schemas.auth import TokenData
+from schemas.jobs import JobOptions
 from core.settings import GENERIC_ERROR_MSG
 from schemas.urls import CloudRunAPIEndpoint
 from common.cloud_run import async_request
+from common.jobs import submit_job
 from common.cost_management import cost_setup, cost_teardown
 from common.file_validation import validate_file_type, validate_file_size_mb
 from common.redis_utils import set_user_api_call_lock, release_user_api_call_lock
@@ -22,12 +25,23 @@ logger = logging.getLogger("APP_API_"+API_NAME+__name__)
 
 async def get_cloud_run_response(
 		token_data: TokenData, redis_conn: redis.Redis, file: UploadFile,
+		job_options: Optional[JobOptions] = None,
 ):
 	validate_file_type(
 		file=file, file_extensions=('pdf',),
 		content_type=tuple(URL_DATA.other["media_type"]),
 	)
 
+	if job_options and job_options.respond_async:
+		return await submit_job(
+			redis_conn=redis_conn,
+			token_data=token_data,
+			api_name=API_NAME,
+			job_options=job_options,
+			files=[("file", file)],
+			max_size_mb=URL_DATA.other["file_size_mb"],
+		)
+
 	date_time_now = datetime.now()
 	current_date = datetime.now().strftime("%d-%m-%Y")
 	timestamp = int(date_time_now.timestamp())
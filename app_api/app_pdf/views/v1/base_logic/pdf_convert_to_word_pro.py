@@ -5,14 +5,17 @@ https://console.cloud.google.com/apis/api/drive.googleapis.com/metrics
 
 import io
 import os
+import shutil
 import logging
 import tempfile
+from typing import Optional
 from datetime import datetime
 from http import HTTPStatus
 
 import redis.asyncio as redis
-from fastapi import UploadFile, HTTPException
+from fastapi import UploadFile, HTTPException, Response
 from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
@@ -20,10 +23,12 @@ from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 from core import settings
 from core.urls import urls
 from schemas.auth import TokenData
+from schemas.jobs import JobOptions
 from schemas.urls import ExternalAPIEndpoint
 from common.other import generate_unique_filename, cleanup_temp_dir
 from common.file_validation import validate_file_size_mb, validate_file_type
 from common.cost_management import cost_setup, cost_teardown
+from common.jobs import job_handler, submit_job
 from common.redis_utils import set_user_api_call_lock, release_user_api_call_lock
 
 
@@ -38,14 +43,111 @@ EXPORT_MEDIA_TYPE = (
 )
 
 
+def convert_pdf_to_docx(pdf_path: str, temp_dir: str) -> str:
+	"""
+	Converts the PDF with Google Docs and returns the path of the .docx, the
+	Google API client is blocking so it runs in the thread pool.
+	"""
+	unique_filename = os.path.basename(pdf_path)
+
+	creds = Credentials.from_service_account_info(
+		settings.GCF_SERVICE_ACCOUNT_JSON,
+		scopes=['https://www.googleapis.com/auth/drive'],
+	)
+	service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+
+	file_metadata = {
+		'name': unique_filename.replace('.pdf', ''),
+		# Set the MIME type to Google Docs
+		'mimeType': 'application/vnd.google-apps.document'
+	}
+
+	media = MediaFileUpload(
+		pdf_path, mimetype='application/pdf', resumable=True
+	)
+
+	gfile = service.files().create(
+		body=file_metadata, media_body=media, fields='id'
+	).execute()
+
+	file_id = gfile.get('id')
+
+	request = service.files().export_media(
+		fileId=file_id,
+		mimeType=EXPORT_MEDIA_TYPE
+	)
+
+	fh = io.BytesIO()
+	downloader = MediaIoBaseDownload(fh, request)
+
+	while True:
+		status, done = downloader.next_chunk()
+		if done:
+			break
+	unique_filename_docx = unique_filename.lower().replace('.pdf', '.docx')
+	docx_path = os.path.join(temp_dir, unique_filename_docx)
+	with open(docx_path, 'wb') as f:
+		fh.seek(0)
+		f.write(fh.read())
+
+	service.files().delete(fileId=file_id).execute()
+
+	return docx_path
+
+
+@job_handler(API_NAME)
+async def run_job(job: dict, files: list[tuple]) -> Response:
+	_, (filename, fileobj, _) = files[0]
+	temp_dir = tempfile.mkdtemp()
+
+	try:
+		pdf_path = os.path.join(
+			temp_dir, generate_unique_filename(extension=".pdf")
+		)
+		with open(pdf_path, "wb") as f:
+			shutil.copyfileobj(fileobj, f)
+
+		docx_path = await run_in_threadpool(
+			convert_pdf_to_docx, pdf_path, temp_dir
+		)
+		with open(docx_path, "rb") as f:
+			docx_content = f.read()
+	finally:
+		cleanup_temp_dir(temp_dir=temp_dir)
+
+	docx_filename = filename.lower().replace(".pdf", ".docx")
+	return Response(
+		content=docx_content,
+		media_type=EXPORT_MEDIA_TYPE,
+		headers={
+			"content-disposition": f'attachment; filename="{docx_filename}"'
+		},
+		status_code=HTTPStatus.OK.value,
+	)
+
+
 async def get_response(
 		token_data: TokenData, redis_conn: redis.Redis, file: UploadFile,
+		job_options: Optional[JobOptions] = None,
 ):
 	validate_file_type(
 		file=file, file_extensions=('pdf',),
 		content_type=tuple(URL_DATA.other["media_type"]),
 	)
 
+	if job_options and job_options.respond_async:
+		return {
+			"resp": await submit_job(
+				redis_conn=redis_conn,
+				token_data=token_data,
+				api_name=API_NAME,
+				job_options=job_options,
+				files=[("file", file)],
+				max_size_mb=URL_DATA.other["file_size_mb"],
+			),
+			"temp_dir": None,
+		}
+
 	date_time_now = datetime.now()
 	current_date = datetime.now().strftime("%d-%m-%Y")
 	timestamp = int(date_time_now.timestamp())
@@ -75,47 +177,10 @@ async def get_response(
 		with open(pdf_path, "wb") as f:
 			f.write(await file.read())
 
-		creds = Credentials.from_service_account_info(
-			settings.GCF_SERVICE_ACCOUNT_JSON,
-			scopes=['https://www.googleapis.com/auth/drive'],
+		docx_path = await run_in_threadpool(
+			convert_pdf_to_docx, pdf_path, temp_dir
 		)
-		service = build('drive', 'v3', credentials=creds, cache_discovery=False)
-
-		file_metadata = {
-			'name': unique_filename.replace('.pdf', ''),
-			# Set the MIME type to Google Docs
-			'mimeType': 'application/vnd.google-apps.document'
-		}
-
-		media = MediaFileUpload(
-			pdf_path, mimetype='application/pdf', resumable=True
-		)
-
-		gfile = service.files().create(
-			body=file_metadata, media_body=media, fields='id'
-		).execute()
-
-		file_id = gfile.get('id')
-
-		request = service.files().export_media(
-			fileId=file_id,
-			mimeType=EXPORT_MEDIA_TYPE
-		)
-
-		fh = io.BytesIO()
-		downloader = MediaIoBaseDownload(fh, request)
-
-		while True:
-			status, done = downloader.next_chunk()
-			if done:
-				break
-		unique_filename_docx = unique_filename.lower().replace('.pdf', '.docx')
-		docx_path = os.path.join(temp_dir, unique_filename_docx)
-		with open(docx_path, 'wb') as f:
-			fh.seek(0)
-			f.write(fh.read())
-
-		service.files().delete(fileId=file_id).execute()
+		unique_filename_docx = os.path.basename(docx_path)
 
 		resp = FileResponse(
 			path=docx_path,
@@ -70,14 +70,14 @@ async def get_cloud_run_response(
 			(
 				"base_file",
 				(
-					base_file.filename, await base_file.read(),
+					base_file.filename, base_file.file,
 					base_file.content_type
 				)
 			),
 			(
 				"insert_file",
 				(
-					insert_file.filename, await insert_file.read(),
+					insert_file.filename, insert_file.file,
 					insert_file.content_type
 				)
 			),
@@ -9,7 +9,7 @@ from core.settings import GENERIC_ERROR_MSG
 from schemas.auth import TokenData
 from schemas.urls import CloudRunAPIEndpoint
 from common.cloud_run import async_request
-from common.file_validation import validate_file_type
+from common.file_validation import validate_file_type, get_upload_file_size
 from common.cost_management import cost_setup, cost_teardown
 from common.redis_utils import set_user_api_call_lock, release_user_api_call_lock
 
@@ -53,12 +53,7 @@ async def get_cloud_run_response(
 		)
 
 		# validate all file sizes are under max_files_size_mb
-		file_sizes = 0
-
-		for f in files:
-			contents = await f.read()
-			await f.seek(0)
-			file_sizes += len(contents)
+		file_sizes = sum(get_upload_file_size(f) for f in files)
 
 		if file_sizes > URL_DATA.other["max_files_size_mb"] * 1024 * 1024:
 			raise HTTPException(
@@ -67,14 +67,14 @@ async def get_cloud_run_response(
 			(
 				"pdf_file",
 				(
-					pdf_file.filename, await pdf_file.read(),
+					pdf_file.filename, pdf_file.file,
 					pdf_file.content_type
 				)
 			),
 			(
 				"image_file",
 				(
-					image_file.filename, await image_file.read(),
+					image_file.filename, image_file.file,
 					image_file.content_type
 				)
 			),
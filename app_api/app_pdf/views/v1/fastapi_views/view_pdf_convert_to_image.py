@@ -3,8 +3,10 @@ import logging
 from fastapi import UploadFile, File, Depends
 
 from schemas.auth import TokenData
+from schemas.jobs import JobOptions
 from access_management.api_auth import verify_token
 from common.redis_utils import get_redis_conn
+from common.jobs import get_job_options
 from app_pdf.views.v1.base_logic.pdf_convert_to_image import (
 	API_NAME, URL_DATA, get_cloud_run_response,
 )
@@ -17,10 +19,12 @@ logger = logging.getLogger("APP_API_"+API_NAME+__name__)
 async def view_pdf_convert_to_image(
 		token_data: TokenData = Depends(verify_token),
 		redis_conn=Depends(get_redis_conn),
+		job_options: JobOptions = Depends(get_job_options),
 		file: UploadFile = File(...),
 ):
 	return await get_cloud_run_response(
 		token_data=token_data,
 		redis_conn=redis_conn,
-		file=file
+		file=file,
+		job_options=job_options,
 	)
@@ -7,9 +7,11 @@ import logging
 from fastapi import UploadFile, File, BackgroundTasks, Depends
 
 from schemas.auth import TokenData
+from schemas.jobs import JobOptions
 from access_management.api_auth import verify_token
 from common.other import cleanup_temp_dir
 from common.redis_utils import get_redis_conn
+from common.jobs import get_job_options
 from app_pdf.views.v1.base_logic.pdf_convert_to_word_pro import (
 	URL_DATA, get_response,
 )
@@ -23,12 +25,15 @@ async def view_pdf_convert_to_word_pro(
 		background_tasks: BackgroundTasks,
 		token_data: TokenData = Depends(verify_token),
 		redis_conn=Depends(get_redis_conn),
+		job_options: JobOptions = Depends(get_job_options),
 		file: UploadFile = File(...)
 ):
 	resp = await get_response(
 		token_data=token_data,
 		redis_conn=redis_conn,
 		file=file,
+		job_options=job_options,
 	)
-	background_tasks.add_task(cleanup_temp_dir, resp["temp_dir"])
+	if resp["temp_dir"]:  # async jobs clean up after themselves
+		background_tasks.add_task(cleanup_temp_dir, resp["temp_dir"])
 	return resp["resp"]
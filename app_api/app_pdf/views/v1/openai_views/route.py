@@ -1,6 +1,9 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
+
+from access_management.rate_limit import rate_limit
 
 v1_view_pdf_router_openai = APIRouter(
 		tags=["App PDFs OpenAI"],
 		responses={404: {"description": "Not found"}},
+		dependencies=[Depends(rate_limit)],
 	)
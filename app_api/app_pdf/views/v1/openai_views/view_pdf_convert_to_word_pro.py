@@ -63,7 +63,7 @@ async def view_pdf_convert_to_word_pro_openai(
 		with open(temp_file_path, "rb") as f:
 			file_content = f.read()
 
-		file_url = upload_resp_file_content_to_bucket(
+		file_url = await upload_resp_file_content_to_bucket(
 			resp_file_content=file_content,
 			filename=filename,
 			content_type=resp["resp"].headers.get("content-type"),
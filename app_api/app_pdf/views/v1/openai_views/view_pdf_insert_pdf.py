@@ -7,6 +7,7 @@ from schemas.auth import TokenData
 from access_management.api_auth import verify_token
 from common.redis_utils import get_redis_conn
 from common.other import get_filename_from_cd
+from common.cloud_run import read_response_body
 from schemas.openai import RequestModel, ResponseModel
 from common.openai.fastapi_transaltion import (
 	get_file_from_request, upload_resp_file_content_to_bucket
@@ -73,8 +74,8 @@ async def view_pdf_insert_pdf_openai(
 		headers = {k.lower(): v for k, v in resp.headers.items()}
 		filename = get_filename_from_cd(headers=headers)
 
-		file_url = upload_resp_file_content_to_bucket(
-			resp_file_content=resp.body,
+		file_url = await upload_resp_file_content_to_bucket(
+			resp_file_content=await read_response_body(resp),
 			filename=filename,
 			content_type=resp.headers.get("content-type"),
 		)
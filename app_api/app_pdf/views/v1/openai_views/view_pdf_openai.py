@@ -1,16 +1,24 @@
+import copy
+
 from fastapi import Request, Depends
 
 from core.urls import urls
 from core.settings import ENV_MODE
 from schemas.urls import CloudRunAPIEndpoint
-from schemas.redis_db import REDIS_KEY_API_COST
 from app_pdf.views.v1.openai_views.route import v1_view_pdf_router_openai
 from app_pdf.cloud_run_container_app_pdf.v1.views.urls import (
 	urls as cloud_run_urls,
 )
-from common.redis_utils import get_redis_conn
+from common.redis_utils import get_redis_conn, COST_CACHE
 from views.urls import default_urls
-from common.other import clean_openapi_schemas
+from common.openapi_cache import (
+	CachedDocument,
+	openapi_variant,
+	document_response,
+	serialize_document,
+	get_openapi_variant,
+	filter_openapi_schema,
+)
 
 APP_NAME, VERSION, API = "app_pdf", "v1", "view_pdf_openai_openapi_json"
 API_NAME = "/".join([APP_NAME, VERSION, API])
@@ -27,17 +35,16 @@ TO_ALLOW = [
 ]
 
 
-@v1_view_pdf_router_openai.get(URL_DATA.api_url, include_in_schema=True)
-async def v1_view_openapi_pdf(
-		request: Request,
-		redis_conn=Depends(get_redis_conn)
-):
-	openapi_schema = request.app.openapi()
+# {server url: (api costs, document)}, rebuilt when a cost changes. The server
+# url comes from the Host header so we only keep a few of them.
+OPENAPI_PDF_DOCUMENTS: dict[str, tuple[tuple, CachedDocument]] = {}
+OPENAPI_PDF_DOCUMENTS_MAX_SIZE = 8
+
+
+@openapi_variant("openai_pdf")
+def build_openai_pdf_openapi(openapi_schema: dict) -> dict:
 	allowed_prefix = "/pdf/v1"
 	allowed_suffix = "/openai"
-	openapi_schema['info']['summary'] = (
-		"These are the endpoints for the PDF Actions on DoodleOps."
-	)
 
 	# Filter paths
 	filtered_paths = {}
@@ -56,48 +63,73 @@ async def v1_view_openapi_pdf(
 				continue
 			filtered_paths[path] = methods
 
-	# we add the cost in the description of the endpoint
-	price_correlation_dict = {}
-	for k in urls["app_pdf"]["v1"]:
-		key = REDIS_KEY_API_COST.format(api_name="app_pdf/v1/" + k)
+	filtered_schema = filter_openapi_schema(
+		openapi_schema=openapi_schema, filtered_paths=filtered_paths
+	)
+	filtered_schema["info"]["summary"] = (
+		"These are the endpoints for the PDF Actions on DoodleOps."
+	)
+	return filtered_schema
 
-		try:
-			api_price = await redis_conn.get(key)
-		except:
-			api_price = None
 
-		if urls["app_pdf"]["v1"][k].is_active and api_price:
+def add_costs_and_server(
+		openapi_schema: dict, api_costs: tuple, server_url: str
+) -> dict:
+	openapi_schema = copy.deepcopy(openapi_schema)
 
-			price_correlation_dict["app_pdf/v1/" + k] = {
-				"url": urls["app_pdf"]["v1"][k].api_url + "/openai",
-				"api_price": int(api_price) if api_price else None,
-			}
-	for k, v in price_correlation_dict.items():
+	# we add the cost in the description of the endpoint
+	for url, api_price in api_costs:
 		try:
 			api_cost_msg = (
-				f" Cost: {v.get('api_price')} credits."
-				if isinstance(v.get("api_price"), int)
+				f" Cost: {api_price} credits."
+				if isinstance(api_price, int)
 				else (
 					" Cost: Not available. Please visit DoodleOps.com to check "
 					"the cost."
 				)
 			)
-			filtered_paths[v.get("url")]["post"]["description"] += api_cost_msg
+			openapi_schema["paths"][url]["post"]["description"] += api_cost_msg
 		except Exception as e:
 			pass
 
-	openapi_schema["paths"] = filtered_paths
+	openapi_schema["servers"] = [{"url": server_url}]
+	return openapi_schema
+
 
-	pruned_schemas = clean_openapi_schemas(
-		openapi_schema=openapi_schema,
-		filtered_paths=filtered_paths,
+@v1_view_pdf_router_openai.get(URL_DATA.api_url, include_in_schema=True)
+async def v1_view_openapi_pdf(
+		request: Request,
+		redis_conn=Depends(get_redis_conn)
+):
+	if not COST_CACHE.loaded_at:
+		try:
+			await COST_CACHE.load(redis_conn)
+		except:
+			pass  # the document is served without the costs
+
+	api_costs = tuple(
+		(data.api_url + "/openai", COST_CACHE.api_costs["app_pdf/v1/" + k])
+		for k, data in urls["app_pdf"]["v1"].items()
+		if data.is_active and COST_CACHE.api_costs.get("app_pdf/v1/" + k)
 	)
 
+	server_url = request.base_url._url
 	if ENV_MODE != "local":
-		request.base_url._url = request.base_url._url.replace(
-			"http://", "https://"
+		server_url = server_url.replace("http://", "https://")
+
+	cached = OPENAPI_PDF_DOCUMENTS.get(server_url)
+	if cached is None or cached[0] != api_costs:
+		cached = api_costs, serialize_document(
+			add_costs_and_server(
+				openapi_schema=get_openapi_variant(
+					app=request.app, name="openai_pdf"
+				),
+				api_costs=api_costs,
+				server_url=server_url,
+			)
 		)
+		if len(OPENAPI_PDF_DOCUMENTS) >= OPENAPI_PDF_DOCUMENTS_MAX_SIZE:
+			OPENAPI_PDF_DOCUMENTS.clear()
+		OPENAPI_PDF_DOCUMENTS[server_url] = cached
 
-	openapi_schema["components"]["schemas"] = pruned_schemas
-	openapi_schema["servers"] = [{"url": request.base_url._url}]
-	return openapi_schema
+	return document_response(request=request, document=cached[1])
@@ -23,6 +23,7 @@ app_pdf_v1_urls = {
 		other={
 			"media_type": ["application/pdf"],
 			"file_size_mb": 20,
+			"timeout": 120,
 		},
 	),
 	"view_pdf_convert_to_word_pro": ExternalAPIEndpoint(
@@ -148,6 +149,7 @@ app_pdf_v1_urls = {
 			other={
 				"media_type": ["application/pdf"],
 				"file_size_mb": 30,
+				"cache": True,
 			},
 		),
 	"view_pdf_password_management_add": CloudRunAPIEndpoint(
@@ -215,6 +217,11 @@ app_pdf_v1_urls = {
 			other={
 				"media_type": ["application/pdf"],
 				"file_size_mb": 30,
+				# can be called with many files at once, see `common.batch`
+				"batch": True,
+				# the same file and params give the same result, see
+				# `common.result_cache`
+				"cache": True,
 			},
 		),
 	"view_pdf_split": CloudRunAPIEndpoint(
@@ -0,0 +1,44 @@
+"""
+Micro-benchmark for the `check_api_toggle` middleware: the allow-list built
+from `core.urls` on every request (previous behaviour) vs the precompiled
+`API_TOGGLE` lookup.
+
+Run it from app_api/ (make bash cont=api):
+    python -m benchmarks.bench_api_toggle --iterations 100000
+"""
+import timeit
+import argparse
+
+from core.urls import urls
+from core.api_toggle import API_TOGGLE, STATIC_ALLOWED_ENDPOINTS
+
+
+def build_allowed_endpoints_per_request(relative_path: str) -> bool:
+    allowed_endpoints = {
+        data.api_url
+        for app_name, app_versions in urls.items()
+        for app_version, app_endpoints in app_versions.items()
+        for app_endpoint, data in app_endpoints.items()
+        if data.is_active
+    } | set(STATIC_ALLOWED_ENDPOINTS)
+    return relative_path in allowed_endpoints
+
+
+def main(iterations: int) -> None:
+    paths = sorted(API_TOGGLE.allowed_endpoints)[:5] + ["/not/an/endpoint"]
+    for name, func in (
+        ("per request", build_allowed_endpoints_per_request),
+        ("precompiled", API_TOGGLE.is_allowed),
+    ):
+        seconds = timeit.timeit(
+            lambda: [func(path) for path in paths], number=iterations
+        )
+        per_check_ns = seconds / (iterations * len(paths)) * 10**9
+        print(f"{name:<12} {per_check_ns:,.0f} ns/request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+    main(iterations=args.iterations)
@@ -0,0 +1,244 @@
+"""
+Micro-benchmark for the Redis part of `cost_setup`: the current path (the API
+cost from the worker's cost cache and one pipelined `get_billing_context`) vs
+the baseline one, where every value was read with its own command and the
+bought credits were one key per purchase found with SCAN.
+
+Run it from app_api/ (make bash cont=api):
+    python -m benchmarks.bench_cost_setup --iterations 2000 --rtt-ms 0.5
+
+Redis is fakeredis by default (`pip install "fakeredis[lua]"`), `--redis
+settings` uses the Redis from `core.settings` instead. `--rtt-ms` adds an
+artificial delay to every round trip, the local Redis is microseconds away
+while Memorystore seen from Cloud Run is not. The baseline SCAN walks the whole
+keyspace, `--filler-keys` adds unrelated keys to make it as big as in
+production.
+"""
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import importlib.util
+
+import redis.asyncio as redis
+
+from core import settings
+from common import redis_utils
+from common.redis_utils import (
+    init_redis_pool,
+    close_redis_pool,
+    get_billing_context,
+    check_if_user_has_enough_credits,
+    check_if_user_has_metered_subscription,
+    check_if_user_has_exceeded_daily_api_call_limit,
+)
+from schemas.redis_db import (
+    REDIS_KEY_API_COST,
+    REDIS_KEY_USER_CREDIT_LEDGER,
+    REDIS_KEY_USER_API_DAILY_CALLS,
+    REDIS_KEY_USER_API_DAILY_CALL_LIMIT,
+    REDIS_KEY_METERED_SUBSCRIPTION_USERS,
+    REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
+    REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
+)
+
+USERNAME = "benchmark_cost_setup_user"
+API_NAME = "benchmark/v1/cost_setup"
+CURRENT_DATE = "01-01-2000"
+# the per purchase keys the bought credits were stored in before the ledger
+BASELINE_CREDIT_BOUGHT_KEY = "user_credit_bought:{username}:{id}"
+FILLER_KEY = "benchmark_cost_setup_filler:{i}"
+
+
+class RoundTripCounter:
+    """Counts (and optionally delays) every packet sent to Redis."""
+
+    def __init__(self, connection_class, rtt_ms: float):
+        self.round_trips = 0
+        self._connection_class = connection_class
+        self._send_packed_command = connection_class.send_packed_command
+        self._rtt = rtt_ms / 1000
+
+    def __enter__(self):
+        counter = self
+
+        async def send_packed_command(connection, *args, **kwargs):
+            counter.round_trips += 1
+            if counter._rtt:
+                await asyncio.sleep(counter._rtt)
+            return await counter._send_packed_command(
+                connection, *args, **kwargs
+            )
+
+        self._connection_class.send_packed_command = send_packed_command
+        return self
+
+    def __exit__(self, *args):
+        self._connection_class.send_packed_command = self._send_packed_command
+
+
+def billing_keys() -> dict:
+    return {
+        REDIS_KEY_API_COST.format(api_name=API_NAME): 2,
+        REDIS_KEY_USER_API_DAILY_CALL_LIMIT.format(username=USERNAME): 10**9,
+        REDIS_KEY_USER_API_DAILY_CALLS.format(
+            username=USERNAME, date=CURRENT_DATE
+        ): 10,
+        REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=USERNAME): 1,
+        REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
+            username=USERNAME
+        ): 1000,
+    }
+
+
+async def baseline(redis_conn: redis.Redis) -> None:
+    """The baseline `cost_setup`, one command per value."""
+    api_cost = int(
+        await redis_conn.get(REDIS_KEY_API_COST.format(api_name=API_NAME))
+    )
+
+    daily_call_limit = await redis_conn.get(
+        REDIS_KEY_USER_API_DAILY_CALL_LIMIT.format(username=USERNAME)
+    )
+    daily_calls = await redis_conn.get(
+        REDIS_KEY_USER_API_DAILY_CALLS.format(
+            username=USERNAME, date=CURRENT_DATE
+        )
+    )
+    assert int(daily_calls) < int(daily_call_limit)
+
+    if await redis_conn.get(
+        REDIS_KEY_METERED_SUBSCRIPTION_USERS.format(username=USERNAME)
+    ):
+        return
+
+    credits_bought = 0
+    async for key in redis_conn.scan_iter(
+        match=BASELINE_CREDIT_BOUGHT_KEY.format(username=USERNAME, id="*")
+    ):
+        purchase_value = await redis_conn.get(key)
+        if purchase_value is not None:
+            credits_bought += int(purchase_value)
+
+    subscription_credits = 0
+    if await redis_conn.get(
+        REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=USERNAME)
+    ):
+        subscription_credits = int(
+            await redis_conn.get(
+                REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
+                    username=USERNAME
+                )
+            )
+        )
+    assert api_cost <= credits_bought + subscription_credits
+
+
+async def pipelined(redis_conn: redis.Redis) -> None:
+    """The current `cost_setup`."""
+    billing_context = await get_billing_context(
+        redis_conn=redis_conn,
+        username=USERNAME,
+        api_name=API_NAME,
+        current_date=CURRENT_DATE,
+    )
+    await check_if_user_has_exceeded_daily_api_call_limit(
+        redis_conn=redis_conn,
+        username=USERNAME,
+        current_date=CURRENT_DATE,
+        billing_context=billing_context,
+    )
+    if not await check_if_user_has_metered_subscription(
+        redis_conn=redis_conn,
+        username=USERNAME,
+        billing_context=billing_context,
+    ):
+        await check_if_user_has_enough_credits(
+            redis_conn=redis_conn,
+            username=USERNAME,
+            api_cost=billing_context.api_cost,
+            billing_context=billing_context,
+        )
+
+
+async def run(name, func, redis_conn, iterations: int, rtt_ms: float) -> None:
+    await func(redis_conn)  # warm up, loads the API cost
+    latencies = []
+    with RoundTripCounter(
+        redis_conn.connection_pool.connection_class, rtt_ms
+    ) as counter:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await func(redis_conn)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    print(
+        f"{name:<11} round trips/call: {counter.round_trips / iterations:.1f}  "
+        f"p50: {statistics.median(latencies):.3f} ms  "
+        f"p99: {latencies[int(len(latencies) * 0.99) - 1]:.3f} ms"
+    )
+
+
+def install_fake_redis() -> None:
+    if importlib.util.find_spec("fakeredis") is None:
+        sys.exit(
+            'fakeredis is not installed, run `pip install "fakeredis[lua]"` or '
+            "use `--redis settings`."
+        )
+    from fakeredis import FakeServer
+    from fakeredis.aioredis import FakeAsyncRedisConnection
+
+    redis_utils.REDIS_POOL = redis_utils.MeteredBlockingConnectionPool(
+        connection_class=FakeAsyncRedisConnection,
+        server=FakeServer(),
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    if args.redis == "fake":
+        install_fake_redis()
+    redis_conn = redis.Redis(connection_pool=init_redis_pool())
+    keys = billing_keys()
+    ledger = {"1": 50, "2": 50}
+    keys.update({
+        BASELINE_CREDIT_BOUGHT_KEY.format(username=USERNAME, id=i): credits
+        for i, credits in ledger.items()
+    })
+    filler_keys = [FILLER_KEY.format(i=i) for i in range(args.filler_keys)]
+    ledger_key = REDIS_KEY_USER_CREDIT_LEDGER.format(username=USERNAME)
+    try:
+        await redis_conn.mset(keys)
+        await redis_conn.hset(ledger_key, mapping=ledger)
+        for i in range(0, len(filler_keys), 1000):
+            await redis_conn.mset(dict.fromkeys(filler_keys[i:i + 1000], 1))
+
+        await run(
+            "baseline", baseline, redis_conn, args.iterations, args.rtt_ms
+        )
+        await run(
+            "pipelined", pipelined, redis_conn, args.iterations, args.rtt_ms
+        )
+    finally:
+        await redis_conn.delete(ledger_key, *keys)
+        for i in range(0, len(filler_keys), 1000):
+            await redis_conn.delete(*filler_keys[i:i + 1000])
+        await close_redis_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument(
+        "--rtt-ms", type=float, default=0,
+        help="artificial delay added to every Redis round trip",
+    )
+    parser.add_argument("--redis", choices=("fake", "settings"), default="fake")
+    parser.add_argument(
+        "--filler-keys", type=int, default=0,
+        help="unrelated keys the baseline SCAN has to walk through",
+    )
+    asyncio.run(main(parser.parse_args()))
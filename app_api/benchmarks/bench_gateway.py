@@ -0,0 +1,541 @@
+"""
+Benchmark of the whole gateway: `core.fastapi_app.app` runs in-process with
+its lifespan, the Cloud Run containers are stubs behind an ASGI transport and
+the OpenAI download links are served by a local stub server. Only the gateway
+work is measured (auth, rate limit, call slots, billing, streaming).
+
+Run it from app_api/ (make bash cont=api):
+    python -m benchmarks.bench_gateway --requests 500 --concurrency 8
+    python -m benchmarks.bench_gateway --output baseline.json
+    python -m benchmarks.bench_gateway --compare baseline.json
+
+Redis is fakeredis by default (`pip install "fakeredis[lua]"`, the billing and
+the rate limit use Lua scripts), `--redis settings` uses the Redis from
+`core.settings` instead. On a real Redis the benchmark users are removed at the
+end and the API costs are only added when missing.
+
+`--compare` exits with 1 if the throughput or the p99 of a scenario is worse
+than the baseline by more than `--tolerance`.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import shutil
+import platform
+import resource
+import tempfile
+import importlib.util
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+# the gateway runs in local mode (no Twilio signature, no GCP clients, temp
+# files on disk), with the limits that would throttle the benchmark users lifted
+TEMP_DIR = tempfile.mkdtemp(prefix="bench_gateway_")
+os.environ.update({
+    "ENV_MODE": "local",
+    "TEMP_API_FILES_BACKEND": "local",
+    "TEMP_API_FILES_LOCAL_DIR": TEMP_DIR,
+    "JOBS_WORKERS": "0",
+    "PUBSUB_LOCAL_PUSH": "false",
+    "RESULT_CACHE_BACKEND": "",
+    # high but realistic, the rate limit script still runs its normal path
+    "RATE_LIMIT_PER_MINUTE_SUBSCRIPTION": str(10**6),
+    "USER_API_CALL_SLOTS_SUBSCRIPTION": "100",
+})
+
+import httpx
+import uvicorn
+import redis.asyncio as redis
+
+from core import settings
+from core.urls import urls
+from common import redis_utils
+from common.cloud_run import UPSTREAM_CLIENTS, _get_origin
+from core.fastapi_app import app
+from schemas.redis_db import (
+    REDIS_KEY_API_COST,
+    REDIS_KEY_LLM_COST,
+    REDIS_KEY_USER_GENERATED_TOKEN,
+    REDIS_KEY_USER_API_DAILY_CALL_LIMIT,
+    REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
+    REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
+)
+from app_ai.cloud_run_container_app_ai.v1.common.pub_sub_schema import LLMCost
+from app_ai.cloud_run_container_app_ai.v1.common.redis_schemas import (
+    REDIS_KEY_USER_PHONE_NUMBER
+)
+
+USERNAME = "bench_gateway_user_{i}"
+TOKEN = "bench_gateway_token_{i}"
+# `verify_twilio_whatsapp` returns this number in local mode
+WHATSAPP_PHONE_NUMBER = "+1234567890"
+KB = 1024
+SCENARIO_NAMES = (
+    "image_small", "pdf_merge", "openai_file_ref", "whatsapp_webhook",
+)
+
+
+# ------------ stub Cloud Run containers and file server
+
+
+async def read_body(receive) -> int:
+    size, more_body = 0, True
+    while more_body:
+        message = await receive()
+        size += len(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return size
+
+
+def stub_cloud_run_app(response_kb: int, latency_ms: float):
+    """Reads the upload and answers with a file, like the containers do."""
+    body = b"%PDF-1.4\n" + b"0" * (response_kb * KB)
+    headers = [
+        (b"content-type", b"application/pdf"),
+        (b"content-length", str(len(body)).encode()),
+        (b"content-disposition", b'attachment; filename="result.pdf"'),
+    ]
+
+    async def app_stub(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        await read_body(receive)
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    return app_stub
+
+
+def stub_file_server_app(file_kb: int):
+    """Serves the `download_link` of the openaiFileIdRefs."""
+    body = b"%PDF-1.4\n" + b"0" * (file_kb * KB)
+    headers = [
+        (b"content-type", b"application/pdf"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+
+    async def app_stub(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    return app_stub
+
+
+class FileServer:
+    """A real HTTP server on a free port, the downloads go through a socket."""
+
+    def __init__(self, file_kb: int):
+        self.server = uvicorn.Server(
+            uvicorn.Config(
+                stub_file_server_app(file_kb), host="127.0.0.1", port=0,
+                lifespan="off", log_level="warning",
+            )
+        )
+        self._task: Optional[asyncio.Task] = None
+        self.url = ""
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        self.server.should_exit = True
+        await self._task
+
+
+def install_upstream_stubs(response_kb: int, latency_ms: float) -> None:
+    """
+    Registered before the lifespan runs, `init_upstream_clients` keeps the
+    clients already in UPSTREAM_CLIENTS.
+    """
+    transport = httpx.ASGITransport(
+        app=stub_cloud_run_app(response_kb, latency_ms)
+    )
+    for cloud_run_app in settings.CLOUD_RUN_APPs.values():
+        origin = _get_origin(cloud_run_app["base_url"])
+        UPSTREAM_CLIENTS[origin] = httpx.AsyncClient(
+            transport=transport, base_url=origin
+        )
+    settings.MAX_MSGS_PER_MINUTE = settings.MAX_MSGS_PER_HOUR = 10**9
+
+
+# ------------ Redis
+
+
+def install_fake_redis() -> None:
+    if importlib.util.find_spec("fakeredis") is None:
+        sys.exit(
+            'fakeredis is not installed, run `pip install "fakeredis[lua]"` or '
+            "use `--redis settings`."
+        )
+    from fakeredis import FakeServer
+    from fakeredis.aioredis import FakeConnection
+
+    redis_utils.REDIS_POOL = redis_utils.MeteredBlockingConnectionPool(
+        connection_class=FakeConnection,
+        server=FakeServer(),
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+    )
+
+
+def get_api_names() -> list[str]:
+    return [
+        "/".join([app_name, app_version, app_endpoint])
+        for app_name, app_versions in urls.items()
+        for app_version, app_endpoints in app_versions.items()
+        for app_endpoint in app_endpoints
+    ]
+
+
+async def seed_redis(redis_conn: redis.Redis, users: int) -> list[str]:
+    """Returns the cost keys it created, the existing ones are kept."""
+    created_keys = []
+    cost_keys = [
+        REDIS_KEY_API_COST.format(api_name=api_name)
+        for api_name in get_api_names()
+    ] + [REDIS_KEY_LLM_COST.format(name=name) for name in LLMCost.model_fields]
+    for key in cost_keys:
+        if await redis_conn.set(key, 1, nx=True):
+            created_keys.append(key)
+
+    pipeline = redis_conn.pipeline(transaction=False)
+    for i in range(users):
+        username = USERNAME.format(i=i)
+        pipeline.set(REDIS_KEY_USER_GENERATED_TOKEN.format(
+            token=TOKEN.format(i=i)
+        ), username)
+        pipeline.set(
+            REDIS_KEY_USER_API_DAILY_CALL_LIMIT.format(username=username), 10**9
+        )
+        pipeline.set(
+            REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=username), 1
+        )
+        pipeline.set(
+            REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
+                username=username
+            ),
+            10**9,
+        )
+    pipeline.set(
+        REDIS_KEY_USER_PHONE_NUMBER.format(number=WHATSAPP_PHONE_NUMBER),
+        json.dumps({"username": USERNAME.format(i=0)}),
+    )
+    await pipeline.execute()
+    return created_keys
+
+
+async def cleanup_redis(redis_conn: redis.Redis, created_keys: list[str]):
+    keys = list(created_keys)
+    for pattern in (
+            f"*{USERNAME.format(i='')}*",
+            f"*{TOKEN.format(i='')}*",
+            f"*{WHATSAPP_PHONE_NUMBER}*",
+    ):
+        keys.extend([key async for key in redis_conn.scan_iter(match=pattern)])
+    if keys:
+        await redis_conn.delete(*keys)
+
+
+# ------------ scenarios
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    # (client, user index) -> response
+    send: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+    expected_status: int = 200
+
+
+@dataclass
+class ScenarioResult:
+    requests: int = 0
+    errors: int = 0
+    seconds: float = 0
+    latencies_ms: list = field(default_factory=list)
+    status_codes: dict = field(default_factory=dict)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies_ms:
+            return None
+        latencies = sorted(self.latencies_ms)
+        return round(latencies[max(int(len(latencies) * p) - 1, 0)], 3)
+
+    def summary(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "status_codes": self.status_codes,
+            "throughput_rps": round(self.requests / self.seconds, 2),
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "rss_mb": get_rss_mb(),
+            "peak_rss_mb": get_peak_rss_mb(),
+        }
+
+
+def auth_headers(user: int) -> dict:
+    return {"Authorization": f"Bearer {TOKEN.format(i=user)}"}
+
+
+def build_scenarios(args, file_server_url: str) -> dict[str, Scenario]:
+    image = b"\x89PNG\r\n\x1a\n" + b"0" * (args.image_kb * KB)
+    pdf = b"%PDF-1.4\n" + b"0" * (args.pdf_kb * KB)
+    merge_pdfs = urls["app_pdf"]["v1"]["view_pdf_merge_pdfs"].api_url
+    rotate_pdf = urls["app_pdf"]["v1"]["view_pdf_rotate"].api_url
+
+    async def image_small(client, user):
+        return await client.post(
+            urls["app_images"]["v1"]["view_image_convert_to_gray"].api_url,
+            files={"file": ("image.png", image, "image/png")},
+            headers=auth_headers(user),
+        )
+
+    async def pdf_merge(client, user):
+        return await client.post(
+            merge_pdfs,
+            files=[
+                ("files", (f"document_{i}.pdf", pdf, "application/pdf"))
+                for i in range(args.merge_files)
+            ],
+            headers=auth_headers(user),
+        )
+
+    async def openai_file_ref(client, user):
+        return await client.post(
+            f"{rotate_pdf}{settings.ENDS_WITH_OPENAI}",
+            params={"pages_to_rotate_right": "1"},
+            json={"openaiFileIdRefs": [{
+                "name": "document.pdf",
+                "id": "file-benchmark",
+                "mime_type": "application/pdf",
+                "download_link": f"{file_server_url}/document.pdf",
+            }]},
+            headers=auth_headers(user),
+        )
+
+    async def whatsapp_webhook(client, user):
+        return await client.post(
+            urls["app_ai"]["v1"]["twilio_whatsapp_webhook"].api_url,
+            data={"From": f"whatsapp:{WHATSAPP_PHONE_NUMBER}", "Body": "hi"},
+        )
+
+    return {
+        scenario.name: scenario for scenario in (
+            Scenario(
+                "image_small", f"{args.image_kb} KiB image to gray",
+                image_small,
+            ),
+            Scenario(
+                "pdf_merge", f"merge {args.merge_files} x {args.pdf_kb} KiB PDFs",
+                pdf_merge,
+            ),
+            Scenario(
+                "openai_file_ref", f"rotate a {args.pdf_kb} KiB PDF file ref",
+                openai_file_ref,
+            ),
+            Scenario(
+                "whatsapp_webhook", "Twilio WhatsApp message",
+                whatsapp_webhook, expected_status=204,
+            ),
+        )
+    }
+
+
+def get_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / KB**2, 1)
+    except (OSError, ValueError):
+        return get_peak_rss_mb()
+
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (KB**2 if platform.system() == "Darwin" else KB), 1)
+
+
+async def run_scenario(
+        client: httpx.AsyncClient,
+        scenario: Scenario,
+        requests: int,
+        concurrency: int,
+        warmup: int,
+) -> ScenarioResult:
+    """Each concurrent client is its own user, so the call slots never wait."""
+    for _ in range(warmup):
+        await scenario.send(client, 0)
+
+    result = ScenarioResult()
+    pending = iter(range(requests))
+
+    async def worker(user: int) -> None:
+        for _ in pending:
+            start = time.perf_counter()
+            try:
+                resp = await scenario.send(client, user)
+                status_code = resp.status_code
+            except Exception:
+                status_code = "exception"
+            result.latencies_ms.append((time.perf_counter() - start) * 1000)
+            result.requests += 1
+            result.status_codes[str(status_code)] = (
+                result.status_codes.get(str(status_code), 0) + 1
+            )
+            if status_code != scenario.expected_status:
+                result.errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(user) for user in range(concurrency)))
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def print_results(results: dict, baseline: Optional[dict]) -> None:
+    print(
+        f"{'scenario':<18} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} "
+        f"{'rss MB':>8} {'errors':>7}"
+    )
+    for name, result in results.items():
+        line = (
+            f"{name:<18} {result['throughput_rps']:>9,.1f} "
+            f"{result['p50_ms']:>9,.2f} {result['p99_ms']:>9,.2f} "
+            f"{result['rss_mb']:>8,.1f} {result['errors']:>7}"
+        )
+        previous = (baseline or {}).get("scenarios", {}).get(name)
+        if previous:
+            line += (
+                f"   vs baseline: req/s "
+                f"{change(previous['throughput_rps'], result['throughput_rps'])}"
+                f", p99 {change(previous['p99_ms'], result['p99_ms'])}"
+            )
+        print(line)
+
+
+def change(before: float, after: float) -> str:
+    return f"{(after - before) / before:+.1%}" if before else "n/a"
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        min_throughput = previous["throughput_rps"] * (1 - tolerance)
+        if result["throughput_rps"] < min_throughput:
+            regressions.append(f"{name}: throughput")
+        if result["p99_ms"] > previous["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 latency")
+    return regressions
+
+
+async def main(args) -> int:
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    if args.redis == "fake":
+        install_fake_redis()
+    install_upstream_stubs(args.response_kb, args.upstream_latency_ms)
+    file_server = FileServer(args.pdf_kb)
+    await file_server.start()
+    redis_conn = redis.Redis(connection_pool=redis_utils.init_redis_pool())
+    created_keys = await seed_redis(redis_conn, users=args.concurrency)
+
+    scenarios = build_scenarios(args, file_server.url)
+    selected = args.scenarios.split(",") if args.scenarios else SCENARIO_NAMES
+    results = {}
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app),
+                base_url="http://gateway",
+                timeout=None,
+            ) as client:
+                for name in selected:
+                    print(f"{name}: {scenarios[name].description}")
+                    results[name] = (await run_scenario(
+                        client=client,
+                        scenario=scenarios[name],
+                        requests=args.requests,
+                        concurrency=args.concurrency,
+                        warmup=args.warmup,
+                    )).summary()
+    finally:
+        await file_server.stop()
+        # the result files of the OpenAI views
+        shutil.rmtree(TEMP_DIR, ignore_errors=True)
+        if args.redis == "settings":
+            # the lifespan closed the pool, use a new one to clean up
+            redis_conn = redis.Redis(
+                connection_pool=redis_utils.init_redis_pool()
+            )
+            await cleanup_redis(redis_conn, created_keys)
+            await redis_utils.close_redis_pool()
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "config": {
+                    key: value for key, value in vars(args).items()
+                    if key not in {"output", "compare"}
+                },
+                "scenarios": results,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if baseline:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print(f"Regressions over {args.tolerance:.0%}: {regressions}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=500,
+                        help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--scenarios",
+                        help="comma separated, all of them by default")
+    parser.add_argument("--redis", choices=("fake", "settings"),
+                        default="fake")
+    parser.add_argument("--upstream-latency-ms", type=float, default=0,
+                        help="time the stub containers take to answer")
+    parser.add_argument("--response-kb", type=int, default=64,
+                        help="size of the files returned by the stubs")
+    parser.add_argument("--image-kb", type=int, default=32)
+    parser.add_argument("--pdf-kb", type=int, default=256)
+    parser.add_argument("--merge-files", type=int, default=20)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    if args.scenarios and set(args.scenarios.split(",")) - set(SCENARIO_NAMES):
+        parser.error(f"--scenarios must be in {', '.join(SCENARIO_NAMES)}")
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,83 @@
+"""
+Micro-benchmark for the request metrics: the cost of a `@timed_phase` call and
+of `RequestMetricsMiddleware` around an ASGI app that answers right away.
+
+Run it from app_api/ (make bash cont=api):
+    python -m benchmarks.bench_request_metrics --iterations 100000
+"""
+import time
+import asyncio
+import argparse
+
+from common.phase_timer import REQUEST_TIMINGS, RequestTimings, timed_phase
+from common.metrics import RequestMetricsMiddleware, render_metrics
+
+ENDPOINT = "/benchmark/v1/request_metrics"
+SCOPE = {"type": "http", "method": "POST", "path": ENDPOINT, "headers": []}
+BODY = b"x" * 1024
+
+
+async def phase() -> None:
+    return None
+
+
+timed = timed_phase("benchmark")(phase)
+
+
+async def app(scope, receive, send) -> None:
+    await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": BODY})
+
+
+async def receive() -> dict:
+    return {"type": "http.request", "body": BODY, "more_body": False}
+
+
+async def send(message: dict) -> None:
+    return None
+
+
+async def per_call_ns(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await func()
+    return (time.perf_counter() - start) / iterations * 10**9
+
+
+async def main(iterations: int) -> None:
+    results = {
+        "phase, plain": await per_call_ns(phase, iterations),
+        "phase, timed outside a request": await per_call_ns(timed, iterations),
+    }
+    token = REQUEST_TIMINGS.set(RequestTimings())
+    try:
+        results["phase, timed in a request"] = await per_call_ns(
+            timed, iterations
+        )
+    finally:
+        REQUEST_TIMINGS.reset(token)
+
+    middleware = RequestMetricsMiddleware(
+        app, is_known_endpoint=lambda path: path == ENDPOINT
+    )
+    results["request, plain"] = await per_call_ns(
+        lambda: app(SCOPE, receive, send), iterations
+    )
+    results["request, with metrics"] = await per_call_ns(
+        lambda: middleware(SCOPE, receive, send), iterations
+    )
+
+    for name, ns in results.items():
+        print(f"{name:<32} {ns:,.0f} ns/call")
+
+    start = time.perf_counter()
+    render_metrics()
+    print(f"{'render /metrics':<32} {(time.perf_counter() - start) * 1000:,.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+    asyncio.run(main(iterations=args.iterations))
@@ -0,0 +1,312 @@
+"""
+Batch calls: many files sent to one API with a single auth, credit check and
+API call slot. The endpoints opt in with `other["batch"] = True`, their batch
+URL is BATCH_URL_PREFIX + `api_url` (ex: "/batch/pdf/v1/rotate").
+
+Each file is sent to the Cloud Run target as the `file` field with the query
+params of the batch request, BATCH_CONCURRENCY at a time. The results are
+streamed back as they finish, as a ZIP (the result files and a
+`manifest.ndjson`) or as NDJSON with a temp bucket link per result. The credits
+of all the items are reserved up front, the ones of the failed items are given
+back at the end.
+"""
+import io
+import json
+import uuid
+import asyncio
+import logging
+import zipfile
+from http import HTTPStatus
+from typing import AsyncIterator, Optional, Union
+
+import redis.asyncio as redis
+from fastapi import HTTPException
+from starlette.datastructures import UploadFile
+
+from core import settings
+from core.settings import GENERIC_ERROR_MSG
+from schemas.urls import CloudRunAPIEndpoint
+from common.other import get_filename_from_cd
+from common.cloud_run import async_request, read_response_body
+from common.file_validation import FileSizeLimitExceeded, UploadSizeBudget
+from common.cost_management import cost_teardown_batch
+from common.redis_utils import (
+	release_user_api_call_lock, refund_user_credits, get_reserved_credits,
+)
+from common.temp_bucket import upload_to_temp_bucket, get_temp_bucket_signed_url
+from common.openai.fastapi_transaltion import (
+	download_file_from_request, sanitize_filename,
+)
+
+
+logger = logging.getLogger("APP_API_"+__name__)
+
+BATCH_URL_PREFIX = "/batch"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+ZIP_MEDIA_TYPE = "application/zip"
+
+# {api_url: (api_name, url data)}, built on first use from `core.urls`
+_BATCH_ENDPOINTS: Optional[dict[str, tuple[str, CloudRunAPIEndpoint]]] = None
+# the batches keep running if the client goes away, they still have to be billed
+BATCH_TASKS: set[asyncio.Task] = set()
+
+
+def get_batch_endpoint(
+		api_url: str
+) -> Optional[tuple[str, CloudRunAPIEndpoint]]:
+	global _BATCH_ENDPOINTS
+	if _BATCH_ENDPOINTS is None:
+		from core.urls import urls
+
+		_BATCH_ENDPOINTS = {
+			data.api_url: ("/".join([app_name, app_version, app_endpoint]), data)
+			for app_name, app_versions in urls.items()
+			for app_version, app_endpoints in app_versions.items()
+			for app_endpoint, data in app_endpoints.items()
+			if data.is_active and (data.other or {}).get("batch")
+		}
+	return _BATCH_ENDPOINTS.get(api_url)
+
+
+def _get_error_detail(content: bytes) -> str:
+	try:
+		detail = json.loads(content)
+	except ValueError:
+		return GENERIC_ERROR_MSG
+	if isinstance(detail, dict) and isinstance(detail.get("detail"), str):
+		return detail["detail"]
+	return json.dumps(detail)
+
+
+async def _run_item(
+		index: int,
+		file: Union[UploadFile, dict],
+		url_data: CloudRunAPIEndpoint,
+		params: dict,
+		batch_id: str,
+		upload_results: bool,
+		username: str,
+		api_name: str,
+) -> tuple[dict, bool]:
+	"""
+	file: an upload file or an openaiFileIdRefs entry
+	Returns the item and if it is billable, the items rejected before calling
+	the API are not.
+	"""
+	item = {"index": index, "filename": None}
+	billable = False
+	try:
+		if isinstance(file, dict):
+			file = await download_file_from_request(
+				file_ref=file,
+				budget=UploadSizeBudget.for_endpoint(url_data.other),
+			)
+		item["filename"] = file.filename
+
+		media_types = (url_data.other or {}).get("media_type")
+		if media_types and file.content_type not in media_types:
+			raise HTTPException(
+				status_code=HTTPStatus.BAD_REQUEST.value,
+				detail="Invalid file type.",
+			)
+
+		billable = True
+		resp = await async_request(
+			url=url_data.url_target, method="POST", file=file, params=params,
+		)
+		content = await read_response_body(resp)
+		item["status_code"] = resp.status_code
+
+		if resp.status_code == HTTPStatus.OK.value:
+			item["result_filename"] = sanitize_filename(
+				get_filename_from_cd(resp.headers) or file.filename or "result"
+			)
+			if upload_results:
+				blob_name = f"batch/{batch_id}/{index}/{item['result_filename']}"
+				await upload_to_temp_bucket(
+					content=content,
+					blob_name=blob_name,
+					content_type=resp.headers.get("content-type"),
+				)
+				item["result_url"] = await get_temp_bucket_signed_url(blob_name)
+			else:
+				item["content"] = content
+		elif resp.status_code == HTTPStatus.BAD_REQUEST.value:
+			item["error"] = _get_error_detail(content)
+		else:
+			item["error"] = GENERIC_ERROR_MSG
+
+	except FileSizeLimitExceeded as error:
+		item["status_code"] = HTTPStatus.REQUEST_ENTITY_TOO_LARGE.value
+		item["error"] = str(error)
+	except HTTPException as error:
+		item["status_code"] = error.status_code
+		item["error"] = (
+			error.detail if error.status_code < 500 else GENERIC_ERROR_MSG
+		)
+	except Exception as error:
+		logger.error(
+			f"User {username} encounter an error when calling API: {api_name} "
+			f"in batch {batch_id}, item {index}. Response: {error}."
+		)
+		item["status_code"] = HTTPStatus.INTERNAL_SERVER_ERROR.value
+		item["error"] = GENERIC_ERROR_MSG
+
+	if item["status_code"] >= 500:
+		logger.error(
+			f"User {username} encounter an error when calling API: {api_name} "
+			f"in batch {batch_id}, item {index}. Status code "
+			f"{item['status_code']}."
+		)
+	return item, billable
+
+
+async def run_batch(
+		redis_conn: redis.Redis,
+		results: asyncio.Queue,
+		files: list[Union[UploadFile, dict]],
+		params: dict,
+		upload_results: bool,
+		username: str,
+		api_name: str,
+		url_data: CloudRunAPIEndpoint,
+		api_cost: int,
+		is_metered: bool,
+		current_date: str,
+		timestamp: int,
+		reservation: Optional[list[str]] = None,
+) -> None:
+	"""
+	Puts the items on `results` as they finish and `None` once the batch was
+	billed. The API call slot taken by the request is released at the end.
+	reservation: the credits reserved for all the files, see
+	`reserve_user_credits`, given back in full if the batch is not billed.
+	"""
+	batch_id = uuid.uuid4().hex
+	semaphore = asyncio.Semaphore(settings.BATCH_CONCURRENCY)
+
+	async def run_item(
+			index: int, file: Union[UploadFile, dict]
+	) -> tuple[int, bool]:
+		async with semaphore:
+			item, billable = await _run_item(
+				index=index,
+				file=file,
+				url_data=url_data,
+				params=params,
+				batch_id=batch_id,
+				upload_results=upload_results,
+				username=username,
+				api_name=api_name,
+			)
+		await results.put(item)
+		return item["status_code"], billable
+
+	billed = False
+	try:
+		status_codes, billable = zip(*await asyncio.gather(
+			*[run_item(index, file) for index, file in enumerate(files)]
+		))
+		charged = await cost_teardown_batch(
+			redis_conn=redis_conn,
+			status_codes=list(status_codes),
+			billable=list(billable),
+			username=username,
+			api_name=api_name,
+			api_cost=api_cost,
+			current_date=current_date,
+			timestamp=timestamp,
+			is_metered=is_metered,
+			reservation=reservation,
+		)
+		billed = True
+		logger.info(
+			f"User {username} batch {batch_id} ({api_name}): {len(files)} "
+			f"files, {charged} credits."
+		)
+	except Exception as error:
+		logger.error(
+			f"User {username} encounter an error when billing batch {batch_id} "
+			f"({api_name}). Response: {error}.", exc_info=True
+		)
+	finally:
+		if not billed and reservation:
+			try:
+				await refund_user_credits(
+					redis_conn=redis_conn,
+					username=username,
+					credits=get_reserved_credits(reservation),
+					reservation=reservation,
+				)
+			except Exception as error:
+				logger.error(
+					f"Could not refund batch {batch_id} to user {username}. "
+					f"Response: {error}."
+				)
+		await release_user_api_call_lock(
+			redis_conn=redis_conn, username=username, api_name=api_name
+		)
+		await results.put(None)
+
+
+def start_batch(**kwargs) -> asyncio.Queue:
+	"""Runs `run_batch` in its own task, returns the queue of the results."""
+	results = asyncio.Queue()
+	task = asyncio.create_task(run_batch(results=results, **kwargs))
+	BATCH_TASKS.add(task)
+	task.add_done_callback(BATCH_TASKS.discard)
+	return results
+
+
+def _get_manifest_entry(item: dict) -> dict:
+	return {
+		k: v for k, v in item.items() if k != "content" and v is not None
+	}
+
+
+async def stream_ndjson(results: asyncio.Queue) -> AsyncIterator[bytes]:
+	while (item := await results.get()) is not None:
+		yield (json.dumps(_get_manifest_entry(item)) + "\n").encode()
+
+
+class _ZipStream(io.RawIOBase):
+	"""Write only buffer, `zipfile` supports streams that can't seek."""
+
+	def __init__(self):
+		self._chunks: list[bytes] = []
+
+	def writable(self) -> bool:
+		return True
+
+	def write(self, data) -> int:
+		self._chunks.append(bytes(data))
+		return len(data)
+
+	def take(self) -> bytes:
+		data, self._chunks = b"".join(self._chunks), []
+		return data
+
+
+async def stream_zip(results: asyncio.Queue) -> AsyncIterator[bytes]:
+	"""
+	The result files are stored as `{index}_{filename}` (they are already
+	compressed formats), `manifest.ndjson` lists all the items at the end.
+	"""
+	stream = _ZipStream()
+	manifest = []
+	with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_STORED) as zf:
+		while (item := await results.get()) is not None:
+			if item.get("content") is not None:
+				item["file"] = f"{item['index']:04d}_{item['result_filename']}"
+				zf.writestr(item["file"], item.pop("content"))
+			manifest.append(_get_manifest_entry(item))
+			yield stream.take()
+
+		zf.writestr(
+			"manifest.ndjson",
+			"".join(
+				json.dumps(entry) + "\n"
+				for entry in sorted(manifest, key=lambda entry: entry["index"])
+			),
+		)
+	yield stream.take()
@@ -1,18 +1,292 @@
+import time
+import asyncio
 import logging
-from typing import List, Literal
+import importlib.util
+from http import HTTPStatus
+from typing import AsyncIterator, List, Literal
+from urllib.parse import urlsplit
 
-from httpx import AsyncClient
+from httpx import (
+	AsyncClient, Limits, Timeout, Request as HttpxRequest,
+	Response as HttpxResponse, ConnectError, ConnectTimeout, ReadError,
+	RemoteProtocolError, WriteError,
+)
 from fastapi import UploadFile, HTTPException, Response
-from cryptography.fernet import Fernet
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
-from core.settings import (
-	CRYPT_SECRET_KEY_G_CLOUD_RUN, EXPECTED_TOKEN_CLOUD_RUN,
+from core import settings
+from common.phase_timer import timed_phase, record_upstream_status
+from common.file_validation import (
+	FileSizeLimitExceeded, SizeLimitedReader, UploadSizeBudget,
+)
+from common.upstream_health import (
+	UpstreamHealth, FAILURE_STATUS_CODES, get_upstream_health,
 )
+from common.result_cache import (
+	get_result_cache_key, get_cached_result, set_cached_result,
+)
+from access_management.service_token import get_service_auth_headers
 
 
 logger = logging.getLogger(__name__)
 
+# HTTP/2 needs the optional `h2` package (`httpx[http2]`), without it httpx
+# can only speak HTTP/1.1 so we keep the keep-alive pool but skip HTTP/2.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# {"https://app-pdf-v1-xyz.a.run.app": AsyncClient}
+UPSTREAM_CLIENTS: dict[str, AsyncClient] = {}
+
+# {url_target: CloudRunAPIEndpoint.other}, built on first use from `core.urls`
+_TARGET_OTHER: dict[str, dict] | None = None
+
+
+def _get_origin(url: str) -> str:
+	parts = urlsplit(url)
+	return f"{parts.scheme}://{parts.netloc}"
+
+
+def _build_upstream_client(origin: str) -> AsyncClient:
+	return AsyncClient(
+		base_url=origin,
+		http2=settings.CLOUD_RUN_HTTP2 and HTTP2_AVAILABLE,
+		limits=Limits(
+			max_connections=settings.CLOUD_RUN_MAX_CONNECTIONS,
+			max_keepalive_connections=(
+				settings.CLOUD_RUN_MAX_KEEPALIVE_CONNECTIONS
+			),
+			keepalive_expiry=settings.CLOUD_RUN_KEEPALIVE_EXPIRY,
+		),
+		timeout=Timeout(
+			settings.CLOUD_RUN_DEFAULT_TIMEOUT,
+			connect=settings.CLOUD_RUN_CONNECT_TIMEOUT,
+		),
+	)
+
+
+def init_upstream_clients() -> None:
+	"""Called from the FastAPI lifespan, one client per Cloud Run app."""
+	if settings.CLOUD_RUN_HTTP2 and not HTTP2_AVAILABLE:
+		logger.warning(
+			"CLOUD_RUN_HTTP2 is enabled but `h2` is not installed, "
+			"falling back to HTTP/1.1 keep-alive connections."
+		)
+
+	for cloud_run_app in settings.CLOUD_RUN_APPs.values():
+		origin = _get_origin(cloud_run_app["base_url"])
+		if origin not in UPSTREAM_CLIENTS:
+			UPSTREAM_CLIENTS[origin] = _build_upstream_client(origin)
+
+
+async def close_upstream_clients() -> None:
+	for client in UPSTREAM_CLIENTS.values():
+		await client.aclose()
+	UPSTREAM_CLIENTS.clear()
+
+
+def get_upstream_client(url: str) -> AsyncClient:
+	origin = _get_origin(url)
+	client = UPSTREAM_CLIENTS.get(origin)
+	if client is None or client.is_closed:
+		client = UPSTREAM_CLIENTS[origin] = _build_upstream_client(origin)
+	return client
+
+
+def get_target_other(url: str) -> dict:
+	global _TARGET_OTHER
+	if _TARGET_OTHER is None:
+		from core.urls import urls
+
+		_TARGET_OTHER = {
+			data.url_target: data.other
+			for app_versions in urls.values()
+			for app_endpoints in app_versions.values()
+			for data in app_endpoints.values()
+			if getattr(data, "url_target", None) and data.other
+		}
+	return _TARGET_OTHER.get(url, {})
+
+
+def get_target_timeout(url: str) -> float:
+	return get_target_other(url).get(
+		"timeout", settings.CLOUD_RUN_DEFAULT_TIMEOUT
+	)
+
+
+def is_target_idempotent(url: str) -> bool:
+	"""The cached endpoints are deterministic, so they can be retried too."""
+	other = get_target_other(url)
+	return bool(other.get("idempotent") or other.get("cache"))
+
+
+def get_target_upload_size_budget(url: str) -> UploadSizeBudget:
+	"""
+	Upload size allowed for the target, taken from the same `other` keys the
+	views validate against, see `UploadSizeBudget.for_endpoint`.
+	"""
+	return UploadSizeBudget.for_endpoint(get_target_other(url))
+
+
+async def _get_request_cache_key(
+		url: str,
+		file: UploadFile | None,
+		files: List[UploadFile] | None,
+		override_files: List[tuple] | None,
+		json: dict | None,
+		data: dict | None,
+		params: dict | None,
+) -> str:
+	if override_files:
+		cache_files = [
+			(name, filename, rest[0] if rest else None, content)
+			for name, (filename, content, *rest) in override_files
+		]
+	elif file:
+		cache_files = [("file", file.filename, file.content_type, file.file)]
+	else:
+		cache_files = [
+			("files", file.filename, file.content_type, file.file)
+			for file in files or []
+			if isinstance(file, StarletteUploadFile)
+		]
+	return await get_result_cache_key(
+		url=url, files=cache_files, params=params, data=data, json_body=json,
+	)
+
+
+def _is_replayable(files_payload) -> bool:
+	"""
+	Streamed upload files can't be sent twice at the same time, only the
+	payloads without them can be hedged.
+	"""
+	if not files_payload:
+		return True
+	if isinstance(files_payload, dict):
+		files_payload = files_payload.items()
+	return all(
+		isinstance(content, (bytes, str))
+		for _, (_, content, *_) in files_payload
+	)
+
+
+def _is_retryable_error(error: Exception, idempotent: bool) -> bool:
+	"""The connection errors happen before the target got the request."""
+	if isinstance(error, (ConnectError, ConnectTimeout)):
+		return True
+	return idempotent and isinstance(
+		error, (ReadError, WriteError, RemoteProtocolError)
+	)
+
+
+def _discard_upstream_response(task: asyncio.Task) -> None:
+	if not task.cancelled() and task.exception() is None:
+		asyncio.ensure_future(task.result().aclose())
+
+
+async def _send_hedged(
+		client: AsyncClient, build_request, health: UpstreamHealth
+) -> HttpxResponse:
+	"""
+	If the target did not answer after its p95 latency (ex: a cold start), a
+	second request is sent and the first response wins.
+	"""
+	first = asyncio.ensure_future(client.send(build_request(), stream=True))
+	done, _ = await asyncio.wait({first}, timeout=health.get_hedge_delay())
+	if done or not health.take_retry_token():
+		return await first
+
+	health.hedges += 1
+	second = asyncio.ensure_future(client.send(build_request(), stream=True))
+	pending, winner, error = {first, second}, None, None
+	try:
+		while pending and winner is None:
+			done, pending = await asyncio.wait(
+				pending, return_when=asyncio.FIRST_COMPLETED
+			)
+			for task in done:
+				if task.exception() is not None:
+					error = task.exception()
+				elif winner is None:
+					winner = task
+				else:
+					await task.result().aclose()
+	finally:
+		for task in pending:
+			task.cancel()
+			task.add_done_callback(_discard_upstream_response)
+
+	if winner is None:
+		raise error
+	if winner is second:
+		health.hedge_wins += 1
+	return winner.result()
+
+
+@timed_phase("upstream")
+async def _send_upstream_request(
+		client: AsyncClient,
+		build_request,
+		health: UpstreamHealth,
+		idempotent: bool,
+		hedge: bool,
+) -> HttpxResponse:
+	"""
+	Sends the request, retrying with backoff while the retry budget of the
+	target allows it: the connection errors for all the targets, the dropped
+	connections and the 429/502/503/504 responses for the idempotent ones.
+	"""
+	attempt = 0
+	try:
+		while True:
+			start = time.monotonic()
+			try:
+				if hedge:
+					resp = await _send_hedged(client, build_request, health)
+				else:
+					resp = await client.send(build_request(), stream=True)
+			except FileSizeLimitExceeded:
+				raise
+			except Exception as e:
+				health.record_failure()
+				if (
+						attempt >= settings.CLOUD_RUN_RETRY_ATTEMPTS or
+						not _is_retryable_error(e, idempotent) or
+						not health.take_retry_token()
+				):
+					raise
+				logger.warning(f"Retrying {health.target}, error: {e!r}")
+			else:
+				if resp.status_code not in FAILURE_STATUS_CODES:
+					health.record_success(time.monotonic() - start)
+					return resp
+
+				health.record_failure()
+				if (
+						attempt >= settings.CLOUD_RUN_RETRY_ATTEMPTS or
+						not idempotent or
+						not health.take_retry_token()
+				):
+					return resp
+				logger.warning(
+					f"Retrying {health.target}, status code {resp.status_code}"
+				)
+				await resp.aclose()
+
+			attempt += 1
+			health.retries += 1
+			await asyncio.sleep(health.get_retry_delay(attempt))
+	finally:
+		health.end_call()
+
+
+def _stream_file(fileobj, budget: UploadSizeBudget):
+	"""Bytes are sent as they are, file objects are streamed in chunks."""
+	if isinstance(fileobj, (bytes, str)):
+		return fileobj
+	return SizeLimitedReader(fileobj, budget)
+
 
 async def async_request(
 		url: str,
@@ -24,14 +298,37 @@ async def async_request(
 		data: dict | None = None,  # form data
 		headers: dict | None = None,
 		params: dict | None = None,  # query string params
-		timeout: int = 60,
+		timeout: int | None = None,
+		max_size_mb: float | None = None,
 ) -> Response:
 	"""
 	Very important, this function should always return the FastAPI Response that
 	we want to pass on to the user. We only allow one file type to be returned:
 	- FastAPI Response
 
+	Successful (200) upstream responses are returned as a `StreamingResponse`
+	that relays the upstream body as it arrives, use `read_response_body` when
+	the content is needed in the gateway. Other status codes are buffered.
+
 	The override attributes are used to pass the payload directly to the function.
+
+	The request goes through the pooled keep-alive client of the target, if no
+	`timeout` is given we use the endpoint's `other["timeout"]` or the default.
+
+	Upload files are streamed to the target as a multipart body read in chunks
+	from their spooled files, we never hold their whole content in memory. The
+	upload size is enforced while streaming, using `max_size_mb` (total) or the
+	size limits from the endpoint's `other`, a 413 is raised if exceeded.
+
+	Calls to a target that is down fail fast with a 503, the connection errors
+	are retried and, for the idempotent endpoints (`other["idempotent"]` or
+	`other["cache"]`), also the 429/502/503/504 responses. The endpoints with
+	`other["hedge"]` and no streamed files send a second request if the first is
+	slow, see `common.upstream_health`.
+
+	For the endpoints with `other["cache"]` the 200 responses are kept in the
+	result cache (`common.result_cache`), the same input is then answered from
+	it with a `x-cache: HIT` header without calling the target.
 	"""
 	files_payload = None
 	if not url or not method:
@@ -43,55 +340,105 @@ async def async_request(
 		logger.error(err_msg)
 		raise HTTPException(status_code=400, detail=err_msg)
 
+	budget = (
+		UploadSizeBudget(max_size_mb) if max_size_mb
+		else get_target_upload_size_budget(url)
+	)
+
 	if override_files:
-		files_payload = override_files
+		files_payload = [
+			(name, (filename, _stream_file(content, budget), *rest))
+			for name, (filename, content, *rest) in override_files
+		]
 	elif file:
-		files_payload = {"file": (file.filename, await file.read(), file.content_type)}
+		files_payload = {
+			"file": (
+				file.filename, _stream_file(file.file, budget), file.content_type
+			)
+		}
 	elif files:
 		files_payload = [
-			("files", (file.filename, await file.read(), file.content_type))
+			(
+				"files",
+				(file.filename, _stream_file(file.file, budget), file.content_type)
+			)
 			for file in files
 			if isinstance(file, StarletteUploadFile)
 			]
 
 	if not headers:
 		try:
-			token = Fernet(CRYPT_SECRET_KEY_G_CLOUD_RUN).encrypt(
-							EXPECTED_TOKEN_CLOUD_RUN.encode()
-						).decode()
-			headers = {"Authorization": f"Bearer {token}"}
+			headers = get_service_auth_headers()
 		except Exception as e:
 			logger.error(f"Error while encrypting token: {e}")
 			raise HTTPException(
 				status_code=500, detail="Internal server error"
 			)
 
+	timeout = Timeout(
+		timeout or get_target_timeout(url),
+		connect=settings.CLOUD_RUN_CONNECT_TIMEOUT,
+	)
+	client = get_upstream_client(url)
+
+	if method.upper() not in {"POST", "GET"}:
+		raise HTTPException(status_code=400, detail="Method not supported.")
+
+	cache_key = None
+	if method.upper() == "POST" and get_target_other(url).get("cache"):
+		cache_key = await _get_request_cache_key(
+			url=url, file=file, files=files, override_files=override_files,
+			json=json, data=data, params=params,
+		)
+		cached = await get_cached_result(cache_key)
+		if cached is not None:
+			content, cached_headers = cached
+			return Response(
+				content=content,
+				status_code=HTTPStatus.OK.value,
+				headers={**cached_headers, "x-cache": "HIT"},
+				media_type=cached_headers.get("content-type"),
+			)
+
+	health = get_upstream_health(_get_origin(url))
+	if not health.allow_request():
+		logger.warning(f"Circuit open for {health.target}, failing fast.")
+		raise HTTPException(
+			status_code=HTTPStatus.SERVICE_UNAVAILABLE.value,
+			detail="Service temporarily unavailable, please try again later.",
+			headers={"Retry-After": str(health.retry_after())},
+		)
+
+	def build_request() -> HttpxRequest:
+		return client.build_request(
+			method.upper(), url,
+			files=files_payload if method.upper() == "POST" else None,
+			data=data if method.upper() == "POST" else None,
+			json=json if method.upper() == "POST" else None,
+			params=params, headers=headers, timeout=timeout,
+		)
+
 	try:
-		async with AsyncClient() as client:
-			if method.upper() == "POST":
-				resp = await client.post(
-					url,
-					files=files_payload, data=data, json=json, params=params,
-					headers=headers,
-					timeout=timeout
-				)
-			elif method.upper() == "GET":
-				resp = await client.get(
-					url, params=params, headers=headers, timeout=timeout
-				)
-			else:
-				raise HTTPException(
-					status_code=400, detail="Method not supported."
-				)
+		resp = await _send_upstream_request(
+			client=client,
+			build_request=build_request,
+			health=health,
+			idempotent=is_target_idempotent(url),
+			hedge=(
+				bool(get_target_other(url).get("hedge")) and
+				_is_replayable(files_payload)
+			),
+		)
+	except FileSizeLimitExceeded as e:
+		raise HTTPException(status_code=413, detail=str(e))
 	except Exception as e:
 		logger.error(f"Error while making request to {url}: {e}", exc_info=True)
 		raise HTTPException(
 			status_code=500, detail="Internal server error"
 		)
 
-	# Extract content, status code, and headers from the response
-	content = resp.content
 	status_code = resp.status_code
+	record_upstream_status(status_code)
 	media_type = resp.headers.get('content-type')
 	response_headers = dict(resp.headers)
 
@@ -103,6 +450,36 @@ async def async_request(
 	for header in hop_by_hop_headers:
 		response_headers.pop(header, None)
 
+	if status_code == HTTPStatus.OK.value:
+		# the raw (still encoded) bytes are forwarded as they arrive, so the
+		# upstream content-length/content-encoding headers stay valid
+		body = (
+			_iter_upstream_body(resp) if cache_key is None
+			else _iter_and_cache_upstream_body(resp, cache_key, response_headers)
+		)
+		return StreamingResponse(
+			content=body,
+			status_code=status_code,
+			headers=response_headers,
+			media_type=media_type,
+			background=BackgroundTask(resp.aclose),
+		)
+
+	# error responses are small and `cost_teardown` needs to read them
+	try:
+		content = await resp.aread()
+	except Exception as e:
+		logger.error(f"Error while reading response from {url}: {e}")
+		raise HTTPException(
+			status_code=500, detail="Internal server error"
+		)
+	finally:
+		await resp.aclose()
+
+	# decoded content, the original encoding no longer applies
+	response_headers.pop("content-encoding", None)
+	response_headers.pop("content-length", None)
+
 	# Return a FastAPI Response with the extracted information
 	return Response(
 		content=content,
@@ -110,3 +487,57 @@ async def async_request(
 		headers=response_headers,
 		media_type=media_type
 	)
+
+
+async def _iter_upstream_body(resp: HttpxResponse) -> AsyncIterator[bytes]:
+	try:
+		async for chunk in resp.aiter_raw():
+			yield chunk
+	finally:
+		await resp.aclose()
+
+
+async def _iter_and_cache_upstream_body(
+		resp: HttpxResponse, cache_key: str, headers: dict
+) -> AsyncIterator[bytes]:
+	"""Relays the body and caches it once fully read, if it's not too big."""
+	chunks, size = [], 0
+	async for chunk in _iter_upstream_body(resp):
+		if chunks is not None:
+			size += len(chunk)
+			if size > settings.RESULT_CACHE_MAX_ITEM_BYTES:
+				chunks = None
+			else:
+				chunks.append(chunk)
+		yield chunk
+
+	if chunks is not None:
+		await set_cached_result(cache_key, b"".join(chunks), headers)
+
+
+async def read_response_body(resp: Response) -> bytes:
+	"""
+	Returns the body of a response from `async_request`, draining it if it is
+	a streamed upstream response.
+	"""
+	if isinstance(resp, StreamingResponse):
+		return b"".join([chunk async for chunk in resp.body_iterator])
+	return resp.body
+
+
+async def iter_response_body(resp: Response) -> AsyncIterator[bytes]:
+	"""Same as `read_response_body`, chunk by chunk."""
+	if isinstance(resp, StreamingResponse):
+		async for chunk in resp.body_iterator:
+			yield chunk
+	else:
+		yield resp.body
+
+
+async def close_response(resp: Response) -> None:
+	"""
+	Closes the upstream stream of a response from `async_request` that won't be
+	sent to the client, a sent one is closed by its background task.
+	"""
+	if isinstance(resp, StreamingResponse) and resp.background is not None:
+		await resp.background()
@@ -1,15 +1,22 @@
 import json
 import logging
 from http import HTTPStatus
+from typing import Optional
 
 import redis
 from fastapi import HTTPException, responses, Response
 
 from core import settings
+from common.phase_timer import timed_phase
+from common.cloud_run import close_response
 from common.redis_utils import (
-    get_api_cost,
     log_api_call,
+    get_billing_context,
     update_user_credits,
+    refund_user_credits,
+    queue_api_call_log,
+    queue_credits_used_log,
+    get_reserved_credits,
     check_if_user_has_enough_credits,
     check_if_user_has_metered_subscription,
     check_if_user_has_exceeded_daily_api_call_limit,
@@ -23,17 +30,29 @@ GENERIC_ERROR_MSG = (
 )
 
 
+@timed_phase("cost_setup")
 async def cost_setup(
-    redis_conn: redis.Redis, username: str, api_name: str, current_date: str
+    redis_conn: redis.Redis,
+    username: str,
+    api_name: str,
+    current_date: str,
+    calls: int = 1,
 ) -> tuple[int, bool]:
+    """
+    Returns (cost of one call, is metered). `calls` is the number of calls
+    about to be made (ex: a batch), the daily limit and the credits must cover
+    all of them.
+    """
     try:
-        api_cost = await get_api_cost(
+        billing_context = await get_billing_context(
             redis_conn=redis_conn,
+            username=username,
             api_name=api_name,
+            current_date=current_date,
         )
     except redis.exceptions.ConnectionError as e:
         logger.error(
-            f"Redis connection error when trying to get API cost for API "
+            f"Redis connection error when trying to get billing context for API "
             f"`{api_name}`, requested by user {username}. Error: {e}"
         )
 
@@ -42,6 +61,7 @@ async def cost_setup(
             detail="Internal server error.",
         ) from e
 
+    api_cost = billing_context.api_cost
     if not api_cost:
         logger.error(
             f"API cost not found for API `{api_name}`, "
@@ -60,23 +80,28 @@ async def cost_setup(
         redis_conn=redis_conn,
         username=username,
         current_date=current_date,
+        billing_context=billing_context,
+        calls=calls,
     )
 
     is_metered = await check_if_user_has_metered_subscription(
         redis_conn=redis_conn,
         username=username,
+        billing_context=billing_context,
     )
 
     if not is_metered:
         await check_if_user_has_enough_credits(
             redis_conn=redis_conn,
             username=username,
-            api_cost=api_cost,
+            api_cost=api_cost * calls,
+            billing_context=billing_context,
         )
 
     return api_cost, is_metered
 
 
+@timed_phase("cost_teardown")
 async def cost_teardown(
     redis_conn: redis.Redis,
     resp_type: str,
@@ -87,84 +112,183 @@ async def cost_teardown(
     current_date: str,
     timestamp: int,
     is_metered: bool = False,
+    reservation: Optional[list[str]] = None,
 ):
     """
     Returns responses if they are 200 or 400. If other status codes are returned,
-    logs the error and raises an 500 exception.
+    logs the error and raises an 500 exception. The upstream stream of `resp` is
+    closed if it is not returned.
+    With a `reservation` (see `reserve_user_credits`) the credits were taken up
+    front, the ones not charged are given back instead.
     """
-    if resp_type not in {"file", "str", "json"}:
-        logger.error(
-        f"Expected response type to be 'file', 'str' or 'json', got {resp_type}."
-        )
-        raise HTTPException(
-            status_code=500,
-            detail="Internal server error.",
-        )
-
-    if not resp or not isinstance(resp, Response):
-        # no need to take credit from the user, this is our logic error
-        logger.error(
-            f"Expected response to be FastAPI Response object, got {type(resp)}."
-        )
-        raise HTTPException(
-            status_code=500,
-            detail="Internal server error.",
-        )
+    # a streamed upstream response that is not returned has to be closed here,
+    # otherwise its connection is never given back to the pool
+    response_sent = False
+    try:
+        if resp_type not in {"file", "str", "json"}:
+            logger.error(
+            f"Expected response type to be 'file', 'str' or 'json', got {resp_type}."
+            )
+            raise HTTPException(
+                status_code=500,
+                detail="Internal server error.",
+            )
 
-    if resp.status_code == HTTPStatus.BAD_REQUEST.value:
-        api_cost = settings.API_COST_BAD_REQUEST
+        if not resp or not isinstance(resp, Response):
+            # no need to take credit from the user, this is our logic error
+            logger.error(
+                f"Expected response to be FastAPI Response object, got {type(resp)}."
+            )
+            raise HTTPException(
+                status_code=500,
+                detail="Internal server error.",
+            )
 
-    if resp.status_code in (HTTPStatus.OK.value, HTTPStatus.BAD_REQUEST.value):
-        if not is_metered:
-            await update_user_credits(
-                username=username,
+        if resp.status_code == HTTPStatus.BAD_REQUEST.value:
+            api_cost = settings.API_COST_BAD_REQUEST
+
+        if resp.status_code in (HTTPStatus.OK.value, HTTPStatus.BAD_REQUEST.value):
+            if reservation is not None:
+                await refund_user_credits(
+                    redis_conn=redis_conn,
+                    username=username,
+                    credits=get_reserved_credits(reservation) - api_cost,
+                    reservation=reservation,
+                )
+            elif not is_metered:
+                await update_user_credits(
+                    username=username,
+                    redis_conn=redis_conn,
+                    api_cost=api_cost,
+                )
+
+            await log_credits_used_per_api_endpoint_by_user(
                 redis_conn=redis_conn,
+                username=username,
+                api_name=api_name,
                 api_cost=api_cost,
+                current_date=current_date,
+                timestamp=timestamp,
+            )
+        elif reservation is not None:
+            await refund_user_credits(
+                redis_conn=redis_conn,
+                username=username,
+                credits=get_reserved_credits(reservation),
+                reservation=reservation,
             )
 
-        await log_credits_used_per_api_endpoint_by_user(
+        # it does not matter if the API call was successful or not, we still log
+        # the API call to limit abuse.
+        await log_api_call(
             redis_conn=redis_conn,
+            current_date=current_date,
             username=username,
             api_name=api_name,
-            api_cost=api_cost,
-            current_date=current_date,
             timestamp=timestamp,
+            success=resp.status_code == HTTPStatus.OK.value,
         )
 
-    # it does not matter if the API call was successful or not, we still log
-    # the API call to limit abuse.
-    await log_api_call(
-        redis_conn=redis_conn,
-        current_date=current_date,
-        username=username,
-        api_name=api_name,
-        timestamp=timestamp,
-        success=resp.status_code == HTTPStatus.OK.value,
-    )
+        if resp.status_code == HTTPStatus.OK.value:
+            response_sent = True
+            return resp
+        elif resp.status_code == HTTPStatus.BAD_REQUEST.value:
+            return responses.JSONResponse(
+                status_code=HTTPStatus.BAD_REQUEST.value,
+                content=json.loads(resp.body.decode()),
+            )
 
-    if resp.status_code == HTTPStatus.OK.value:
-        return resp
-    elif resp.status_code == HTTPStatus.BAD_REQUEST.value:
-        return responses.JSONResponse(
-            status_code=HTTPStatus.BAD_REQUEST.value,
-            content=json.loads(resp.body.decode()),
+        # if we are here, something went wrong
+        err_msg = (
+            f"User {username} encounter an error when calling GCF API: {api_name} at "
+            f"timestamp: {timestamp}. "
+            f"Resp status code {resp.status_code}."
         )
+        if resp_type == "file":
+            err_msg += f" Response: {resp.body}."
 
-    # if we are here, something went wrong
-    err_msg = (
-        f"User {username} encounter an error when calling GCF API: {api_name} at "
-        f"timestamp: {timestamp}. "
-        f"Resp status code {resp.status_code}."
-    )
-    if resp_type == "file":
-        err_msg += f" Response: {resp.body}."
+        logging.error(err_msg)
 
-    logging.error(err_msg)
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value,
+            detail=GENERIC_ERROR_MSG
+        )
+    finally:
+        if not response_sent:
+            await close_response(resp)
 
-    raise HTTPException(
-        status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value,
-        detail=GENERIC_ERROR_MSG
-    )
+
+async def cost_teardown_batch(
+    redis_conn: redis.Redis,
+    status_codes: list[int],
+    username: str,
+    api_name: str,
+    api_cost: int,
+    current_date: str,
+    timestamp: int,
+    is_metered: bool = False,
+    reservation: Optional[list[str]] = None,
+    billable: Optional[list[bool]] = None,
+) -> int:
+    """
+    Same billing as `cost_teardown` for the items of a batch, one status code
+    per item: the credits are taken once for all the 200 and 400 items, the
+    failed ones are not charged, and the items are logged in one round trip.
+    billable: per item, False for the items rejected before calling the API,
+    they are not charged whatever their status code.
+    The reservation is emptied once settled, so it can't be refunded twice.
+    Returns the credits charged.
+    """
+    item_costs = []
+    for status_code, is_billable in zip(
+            status_codes, billable or [True] * len(status_codes)
+    ):
+        if not is_billable:
+            continue
+        elif status_code == HTTPStatus.OK.value:
+            item_costs.append(api_cost)
+        elif status_code == HTTPStatus.BAD_REQUEST.value:
+            item_costs.append(settings.API_COST_BAD_REQUEST)
+
+    total_cost = sum(item_costs)
+    if reservation is not None:
+        await refund_user_credits(
+            redis_conn=redis_conn,
+            username=username,
+            credits=get_reserved_credits(reservation) - total_cost,
+            reservation=reservation,
+        )
+        reservation.clear()
+    elif total_cost and not is_metered:
+        await update_user_credits(
+            username=username,
+            redis_conn=redis_conn,
+            api_cost=total_cost,
+        )
+
+    pipeline = redis_conn.pipeline(transaction=True)
+    for item_cost in item_costs:
+        queue_credits_used_log(
+            pipeline=pipeline,
+            username=username,
+            api_name=api_name,
+            api_cost=item_cost,
+            current_date=current_date,
+            timestamp=timestamp,
+        )
+
+    for status_code in status_codes:
+        queue_api_call_log(
+            pipeline=pipeline,
+            current_date=current_date,
+            username=username,
+            api_name=api_name,
+            timestamp=timestamp,
+            success=status_code == HTTPStatus.OK.value,
+        )
+    await pipeline.execute()
+
+    return total_cost
 
 
 async def free_api_call(
@@ -1,12 +1,27 @@
+"""
+Publishing of the WhatsApp messages to the `twilio` Pub/Sub topic, Eventarc
+pushes them to the AI container.
+
+`publish_whatsapp_msg_to_pubsub` returns as soon as the message is queued, the
+publisher client sends the messages in batches (PUBSUB_BATCH_*) from its own
+threads and a failed publish is only logged. With PUBSUB_MESSAGE_ORDERING the
+phone number is the ordering key, the messages of a conversation keep their
+order if the subscription has message ordering enabled.
+"""
 import json
 import uuid
 import base64
+import asyncio
 import logging
 from datetime import datetime
+from collections import deque
+from typing import Optional
 
 import httpx
 from google.cloud import pubsub_v1
+from starlette.concurrency import run_in_threadpool
 
+from core import settings
 from core.settings import ENV_MODE, GCP_PROJECT_ID
 from app_ai.views.v1.urls import app_ai_v1_urls
 from app_ai.cloud_run_container_app_ai.v1.common.pub_sub_schema import (
@@ -15,6 +30,9 @@ from app_ai.cloud_run_container_app_ai.v1.common.pub_sub_schema import (
 
 logger = logging.getLogger("APP_API_"+__name__)
 
+# messages kept by the local publisher, the newest ones
+LOCAL_PUBLISHER_MAX_MESSAGES = 1000
+
 
 class LocalPublishFuture:
 	"""
@@ -29,70 +47,172 @@ class LocalPublishFuture:
 		"""
 		return self._message_id
 
+	def add_done_callback(self, callback) -> None:
+		callback(self)
+
 
 class LocalPublisherClient:
-	"""A mock PublisherClient"""
+	"""
+	In-memory stand-in for the PublisherClient. `publish` keeps the message in
+	`messages` and, with a `local_endpoint`, a background task per ordering key
+	pushes it there like Eventarc would.
+	"""
 
-	def __init__(self, local_endpoint: str):
+	def __init__(self, local_endpoint: Optional[str]):
 		self.local_endpoint = local_endpoint
+		self.messages: deque = deque(maxlen=LOCAL_PUBLISHER_MAX_MESSAGES)
+		self._queues: dict[str, deque] = {}
+		self._tasks: dict[str, asyncio.Task] = {}
+		self._client: Optional[httpx.AsyncClient] = None
 
 	def topic_path(self, project: str, topic: str) -> str:
 		return f"projects/{project}/topics/{topic}"
 
 	def publish(
-			self, topic: str, data: bytes, **kwargs
+			self, topic: str, data: bytes, ordering_key: str = "", **kwargs
 	) -> LocalPublishFuture:
-		encoded_data = base64.b64encode(data).decode("utf-8")
-
 		message_id = str(uuid.uuid4())
-		publish_time = datetime.utcnow().isoformat() + "Z"
 		event_body = {
 			"message": {
-				"data": encoded_data,
+				"data": base64.b64encode(data).decode("utf-8"),
 				"messageId": message_id,
-				"publishTime": publish_time,
+				"publishTime": datetime.utcnow().isoformat() + "Z",
+				"orderingKey": ordering_key,
 			},
 			"subscription": "projects/fake-project/subscriptions/fake-sub",
 		}
+		self.messages.append(event_body)
 
-		headers = {
-			"ce-id": str(uuid.uuid4()),
-			"ce-source": topic,
-			"ce-specversion": "1.0",
-			"ce-type": "google.cloud.pubsub.topic.v1.messagePublished",
-			"Content-Type": "application/json",
-		}
+		if self.local_endpoint:
+			self._queues.setdefault(ordering_key, deque()).append(
+				(topic, event_body)
+			)
+			if ordering_key not in self._tasks:
+				self._tasks[ordering_key] = asyncio.create_task(
+					self._push(ordering_key)
+				)
 
-		with httpx.Client() as client:
+		return LocalPublishFuture(message_id)
+
+	def resume_publish(self, topic: str, ordering_key: str) -> None:
+		return None
 
-			response = client.post(
-				self.local_endpoint, headers=headers, json=event_body,
+	async def _push(self, ordering_key: str) -> None:
+		"""The messages of an ordering key are pushed one after the other."""
+		if self._client is None:
+			self._client = httpx.AsyncClient(
 				timeout=90  # seconds, because of LLM delay
 			)
-			response.raise_for_status()
 
-		return LocalPublishFuture(message_id)
+		queue = self._queues[ordering_key]
+		try:
+			while queue:
+				topic, event_body = queue.popleft()
+				headers = {
+					"ce-id": str(uuid.uuid4()),
+					"ce-source": topic,
+					"ce-specversion": "1.0",
+					"ce-type": "google.cloud.pubsub.topic.v1.messagePublished",
+					"Content-Type": "application/json",
+				}
+				try:
+					response = await self._client.post(
+						self.local_endpoint, headers=headers, json=event_body,
+					)
+					response.raise_for_status()
+				except Exception as e:
+					logger.error(
+						f"Could not push message {event_body['message']['messageId']}"
+						f" to {self.local_endpoint}: {e!r}"
+					)
+		finally:
+			self._queues.pop(ordering_key, None)
+			self._tasks.pop(ordering_key, None)
+
+	async def stop(self) -> None:
+		"""
+		Waits up to PUBSUB_LOCAL_STOP_TIMEOUT seconds for the queued messages to
+		be pushed, the pushes still running then are cancelled.
+		"""
+		tasks = list(self._tasks.values())
+		if tasks:
+			_, pending = await asyncio.wait(
+				tasks, timeout=settings.PUBSUB_LOCAL_STOP_TIMEOUT
+			)
+			if pending:
+				logger.warning(
+					f"The pushes to {self.local_endpoint} did not finish, "
+					f"{sum(len(queue) for queue in self._queues.values())} "
+					f"queued messages were dropped."
+				)
+			for task in pending:
+				task.cancel()
+			await asyncio.gather(*pending, return_exceptions=True)
+		if self._client is not None:
+			await self._client.aclose()
+			self._client = None
+
+
+def build_publisher():
+	if ENV_MODE == "local":
+		return LocalPublisherClient(
+			local_endpoint=(
+				app_ai_v1_urls["twilio_whatsapp_webhook"].url_target
+				if settings.PUBSUB_LOCAL_PUSH else None
+			)
+		)
+
+	return pubsub_v1.PublisherClient(
+		batch_settings=pubsub_v1.types.BatchSettings(
+			max_messages=settings.PUBSUB_BATCH_MAX_MESSAGES,
+			max_bytes=settings.PUBSUB_BATCH_MAX_BYTES,
+			max_latency=settings.PUBSUB_BATCH_MAX_LATENCY,
+		),
+		publisher_options=pubsub_v1.types.PublisherOptions(
+			enable_message_ordering=settings.PUBSUB_MESSAGE_ORDERING,
+		),
+	)
 
 
-if ENV_MODE != "local":
-	PUBLISHER = pubsub_v1.PublisherClient()
-else:
-	PUBLISHER = LocalPublisherClient(
-			local_endpoint=app_ai_v1_urls["twilio_whatsapp_webhook"].url_target
-		)
+PUBLISHER = build_publisher()
+TOPIC_PATH = PUBLISHER.topic_path(
+	topic="twilio",  # same as Terraform topic name needed for Eventarc
+	project=GCP_PROJECT_ID
+)
+
+
+async def close_pubsub_publisher() -> None:
+	"""Called from the FastAPI lifespan, sends the messages still batched."""
+	if isinstance(PUBLISHER, LocalPublisherClient):
+		await PUBLISHER.stop()
+	else:
+		await run_in_threadpool(PUBLISHER.stop)
 
 
-def publish_whatsapp_msg_to_pubsub(input_data: TwilioPublisherMsg) -> bool:
+def _on_published(future, phone_number: str, ordering_key: str) -> None:
+	"""Runs in a thread of the publisher client."""
+	try:
+		future.result()
+	except Exception as e:
+		logger.error(
+			f"Phone number: {phone_number} encounter an error "
+			f"when trying to publish to Pub/Sub. Response: {e}."
+		)
+		# the next messages of this key are rejected until it is resumed
+		if ordering_key:
+			PUBLISHER.resume_publish(TOPIC_PATH, ordering_key)
+
 
-	topic_path = PUBLISHER.topic_path(
-		topic="twilio",  # same as Terraform topic name needed for Eventarc
-		project=GCP_PROJECT_ID
+async def publish_whatsapp_msg_to_pubsub(input_data: TwilioPublisherMsg) -> bool:
+	"""False if the message could not be queued."""
+	ordering_key = (
+		input_data.phone_number if settings.PUBSUB_MESSAGE_ORDERING else ""
 	)
-	
 	try:
-		PUBLISHER.publish(
-			topic=topic_path,
-			data=json.dumps(input_data.model_dump()).encode("utf-8")
+		future = PUBLISHER.publish(
+			topic=TOPIC_PATH,
+			data=json.dumps(input_data.model_dump()).encode("utf-8"),
+			ordering_key=ordering_key,
 		)
 	except Exception as e:
 		logger.error(
@@ -101,4 +221,7 @@ def publish_whatsapp_msg_to_pubsub(input_data: TwilioPublisherMsg) -> bool:
 		)
 		return False
 
+	future.add_done_callback(
+		lambda f: _on_published(f, input_data.phone_number, ordering_key)
+	)
 	return True
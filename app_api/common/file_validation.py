@@ -1,16 +1,111 @@
+import os
 import logging
 from typing import Union
 
 from fastapi import UploadFile, HTTPException, status
 
+from common.phase_timer import timed_phase
+
 
 logger = logging.getLogger(__name__)
 
 
+class FileSizeLimitExceeded(Exception):
+    pass
+
+
+class UploadSizeBudget:
+    """
+    Max number of bytes that the files of one request can stream, either for
+    each file (`per_file=True`) or for all the files together. The readers are
+    anything counting its `bytes_read`: the uploads streamed to Cloud Run and
+    the files downloaded by `common.openai`.
+    """
+
+    def __init__(
+            self, max_size_mb: Union[int, float, None] = None,
+            per_file: bool = False
+    ):
+        self.max_size_mb = max_size_mb
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.per_file = per_file
+        self.readers = []
+
+    @classmethod
+    def for_endpoint(cls, other: Union[dict, None]) -> "UploadSizeBudget":
+        """
+        From the endpoint's `other`: `max_files_size_mb` is for all the files
+        together, `file_size_mb` (or the biggest `*_file_size_mb`) is for each
+        file.
+        """
+        other = other or {}
+        if "max_files_size_mb" in other:
+            return cls(other["max_files_size_mb"])
+        elif "file_size_mb" in other:
+            return cls(other["file_size_mb"], per_file=True)
+
+        sizes = [v for k, v in other.items() if k.endswith("file_size_mb")]
+        return cls(max(sizes) if sizes else None, per_file=True)
+
+    def check(self, reader: "SizeLimitedReader") -> None:
+        if self.max_bytes is None:
+            return
+
+        if self.per_file:
+            size = reader.bytes_read
+        else:
+            size = sum(r.bytes_read for r in self.readers)
+
+        if size > self.max_bytes:
+            raise FileSizeLimitExceeded(
+                f"File too large. Max size is {self.max_size_mb} MB."
+            )
+
+
+class SizeLimitedReader:
+    """
+    Read-only wrapper around an upload's spooled file, handed to httpx so the
+    multipart body is streamed in chunks instead of being loaded in memory.
+    Raises `FileSizeLimitExceeded` as soon as the budget is exceeded.
+
+    `fileno` is deliberately not exposed, httpx would call it to get the length
+    and that forces a SpooledTemporaryFile to roll over to disk.
+    """
+
+    def __init__(self, file, budget: UploadSizeBudget):
+        self.file = file
+        self.budget = budget
+        self.bytes_read = 0
+        budget.readers.append(self)
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.file.read(size)
+        self.bytes_read += len(chunk)
+        self.budget.check(self)
+        return chunk
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        position = self.file.seek(offset, whence)
+        if whence == os.SEEK_SET:
+            self.bytes_read = position
+        return position
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+
+def get_upload_file_size(file: UploadFile) -> int:
+    """Size in bytes, without reading the file into memory."""
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+
+@timed_phase("file_validation")
 async def validate_file_size_mb(file: UploadFile, max_size_mb: int) -> bool:
     try:
-        contents = await file.read()
-        await file.seek(0)
+        size = get_upload_file_size(file)
     except (AttributeError, FileNotFoundError) as e:
         msg = "File not found."
 
@@ -26,7 +121,7 @@ async def validate_file_size_mb(file: UploadFile, max_size_mb: int) -> bool:
             detail="Unknown error. Please check file format and try again.",
         ) from e
 
-    if len(contents) > max_size_mb * 1024 * 1024:
+    if size > max_size_mb * 1024 * 1024:
         raise HTTPException(
             status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
             detail=f"File too large. Max size is {max_size_mb} MB.",
@@ -0,0 +1,243 @@
+"""
+`Idempotency-Key` support for the POST calls, so a client can safely retry a
+call that timed out without the work being done and billed twice.
+
+The first call with a key takes the lock and runs, its response is then stored
+for IDEMPOTENCY_TTL seconds if it was billed (200 and 400, see
+`cost_teardown`) or accepted (202, a job was submitted). A call with the same
+key, from the same user and with the same URL and body, waits for the lock and
+gets the stored response with an `Idempotent-Replayed: true` header, without
+calling the views (no Cloud Run call, no credits). Other responses (ex: 429,
+500) are not stored, a retry runs again.
+
+The request and response bodies are buffered, the small response bodies are
+kept in Redis, the others in the temp bucket.
+"""
+import json
+import uuid
+import asyncio
+import hashlib
+import logging
+import time
+from http import HTTPStatus
+from typing import Optional
+
+import redis.asyncio as redis
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+from core import settings
+from common.redis_scripts import LOCK_RELEASE_LUA
+from common.redis_utils import init_redis_pool, get_redis_script
+from common.temp_bucket import upload_to_temp_bucket, download_from_temp_bucket
+from access_management.api_auth import verify_token
+from schemas.redis_db import (
+	REDIS_KEY_IDEMPOTENCY_LOCK, REDIS_KEY_IDEMPOTENCY_RESULT,
+)
+
+
+logger = logging.getLogger("APP_API_"+__name__)
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+REPLAYED_HEADER = "Idempotent-Replayed"
+# the RateLimit-* headers of the first call are stale on a replay
+RATE_LIMIT_HEADER_PREFIX = b"ratelimit-"
+# the billed responses, and the submitted jobs so that a retry doesn't submit
+# (and bill) the job again
+STORED_STATUS_CODES = {
+	HTTPStatus.OK.value, HTTPStatus.ACCEPTED.value, HTTPStatus.BAD_REQUEST.value,
+}
+POLL_INTERVAL = 0.2
+
+
+async def _get_fingerprint(request: Request) -> str:
+	"""
+	The same key can't be used for a different call. The multipart boundary is
+	left out of the body hash, clients pick a new one for each retry.
+	"""
+	body = await request.body()
+	_, _, boundary = request.headers.get("content-type", "").partition(
+		"boundary="
+	)
+	if boundary:
+		body = body.replace(boundary.split(";")[0].strip('"').encode(), b"")
+	return (
+		f"{request.method} {request.url.path}?{request.url.query} "
+		f"{hashlib.sha256(body).hexdigest()}"
+	)
+
+
+def _build_response(
+		body: bytes, status_code: int, raw_headers: list[tuple[bytes, bytes]]
+) -> Response:
+	"""The raw headers keep the repeated ones (ex: Set-Cookie)."""
+	response = Response(content=body, status_code=status_code)
+	response.raw_headers = raw_headers
+	return response
+
+
+async def _get_stored_response(
+		redis_conn: redis.Redis, result_key: str
+) -> Optional[dict]:
+	stored = await redis_conn.hgetall(result_key)
+	if not stored:
+		return None
+	return {k.decode(): v for k, v in stored.items()}
+
+
+async def _replay(stored: dict, fingerprint: str) -> Response:
+	if stored["fingerprint"].decode() != fingerprint:
+		return JSONResponse(
+			status_code=HTTPStatus.UNPROCESSABLE_ENTITY.value,
+			content={
+				"detail": (
+					f"The {IDEMPOTENCY_KEY_HEADER} was already used for a "
+					f"different request."
+				)
+			},
+		)
+
+	if "body_ref" in stored:
+		body = await download_from_temp_bucket(stored["body_ref"].decode())
+	else:
+		body = stored["body"]
+
+	headers = json.loads(stored["headers"])
+	if isinstance(headers, dict):  # stored before the headers were pairs
+		headers = headers.items()
+	raw_headers = [
+		(name.encode("latin-1"), value.encode("latin-1"))
+		for name, value in headers
+	]
+	return _build_response(
+		body=body,
+		status_code=int(stored["status_code"]),
+		raw_headers=[
+			*(
+				(name, value) for name, value in raw_headers
+				if not name.lower().startswith(RATE_LIMIT_HEADER_PREFIX)
+			),
+			(REPLAYED_HEADER.lower().encode("latin-1"), b"true"),
+		],
+	)
+
+
+async def _store_response(
+		redis_conn: redis.Redis,
+		result_key: str,
+		fingerprint: str,
+		response: Response,
+		body: bytes,
+) -> None:
+	stored = {
+		"fingerprint": fingerprint,
+		"status_code": response.status_code,
+		"headers": json.dumps([
+			[name.decode("latin-1"), value.decode("latin-1")]
+			for name, value in response.headers.raw
+		]),
+	}
+	if len(body) > settings.IDEMPOTENCY_MAX_INLINE_BYTES:
+		stored["body_ref"] = f"idempotency/{uuid.uuid4().hex}"
+		await upload_to_temp_bucket(
+			content=body,
+			blob_name=stored["body_ref"],
+			content_type=response.headers.get("content-type"),
+		)
+	else:
+		stored["body"] = body
+
+	async with redis_conn.pipeline(transaction=True) as pipe:
+		pipe.hset(result_key, mapping=stored)
+		pipe.expire(result_key, settings.IDEMPOTENCY_TTL)
+		await pipe.execute()
+
+
+async def idempotency_middleware(request: Request, call_next):
+	idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+	if request.method != "POST" or idempotency_key is None:
+		return await call_next(request)
+
+	if not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+		return JSONResponse(
+			status_code=HTTPStatus.BAD_REQUEST.value,
+			content={"detail": f"Invalid {IDEMPOTENCY_KEY_HEADER} header."},
+		)
+
+	redis_conn = redis.Redis(connection_pool=init_redis_pool())
+	try:
+		token_data = await verify_token(req=request, redis_conn=redis_conn)
+	except Exception:
+		# the view answers with the authentication error
+		return await call_next(request)
+
+	key = hashlib.sha256(idempotency_key.encode()).hexdigest()
+	lock_key = REDIS_KEY_IDEMPOTENCY_LOCK.format(
+		username=token_data.username, key=key
+	)
+	result_key = REDIS_KEY_IDEMPOTENCY_RESULT.format(
+		username=token_data.username, key=key
+	)
+	fingerprint = await _get_fingerprint(request)
+	lock_token = uuid.uuid4().hex
+
+	# a duplicate waits for the call holding the lock to finish, if that one
+	# was not stored (ex: 500) the duplicate takes the lock and runs again
+	deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+	while True:
+		stored = await _get_stored_response(redis_conn, result_key)
+		if stored is not None:
+			return await _replay(stored, fingerprint)
+
+		if await redis_conn.set(
+				lock_key, lock_token, nx=True, ex=settings.IDEMPOTENCY_LOCK_TTL
+		):
+			break
+
+		if time.monotonic() > deadline:
+			return JSONResponse(
+				status_code=HTTPStatus.CONFLICT.value,
+				content={
+					"detail": (
+						"A request with the same "
+						f"{IDEMPOTENCY_KEY_HEADER} is still in progress."
+					)
+				},
+			)
+		await asyncio.sleep(POLL_INTERVAL)
+
+	try:
+		# it may have finished between our read and taking the lock
+		stored = await _get_stored_response(redis_conn, result_key)
+		if stored is not None:
+			return await _replay(stored, fingerprint)
+
+		response = await call_next(request)
+		if response.status_code not in STORED_STATUS_CODES:
+			return response
+
+		body = b"".join([chunk async for chunk in response.body_iterator])
+		try:
+			await _store_response(
+				redis_conn=redis_conn,
+				result_key=result_key,
+				fingerprint=fingerprint,
+				response=response,
+				body=body,
+			)
+		except Exception as e:
+			logger.error(
+				f"Could not store the response of {fingerprint} for user "
+				f"{token_data.username}: {e}"
+			)
+
+		return _build_response(
+			body=body,
+			status_code=response.status_code,
+			raw_headers=response.headers.raw,
+		)
+	finally:
+		# after IDEMPOTENCY_LOCK_TTL the lock may belong to a retry
+		release_lock = get_redis_script(redis_conn, LOCK_RELEASE_LUA)
+		await release_lock(keys=[lock_key], args=[lock_token], client=redis_conn)
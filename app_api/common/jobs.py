@@ -0,0 +1,682 @@
+"""
+Async job mode for the long running APIs (ex: conversions that can take longer
+than the request timeout).
+
+A client opts in by sending `Prefer: respond-async`, the view then calls
+`submit_job` instead of the Cloud Run target:
+- `cost_setup` checks the daily limit, the job takes one of the user's
+  JOBS_MAX_ACTIVE_PER_USER job slots and its cost is reserved (debited) up
+  front. The input files are stored in the temp bucket and the job id is pushed
+  on REDIS_KEY_API_JOBS_QUEUE, the client gets a 202 with the job status and
+  the URL to poll (`/jobs/v1/status`);
+- `JobWorkers` (started from the FastAPI lifespan) move the job ids to their
+  own processing list and run the handler of the API, by default the Cloud Run
+  target is called with JOBS_UPSTREAM_TIMEOUT. APIs that don't go to Cloud Run
+  register their own handler with `@job_handler(API_NAME)`;
+- `cost_teardown` gives back the credits that are not charged when the job
+  finishes, the result is stored in the temp bucket and the job status is
+  POSTed to the optional `Job-Webhook-Url` header (public hosts only).
+
+The workers run in the App_API instances, which only get CPU while they serve
+requests (Cloud Run `cpu_idle = true`) and can be stopped at any time. Each
+process refreshes a heartbeat, the jobs left in the processing lists of a
+process without one are queued again by the reaper, or failed and refunded
+after JOBS_MAX_RETRIES.
+"""
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import ipaddress
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from http import HTTPStatus
+from typing import Awaitable, Callable, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+import redis.asyncio as redis
+from fastapi import Header, HTTPException, Response, UploadFile
+from fastapi.responses import JSONResponse
+
+from core import settings
+from core.settings import GENERIC_ERROR_MSG
+from schemas.auth import TokenData
+from schemas.jobs import JobOptions, JobStatus
+from schemas.redis_db import (
+	REDIS_KEY_API_JOB, REDIS_KEY_API_JOBS_QUEUE, REDIS_KEY_API_JOBS_PROCESSING,
+	REDIS_KEY_API_JOBS_INSTANCE, REDIS_KEY_USER_API_JOB_SLOTS,
+	REDIS_KEY_METERED_SUBSCRIPTION_USERS, REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
+)
+from common.other import get_filename_from_cd
+from common.cloud_run import async_request, iter_response_body, close_response
+from common.cost_management import cost_setup, cost_teardown
+from common.file_validation import validate_file_size_mb
+from common.redis_scripts import API_CALL_SLOT_ACQUIRE_LUA
+from common.redis_utils import (
+	init_redis_pool, get_redis_script, reserve_user_credits,
+	refund_user_credits, get_reserved_credits,
+)
+from common.temp_bucket import (
+	upload_file_to_temp_bucket, upload_stream_to_temp_bucket,
+	download_file_from_temp_bucket, get_temp_bucket_signed_url,
+	delete_from_temp_bucket,
+)
+from common.openai.fastapi_transaltion import sanitize_filename
+
+
+logger = logging.getLogger("APP_API_"+__name__)
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_SUCCEEDED = "succeeded"
+JOB_STATUS_FAILED = "failed"
+
+JOB_STATUS_URL = "/jobs/v1/status"
+
+# the GCP metadata server, also reachable as 169.254.169.254
+METADATA_HOSTS = {"metadata", "metadata.google.internal"}
+
+# handler(job, files) -> Response, `files` is in the `override_files` format
+# of `async_request`: [(field name, (filename, file object, content type))]
+JobHandler = Callable[[dict, list[tuple]], Awaitable[Response]]
+# {api_name: handler}, APIs without a handler use `run_cloud_run_job`
+JOB_HANDLERS: dict[str, JobHandler] = {}
+
+
+def job_handler(api_name: str):
+	def register(handler: JobHandler) -> JobHandler:
+		JOB_HANDLERS[api_name] = handler
+		return handler
+	return register
+
+
+def _is_public_address(address: str) -> bool:
+	ip = ipaddress.ip_address(address.split("%")[0])
+	if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+		ip = ip.ipv4_mapped
+	return ip.is_global and not ip.is_multicast
+
+
+async def resolve_webhook_url(url: str) -> list[str]:
+	"""
+	Returns the IP addresses of the webhook URL's host. Raises a ValueError if
+	the URL is not valid or if the host is not public (loopback, private,
+	link-local, the metadata server...), a webhook must not reach our own
+	network. Local mode also allows http and any host.
+	"""
+	parts = urlsplit(url)
+	is_local = settings.ENV_MODE == "local"
+	allowed_schemes = {"https", "http"} if is_local else {"https"}
+	if parts.scheme not in allowed_schemes or not parts.hostname:
+		raise ValueError(f"Invalid webhook URL `{url}`.")
+	if not is_local and parts.hostname.rstrip(".").lower() in METADATA_HOSTS:
+		raise ValueError(f"Webhook URL `{url}` is not public.")
+
+	try:
+		address_infos = await asyncio.get_running_loop().getaddrinfo(
+			parts.hostname,
+			parts.port or (443 if parts.scheme == "https" else 80),
+			type=socket.SOCK_STREAM,
+		)
+	except socket.gaierror as e:
+		raise ValueError(f"Could not resolve webhook URL `{url}`: {e}") from e
+
+	addresses = list(dict.fromkeys(info[4][0] for info in address_infos))
+	if not is_local and not all(map(_is_public_address, addresses)):
+		raise ValueError(f"Webhook URL `{url}` is not public.")
+	return addresses
+
+
+async def get_job_options(
+		prefer: Optional[str] = Header(
+			None,
+			description=(
+				"Send `respond-async` to run the request as a job, the response "
+				f"is a 202 with the job id to poll on `{JOB_STATUS_URL}`."
+			),
+		),
+		job_webhook_url: Optional[str] = Header(
+			None,
+			description=(
+				"Async jobs only, the job status is POSTed to this HTTPS URL "
+				"when the job finishes."
+			),
+		),
+) -> JobOptions:
+	respond_async = "respond-async" in (prefer or "").lower()
+	if job_webhook_url:
+		try:
+			await resolve_webhook_url(job_webhook_url)
+		except ValueError as e:
+			logger.info(str(e))
+			raise HTTPException(
+				status_code=400, detail="Invalid request, invalid webhook URL."
+			)
+
+	return JobOptions(respond_async=respond_async, webhook_url=job_webhook_url)
+
+
+def _get_job_key(job_id: str) -> str:
+	return REDIS_KEY_API_JOB.format(job_id=job_id)
+
+
+async def _take_job_slot(
+		redis_conn: redis.Redis, username: str, job_id: str
+) -> None:
+	"""
+	Raises a 429 if the user already has JOBS_MAX_ACTIVE_PER_USER jobs queued
+	or running. A slot is leased for JOBS_TTL, the lifetime of its job.
+	"""
+	acquire_slot = get_redis_script(redis_conn, API_CALL_SLOT_ACQUIRE_LUA)
+	if not await acquire_slot(
+		keys=[
+			REDIS_KEY_USER_API_JOB_SLOTS.format(username=username),
+			REDIS_KEY_METERED_SUBSCRIPTION_USERS.format(username=username),
+			REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=username),
+		],
+		args=[
+			job_id,
+			settings.JOBS_TTL * 1000,
+			*[settings.JOBS_MAX_ACTIVE_PER_USER] * 3,
+		],
+		client=redis_conn,
+	):
+		raise HTTPException(
+			status_code=HTTPStatus.TOO_MANY_REQUESTS.value,
+			detail="Too many jobs, wait for the running ones to finish.",
+		)
+
+
+async def _release_job_slot(
+		redis_conn: redis.Redis, username: str, job_id: str
+) -> None:
+	await redis_conn.zrem(
+		REDIS_KEY_USER_API_JOB_SLOTS.format(username=username), job_id
+	)
+
+
+async def get_job(redis_conn: redis.Redis, job_id: str) -> dict:
+	job = await redis_conn.hgetall(_get_job_key(job_id))
+	return {k.decode(): v.decode() for k, v in job.items()}
+
+
+async def get_job_status(job: dict) -> JobStatus:
+	job_status = JobStatus(
+		job_id=job["job_id"],
+		api_name=job["api_name"],
+		status=job["status"],
+		created_at=int(job["created_at"]),
+		finished_at=int(job["finished_at"]) if job.get("finished_at") else None,
+		filename=job.get("result_filename") or None,
+		status_code=int(job["status_code"]) if job.get("status_code") else None,
+		error=job.get("error") or None,
+	)
+	if job["status"] == JOB_STATUS_SUCCEEDED:
+		job_status.result_url = await get_temp_bucket_signed_url(
+			job["result_blob_name"]
+		)
+	return job_status
+
+
+async def submit_job(
+		redis_conn: redis.Redis,
+		token_data: TokenData,
+		api_name: str,
+		job_options: JobOptions,
+		files: list[tuple[str, UploadFile]],
+		max_size_mb: float,
+		data: Optional[dict] = None,
+) -> JSONResponse:
+	"""
+	files: [(field name, file)], they are sent to the Cloud Run target with the
+	same field names. `data` is the form data sent with them.
+	"""
+	date_time_now = datetime.now()
+	current_date = date_time_now.strftime("%d-%m-%Y")
+	timestamp = int(date_time_now.timestamp())
+
+	for _, file in files:
+		await validate_file_size_mb(file=file, max_size_mb=max_size_mb)
+
+	api_cost, is_metered = await cost_setup(
+		redis_conn=redis_conn,
+		username=token_data.username,
+		api_name=api_name,
+		current_date=current_date,
+	)
+
+	job_id = uuid.uuid4().hex
+	await _take_job_slot(redis_conn, token_data.username, job_id)
+	reservation = None
+	try:
+		if not is_metered:
+			reservation = await reserve_user_credits(
+				redis_conn=redis_conn,
+				username=token_data.username,
+				credits=api_cost,
+			)
+
+		inputs = []
+		for i, (field_name, file) in enumerate(files):
+			blob_name = f"jobs/{job_id}/input/{i}"
+			await file.seek(0)
+			await upload_file_to_temp_bucket(
+				fileobj=file.file,
+				blob_name=blob_name,
+				content_type=file.content_type,
+			)
+			inputs.append({
+				"field_name": field_name,
+				"filename": file.filename,
+				"content_type": file.content_type,
+				"blob_name": blob_name,
+			})
+
+		job = {
+			"job_id": job_id,
+			"api_name": api_name,
+			"username": token_data.username,
+			"status": JOB_STATUS_QUEUED,
+			"created_at": timestamp,
+			"current_date": current_date,
+			"api_cost": api_cost,
+			"is_metered": int(is_metered),
+			# empty for metered users, they are billed by usage
+			"credits_reserved": (
+				json.dumps(reservation) if reservation is not None else ""
+			),
+			"inputs": json.dumps(inputs),
+			"data": json.dumps(data or {}),
+			"webhook_url": job_options.webhook_url or "",
+		}
+		pipeline = redis_conn.pipeline(transaction=True)
+		pipeline.hset(_get_job_key(job_id), mapping=job)
+		pipeline.expire(_get_job_key(job_id), settings.JOBS_TTL)
+		pipeline.lpush(REDIS_KEY_API_JOBS_QUEUE, job_id)
+		await pipeline.execute()
+	except Exception:
+		if reservation:
+			await refund_user_credits(
+				redis_conn=redis_conn,
+				username=token_data.username,
+				credits=get_reserved_credits(reservation),
+				reservation=reservation,
+			)
+		await _release_job_slot(redis_conn, token_data.username, job_id)
+		raise
+
+	logger.info(f"User {token_data.username} submitted job {job_id} ({api_name})")
+
+	job_status = await get_job_status({k: str(v) for k, v in job.items()})
+	return JSONResponse(
+		status_code=HTTPStatus.ACCEPTED.value,
+		content=job_status.model_dump(mode="json"),
+		headers={"Location": f"{JOB_STATUS_URL}?job_id={job_id}"},
+	)
+
+
+async def run_cloud_run_job(job: dict, files: list[tuple]) -> Response:
+	from core.urls import urls
+
+	app_name, version, api = job["api_name"].split("/")
+	return await async_request(
+		url=urls[app_name][version][api].url_target,
+		method="POST",
+		override_files=files,
+		data=json.loads(job["data"]) or None,
+		timeout=settings.JOBS_UPSTREAM_TIMEOUT,
+	)
+
+
+async def _update_job(redis_conn: redis.Redis, job: dict, **fields) -> None:
+	job.update({k: str(v) for k, v in fields.items()})
+	await redis_conn.hset(_get_job_key(job["job_id"]), mapping=fields)
+
+
+async def _store_job_result(
+		redis_conn: redis.Redis, job: dict, resp: Response
+) -> None:
+	"""The body is piped from the Cloud Run target to the bucket."""
+	filename = sanitize_filename(get_filename_from_cd(resp.headers) or "result")
+	blob_name = f"jobs/{job['job_id']}/result/{filename}"
+	try:
+		await upload_stream_to_temp_bucket(
+			chunks=iter_response_body(resp),
+			blob_name=blob_name,
+			content_type=resp.media_type or resp.headers.get("content-type"),
+		)
+	finally:
+		await close_response(resp)
+	await _update_job(
+		redis_conn, job,
+		status=JOB_STATUS_SUCCEEDED,
+		finished_at=int(time.time()),
+		result_blob_name=blob_name,
+		result_filename=filename,
+	)
+
+
+async def _notify_webhook(job: dict) -> None:
+	if not job.get("webhook_url"):
+		return
+
+	try:
+		job_status = await get_job_status(job)
+		# the host is resolved and checked again, the request goes to that
+		# address so a DNS answer that changed since can't send it elsewhere
+		parts = urlsplit(job["webhook_url"])
+		address = (await resolve_webhook_url(job["webhook_url"]))[0]
+		port = parts.port or (443 if parts.scheme == "https" else 80)
+		host = f"[{address}]" if ":" in address else address
+		async with httpx.AsyncClient(
+				timeout=settings.JOBS_WEBHOOK_TIMEOUT
+		) as client:  # redirects are not followed
+			resp = await client.post(
+				urlunsplit(parts._replace(netloc=f"{host}:{port}")),
+				json=job_status.model_dump(mode="json"),
+				headers={"Host": parts.netloc.rpartition("@")[2]},
+				extensions={"sni_hostname": parts.hostname},
+			)
+			resp.raise_for_status()
+	except Exception as e:
+		logger.warning(f"Could not notify the webhook of job {job['job_id']}: {e}")
+
+
+async def _claim_job_reservation(
+		redis_conn: redis.Redis, job: dict
+) -> Optional[list[str]]:
+	"""
+	The credits reserved by `submit_job`, a job's credits are charged or given
+	back once: [] if that was already done (ex: the reaper queued it again while
+	its worker was still running it). None for metered users.
+	"""
+	if not job.get("credits_reserved"):
+		return None
+	if not await redis_conn.hsetnx(_get_job_key(job["job_id"]), "settled", 1):
+		return []
+	return json.loads(job["credits_reserved"])
+
+
+async def _refund_job(redis_conn: redis.Redis, job: dict) -> None:
+	"""Gives back all the credits of a job that failed before it was billed."""
+	try:
+		reservation = await _claim_job_reservation(redis_conn, job)
+		if reservation:
+			await refund_user_credits(
+				redis_conn=redis_conn,
+				username=job["username"],
+				credits=get_reserved_credits(reservation),
+				reservation=reservation,
+			)
+	except Exception as e:
+		logger.error(
+			f"Could not refund the credits of job {job['job_id']} to user "
+			f"{job['username']}: {e}"
+		)
+
+
+async def _finish_job(redis_conn: redis.Redis, job: dict) -> None:
+	for file_input in json.loads(job["inputs"]):
+		try:
+			await delete_from_temp_bucket(file_input["blob_name"])
+		except Exception as e:
+			logger.warning(f"Could not delete {file_input['blob_name']}: {e}")
+
+	await _release_job_slot(redis_conn, job["username"], job["job_id"])
+	await _notify_webhook(job)
+
+
+async def run_job(redis_conn: redis.Redis, job_id: str) -> None:
+	job = await get_job(redis_conn, job_id)
+	if not job or job["status"] != JOB_STATUS_QUEUED:
+		return  # expired, or already picked up
+
+	await _update_job(redis_conn, job, status=JOB_STATUS_RUNNING)
+	inputs = json.loads(job["inputs"])
+	files = []
+	billed = False
+	try:
+		for file_input in inputs:
+			fileobj = SpooledTemporaryFile(
+				max_size=settings.JOBS_FILE_SPOOL_MAX_BYTES
+			)
+			files.append((
+				file_input["field_name"],
+				(file_input["filename"], fileobj, file_input["content_type"]),
+			))
+			await download_file_from_temp_bucket(
+				file_input["blob_name"], fileobj
+			)
+			fileobj.seek(0)
+
+		handler = JOB_HANDLERS.get(job["api_name"], run_cloud_run_job)
+		resp = await handler(job, files)
+		for _, (_, fileobj, _) in files:
+			fileobj.close()
+
+		billed = True
+		final_resp = await cost_teardown(
+			redis_conn=redis_conn,
+			resp_type="file",
+			resp=resp,
+			username=job["username"],
+			api_name=job["api_name"],
+			api_cost=int(job["api_cost"]),
+			current_date=job["current_date"],
+			timestamp=int(job["created_at"]),
+			is_metered=job["is_metered"] == "1",
+			reservation=await _claim_job_reservation(redis_conn, job),
+		)
+
+		if final_resp.status_code == HTTPStatus.OK.value:
+			await _store_job_result(redis_conn, job, final_resp)
+		else:  # bad request, the details come from the Cloud Run target
+			detail = json.loads(final_resp.body)
+			await _update_job(
+				redis_conn, job,
+				status=JOB_STATUS_FAILED,
+				finished_at=int(time.time()),
+				status_code=final_resp.status_code,
+				error=(
+					detail.get("detail", GENERIC_ERROR_MSG)
+					if isinstance(detail, dict) else str(detail)
+				),
+			)
+
+	except HTTPException as error:
+		logger.error(
+			f"User {job['username']} encounter an error when running job "
+			f"{job_id} ({job['api_name']}). Response: {error} with status code "
+			f"{error.status_code}."
+		)
+		await _update_job(
+			redis_conn, job,
+			status=JOB_STATUS_FAILED,
+			finished_at=int(time.time()),
+			status_code=error.status_code,
+			error=error.detail,
+		)
+	except Exception as error:
+		logger.error(
+			f"User {job['username']} encounter an error when running job "
+			f"{job_id} ({job['api_name']}). Response: {error}.", exc_info=True
+		)
+		await _update_job(
+			redis_conn, job,
+			status=JOB_STATUS_FAILED,
+			finished_at=int(time.time()),
+			status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value,
+			error=GENERIC_ERROR_MSG,
+		)
+
+	for _, (_, fileobj, _) in files:
+		fileobj.close()
+	if not billed:
+		await _refund_job(redis_conn, job)
+	await _finish_job(redis_conn, job)
+
+
+async def _retry_or_fail_job(redis_conn: redis.Redis, job_id: str) -> None:
+	job = await get_job(redis_conn, job_id)
+	if not job or job["status"] not in (JOB_STATUS_QUEUED, JOB_STATUS_RUNNING):
+		return  # expired, or it finished after all
+
+	retries = await redis_conn.hincrby(_get_job_key(job_id), "retries", 1)
+	if retries <= settings.JOBS_MAX_RETRIES:
+		logger.warning(
+			f"Job {job_id} ({job['api_name']}) of user {job['username']} was "
+			f"interrupted, it is queued again."
+		)
+		pipeline = redis_conn.pipeline(transaction=True)
+		pipeline.hset(_get_job_key(job_id), "status", JOB_STATUS_QUEUED)
+		pipeline.rpush(REDIS_KEY_API_JOBS_QUEUE, job_id)
+		await pipeline.execute()
+		return
+
+	logger.error(
+		f"Job {job_id} ({job['api_name']}) of user {job['username']} was "
+		f"interrupted {retries} times, it failed."
+	)
+	await _update_job(
+		redis_conn, job,
+		status=JOB_STATUS_FAILED,
+		finished_at=int(time.time()),
+		status_code=HTTPStatus.INTERNAL_SERVER_ERROR.value,
+		error=GENERIC_ERROR_MSG,
+	)
+	await _refund_job(redis_conn, job)
+	await _finish_job(redis_conn, job)
+
+
+async def reap_stale_jobs(redis_conn: redis.Redis) -> None:
+	"""
+	Takes back the jobs in the processing lists of the processes that stopped
+	refreshing their heartbeat (ex: the instance was stopped).
+	"""
+	async for key in redis_conn.scan_iter(
+			match=REDIS_KEY_API_JOBS_PROCESSING.format(worker_id="*"), count=1000
+	):
+		instance_id = key.decode().split(":")[1]
+		if await redis_conn.exists(
+				REDIS_KEY_API_JOBS_INSTANCE.format(instance_id=instance_id)
+		):
+			continue
+
+		for job_id in await redis_conn.lrange(key, 0, -1):
+			# only the reaper that removes it handles the job
+			if await redis_conn.lrem(key, 1, job_id):
+				await _retry_or_fail_job(redis_conn, job_id.decode())
+
+
+class JobWorkers:
+	"""
+	JOBS_WORKERS asyncio tasks per process, they share the Redis pool and the
+	Cloud Run clients with the requests. Each process also refreshes its
+	heartbeat and reaps the jobs of the processes that are gone.
+	"""
+
+	def __init__(self):
+		self.instance_id = uuid.uuid4().hex
+		self._tasks: list[asyncio.Task] = []
+
+	def _get_processing_key(self, index: int) -> str:
+		return REDIS_KEY_API_JOBS_PROCESSING.format(
+			worker_id=f"{self.instance_id}:{index}"
+		)
+
+	async def _work(self, redis_conn: redis.Redis, index: int) -> None:
+		processing_key = self._get_processing_key(index)
+		while True:
+			try:
+				# the job id stays in the processing list while the job runs
+				job_id = await redis_conn.blmove(
+					REDIS_KEY_API_JOBS_QUEUE,
+					processing_key,
+					timeout=settings.JOBS_QUEUE_POLL_TIMEOUT,
+					src="RIGHT",
+					dest="LEFT",
+				)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f"Could not read the jobs queue: {e}")
+				await asyncio.sleep(settings.JOBS_QUEUE_POLL_TIMEOUT)
+				continue
+
+			if not job_id:
+				continue
+
+			job_id = job_id.decode()
+			try:
+				await run_job(redis_conn, job_id)
+			except asyncio.CancelledError:
+				# shutting down, the job goes back to the queue for another worker
+				pipeline = redis_conn.pipeline(transaction=True)
+				pipeline.hset(
+					_get_job_key(job_id), "status", JOB_STATUS_QUEUED
+				)
+				pipeline.lrem(processing_key, 1, job_id)
+				pipeline.rpush(REDIS_KEY_API_JOBS_QUEUE, job_id)
+				await pipeline.execute()
+				raise
+			except Exception as e:
+				logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+
+			try:
+				await redis_conn.lrem(processing_key, 1, job_id)
+			except Exception as e:
+				logger.error(f"Could not remove job {job_id} from {processing_key}: {e}")
+
+	async def _heartbeat(self, redis_conn: redis.Redis) -> None:
+		heartbeat_key = REDIS_KEY_API_JOBS_INSTANCE.format(
+			instance_id=self.instance_id
+		)
+		while True:
+			try:
+				await redis_conn.set(
+					heartbeat_key, 1, ex=settings.JOBS_WORKER_HEARTBEAT_TTL
+				)
+			except Exception as e:
+				logger.warning(f"Could not refresh the jobs heartbeat: {e}")
+			await asyncio.sleep(settings.JOBS_WORKER_HEARTBEAT_TTL / 3)
+
+	async def _reap(self, redis_conn: redis.Redis) -> None:
+		while True:
+			await asyncio.sleep(settings.JOBS_REAPER_INTERVAL)
+			try:
+				await reap_stale_jobs(redis_conn)
+			except Exception as e:
+				logger.error(f"Could not reap the stale jobs: {e}", exc_info=True)
+
+	def start(self, redis_conn: redis.Redis) -> None:
+		if not settings.JOBS_WORKERS:
+			return
+
+		# the heartbeat is sent before the workers take any job
+		self._tasks = [
+			asyncio.create_task(self._heartbeat(redis_conn)),
+			asyncio.create_task(self._reap(redis_conn)),
+		] + [
+			asyncio.create_task(self._work(redis_conn, index))
+			for index in range(settings.JOBS_WORKERS)
+		]
+
+	async def stop(self) -> None:
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+
+
+JOB_WORKERS = JobWorkers()
+
+
+def init_job_workers() -> None:
+	JOB_WORKERS.start(redis.Redis(connection_pool=init_redis_pool()))
+
+
+async def close_job_workers() -> None:
+	await JOB_WORKERS.stop()
@@ -0,0 +1,296 @@
+"""
+Metrics of the worker in the Prometheus text format, served on `/metrics`.
+
+Each collector returns the metric families it exports, they are read from the
+stats the modules already keep (ex: `get_upstream_health_stats`) when the
+endpoint is scraped. The values are per worker process.
+
+`RequestMetricsMiddleware` adds per endpoint histograms of the request latency,
+of the time spent in each phase (see `common.phase_timer`) and of the bytes in
+and out, plus the status codes returned by Cloud Run.
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, Union
+
+from core import settings
+from common.phase_timer import REQUEST_TIMINGS, RequestTimings
+from common.upstream_health import CIRCUIT_STATES, get_upstream_health_stats
+
+
+METRICS_PREFIX = "doodleops_"
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ({label: value}, sample value)
+Sample = tuple[dict, Union[int, float]]
+
+_COLLECTORS: list[Callable[[], list[str]]] = []
+
+
+def metrics_collector(func: Callable[[], list[str]]):
+	_COLLECTORS.append(func)
+	return func
+
+
+def _escape_label_value(value) -> str:
+	return (
+		str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+	)
+
+
+def format_labels(labels: dict) -> str:
+	if not labels:
+		return ""
+	return "{" + ",".join(
+		f'{k}="{_escape_label_value(v)}"' for k, v in labels.items()
+	) + "}"
+
+
+def format_metric(
+		name: str, metric_type: str, help_text: str, samples: Iterable[Sample]
+) -> str:
+	name = METRICS_PREFIX + name
+	lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+	lines.extend(
+		f"{name}{format_labels(labels)} {value}" for labels, value in samples
+	)
+	return "\n".join(lines)
+
+
+class Histogram:
+	"""Prometheus histogram, one set of buckets per label values tuple."""
+
+	def __init__(
+			self,
+			name: str,
+			help_text: str,
+			label_names: tuple[str, ...],
+			buckets: tuple[float, ...],
+	):
+		self.name = name
+		self.help_text = help_text
+		self.label_names = label_names
+		self.buckets = buckets
+		# label values: [count per bucket (the last one is +Inf), sum]
+		self._series: dict[tuple, list] = {}
+
+	def observe(self, label_values: tuple, value: Union[int, float]) -> None:
+		series = self._series.get(label_values)
+		if series is None:
+			series = self._series[label_values] = [
+				[0] * (len(self.buckets) + 1), 0
+			]
+		series[0][bisect_left(self.buckets, value)] += 1
+		series[1] += value
+
+	def collect(self) -> str:
+		name = METRICS_PREFIX + self.name
+		lines = [
+			f"# HELP {name} {self.help_text}", f"# TYPE {name} histogram"
+		]
+		# `/metrics` is rendered in a thread, copy what the event loop updates
+		for label_values, (counts, total) in list(self._series.items()):
+			labels = dict(zip(self.label_names, label_values))
+			cumulative = 0
+			for bound, count in zip(self.buckets + ("+Inf",), list(counts)):
+				cumulative += count
+				lines.append(
+					f"{name}_bucket{format_labels({**labels, 'le': bound})} "
+					f"{cumulative}"
+				)
+			lines.append(f"{name}_sum{format_labels(labels)} {total}")
+			lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+		return "\n".join(lines)
+
+
+class Counter:
+	def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]):
+		self.name = name
+		self.help_text = help_text
+		self.label_names = label_names
+		self._values: dict[tuple, int] = {}
+
+	def inc(self, label_values: tuple) -> None:
+		self._values[label_values] = self._values.get(label_values, 0) + 1
+
+	def collect(self) -> str:
+		return format_metric(
+			self.name, "counter", self.help_text,
+			[
+				(dict(zip(self.label_names, label_values)), value)
+				for label_values, value in list(self._values.items())
+			],
+		)
+
+
+LATENCY_BUCKETS = (
+	0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+	30, 60, 120, 300,
+)
+SIZE_BUCKETS = tuple(4**i * 1024 for i in range(10))  # 1 KiB to 256 GiB
+
+REQUEST_DURATION = Histogram(
+	"request_duration_seconds",
+	"Time from the first byte received to the last byte sent.",
+	("endpoint",), LATENCY_BUCKETS,
+)
+REQUEST_PHASE_DURATION = Histogram(
+	"request_phase_duration_seconds",
+	"Time spent in each phase of the request, see common.phase_timer.",
+	("endpoint", "phase"), LATENCY_BUCKETS,
+)
+REQUEST_SIZE = Histogram(
+	"request_size_bytes", "Request body bytes received.",
+	("endpoint",), SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+	"response_size_bytes", "Response body bytes sent.",
+	("endpoint",), SIZE_BUCKETS,
+)
+RESPONSES = Counter(
+	"responses_total", "Responses sent by the gateway.", ("endpoint", "status"),
+)
+UPSTREAM_RESPONSES = Counter(
+	"upstream_responses_total", "Status codes returned by Cloud Run.",
+	("endpoint", "status"),
+)
+
+# any other path (ex: scanners) is counted under this label
+OTHER_ENDPOINT = "other"
+
+
+class RequestMetricsMiddleware:
+	"""
+	ASGI middleware, added last so it is the outermost one and sees the whole
+	request. `is_known_endpoint` keeps the endpoint label to the paths of the
+	API (ex: `API_TOGGLE.is_allowed`).
+	"""
+
+	def __init__(self, app, is_known_endpoint: Callable[[str], bool]):
+		self.app = app
+		self.is_known_endpoint = is_known_endpoint
+
+	async def __call__(self, scope, receive, send):
+		if scope["type"] != "http":
+			return await self.app(scope, receive, send)
+
+		endpoint = scope["path"].replace(settings.FASTAPI_BASE_URL, "")
+		if not self.is_known_endpoint(endpoint):
+			endpoint = OTHER_ENDPOINT
+
+		timings = RequestTimings()
+		sizes = [0, 0]  # bytes in, bytes out
+		status = [None]
+
+		async def receive_counted():
+			message = await receive()
+			if message["type"] == "http.request":
+				sizes[0] += len(message.get("body", b""))
+			return message
+
+		async def send_counted(message):
+			if message["type"] == "http.response.start":
+				status[0] = message["status"]
+			elif message["type"] == "http.response.body":
+				sizes[1] += len(message.get("body", b""))
+			await send(message)
+
+		token = REQUEST_TIMINGS.set(timings)
+		start = time.perf_counter()
+		try:
+			await self.app(scope, receive_counted, send_counted)
+		finally:
+			REQUEST_TIMINGS.reset(token)
+			observe_request(
+				endpoint=endpoint,
+				seconds=time.perf_counter() - start,
+				timings=timings,
+				bytes_in=sizes[0],
+				bytes_out=sizes[1],
+				status=status[0],
+			)
+
+
+def observe_request(
+		endpoint: str,
+		seconds: float,
+		timings: RequestTimings,
+		bytes_in: int,
+		bytes_out: int,
+		status=None,
+) -> None:
+	label_values = (endpoint,)
+	REQUEST_DURATION.observe(label_values, seconds)
+	REQUEST_SIZE.observe(label_values, bytes_in)
+	RESPONSE_SIZE.observe(label_values, bytes_out)
+	# no status means the app raised before answering
+	RESPONSES.inc((endpoint, status or 500))
+	for phase, phase_seconds in timings.phases.items():
+		REQUEST_PHASE_DURATION.observe((endpoint, phase), phase_seconds)
+	if timings.upstream_status is not None:
+		UPSTREAM_RESPONSES.inc((endpoint, timings.upstream_status))
+
+
+def render_metrics() -> str:
+	return "\n".join(
+		family for collector in _COLLECTORS for family in collector()
+	) + "\n"
+
+
+@metrics_collector
+def collect_upstream_health() -> list[str]:
+	stats = get_upstream_health_stats()
+	families = [
+		format_metric(
+			"upstream_circuit_state", "gauge",
+			"1 for the current circuit breaker state of the Cloud Run target.",
+			[
+				({"target": target, "state": state}, int(s["state"] == state))
+				for target, s in stats.items()
+				for state in CIRCUIT_STATES
+			],
+		),
+		format_metric(
+			"upstream_retry_budget", "gauge",
+			"Retries and hedged requests the target can still use.",
+			[({"target": t}, s["retry_budget"]) for t, s in stats.items()],
+		),
+		format_metric(
+			"upstream_latency_p95_seconds", "gauge",
+			"p95 latency of the last successful calls, the hedging delay.",
+			[
+				({"target": t}, s["latency_p95_seconds"])
+				for t, s in stats.items()
+				if s["latency_p95_seconds"] is not None
+			],
+		),
+	]
+	for key, help_text in (
+			("requests_total", "Calls sent to the target."),
+			("failures_total", "Connection errors, timeouts and 429/5xx."),
+			("retries_total", "Calls retried after a failure."),
+			("hedges_total", "Hedged second requests sent."),
+			("hedge_wins_total", "Hedged requests that answered first."),
+			("rejected_total", "Calls failed fast by the open circuit."),
+	):
+		families.append(
+			format_metric(
+				f"upstream_{key}", "counter", help_text,
+				[({"target": t}, s[key]) for t, s in stats.items()],
+			)
+		)
+	return families
+
+
+@metrics_collector
+def collect_request_metrics() -> list[str]:
+	return [
+		metric.collect() for metric in (
+			REQUEST_DURATION,
+			REQUEST_PHASE_DURATION,
+			REQUEST_SIZE,
+			RESPONSE_SIZE,
+			RESPONSES,
+			UPSTREAM_RESPONSES,
+		)
+	]
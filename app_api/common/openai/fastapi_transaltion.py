@@ -1,16 +1,20 @@
 import re
 import uuid
+import asyncio
 import logging
-from io import BytesIO
-from urllib.parse import urljoin
+from typing import Optional
+from tempfile import SpooledTemporaryFile
 
 import httpx
-from google.cloud import storage
 from fastapi import Request, HTTPException
 from starlette.datastructures import Headers
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
-from core.settings import TEMP_API_FILES_BUCKET, BUKET_BASE_URL, ENV_MODE
+from core import settings
+from core.urls import urls
+from common.phase_timer import timed_phase
+from common.file_validation import FileSizeLimitExceeded, UploadSizeBudget
+from common.temp_bucket import upload_to_temp_bucket, get_temp_bucket_public_url
 
 
 logger = logging.getLogger("APP_API_"+__name__)
@@ -32,8 +36,51 @@ HEADERS = {
 			"Connection": "keep-alive",
 		}
 
+_DOWNLOAD_CLIENT: Optional[httpx.AsyncClient] = None
 
-async def download_file_from_request(file_ref: dict):
+
+class _DownloadCounter:
+	"""Bytes of one download, checked against the request's UploadSizeBudget."""
+
+	def __init__(self, budget: UploadSizeBudget):
+		self.bytes_read = 0
+		budget.readers.append(self)
+
+
+def get_download_client() -> httpx.AsyncClient:
+	"""One keep-alive client per worker, closed by the FastAPI lifespan."""
+	global _DOWNLOAD_CLIENT
+	if _DOWNLOAD_CLIENT is None or _DOWNLOAD_CLIENT.is_closed:
+		_DOWNLOAD_CLIENT = httpx.AsyncClient(
+			headers=HEADERS,
+			timeout=settings.OPENAI_FILE_DOWNLOAD_TIMEOUT,
+			limits=httpx.Limits(
+				max_connections=settings.OPENAI_FILE_DOWNLOAD_MAX_CONNECTIONS
+			),
+		)
+	return _DOWNLOAD_CLIENT
+
+
+async def close_download_client() -> None:
+	global _DOWNLOAD_CLIENT
+	if _DOWNLOAD_CLIENT is not None:
+		await _DOWNLOAD_CLIENT.aclose()
+		_DOWNLOAD_CLIENT = None
+
+
+def get_download_size_budget(api_name: str) -> UploadSizeBudget:
+	"""api_name: "app_pdf/v1/view_pdf_rotate", the limits of its endpoint."""
+	app_name, app_version, api = api_name.split("/")
+	return UploadSizeBudget.for_endpoint(urls[app_name][app_version][api].other)
+
+
+async def download_file_from_request(
+		file_ref: dict, budget: Optional[UploadSizeBudget] = None
+) -> StarletteUploadFile:
+	"""
+	The file is streamed to a spooled temporary file, the download stops with
+	a 413 as soon as the `budget` is exceeded.
+	"""
 	if "download_link" not in file_ref:
 		raise HTTPException(
 			status_code=400, detail="Invalid request, missing download_link."
@@ -43,34 +90,70 @@ async def download_file_from_request(file_ref: dict):
 			status_code=400, detail="Invalid request, missing file type."
 		)
 
-	async with httpx.AsyncClient(headers=HEADERS) as client:
-		response = await client.get(file_ref.get("download_link"))
-		response.raise_for_status()
-		pdf_content = response.content
-
-	if not pdf_content:
-		raise HTTPException(
-			status_code=400,
-			detail="Invalid request, could not download the file."
-		)
-
-	file_like = BytesIO(pdf_content)
+	budget = budget or UploadSizeBudget()
+	counter = _DownloadCounter(budget)
 	file = StarletteUploadFile(
+		file=SpooledTemporaryFile(max_size=settings.OPENAI_FILE_SPOOL_MAX_BYTES),
+		size=0,
 		filename=(
 			file_ref.get("name") if file_ref.get(
 				"name") else "uploaded.pdf"
 		),
-		file=file_like
+		headers=Headers({"content-type": file_ref.get("mime_type")}),
 	)
-	file.headers = Headers({"content-type": file_ref.get("mime_type")})
+	try:
+		async with get_download_client().stream(
+				"GET", str(file_ref.get("download_link"))
+		) as response:
+			response.raise_for_status()
+			content_length = response.headers.get("content-length", "")
+			if (
+					budget.max_bytes and content_length.isdigit() and
+					int(content_length) > budget.max_bytes
+			):
+				raise FileSizeLimitExceeded(
+					f"File too large. Max size is {budget.max_size_mb} MB."
+				)
+
+			async for chunk in response.aiter_bytes():
+				counter.bytes_read += len(chunk)
+				budget.check(counter)
+				await file.write(chunk)
+	except FileSizeLimitExceeded as e:
+		await file.close()
+		raise HTTPException(status_code=413, detail=str(e))
+	except BaseException:
+		await file.close()
+		raise
+
+	if not file.size:
+		await file.close()
+		raise HTTPException(
+			status_code=400,
+			detail="Invalid request, could not download the file."
+		)
 
+	await file.seek(0)
 	return file
 
 
+async def _close_downloads(tasks: list[asyncio.Task]) -> None:
+	for task in tasks:
+		task.cancel()
+	for result in await asyncio.gather(*tasks, return_exceptions=True):
+		if isinstance(result, StarletteUploadFile):
+			await result.close()
+
+
+@timed_phase("file_download")
 async def get_file_from_request(
 		request: Request, api_name: str, username: str = "unknown",
 		max_no_of_files: int = 1, min_no_of_files: int = 1
 ) -> list:
+	"""
+	The openaiFileIdRefs are downloaded at the same time, within the file size
+	limits of the `api_name` endpoint.
+	"""
 	req = await request.json()
 	if not req.get("openaiFileIdRefs"):
 		raise HTTPException(
@@ -93,12 +176,20 @@ async def get_file_from_request(
 			)
 		)
 
-	files = []
+	budget = get_download_size_budget(api_name)
+	tasks = [
+		asyncio.ensure_future(
+			download_file_from_request(file_ref=file_ref, budget=budget)
+		)
+		for file_ref in openai_field_refs
+	]
 	try:
-		for file_ref in openai_field_refs:
-			file = await download_file_from_request(file_ref=file_ref)
-			files.append(file)
+		files = await asyncio.gather(*tasks)
+	except HTTPException:
+		await _close_downloads(tasks)
+		raise
 	except Exception as error:
+		await _close_downloads(tasks)
 		logger.error(
 			f"User {username} encounter an error when calling "
 			f"API: {api_name}. Response: {error}."
@@ -108,7 +199,7 @@ async def get_file_from_request(
 			detail="Invalid request, could not download the file."
 		)
 
-	return files
+	return list(files)
 
 
 def sanitize_filename(filename: str) -> str:
@@ -118,9 +209,10 @@ def sanitize_filename(filename: str) -> str:
 	return filename_no_spaces
 
 
-def upload_resp_file_content_to_bucket(
+async def upload_resp_file_content_to_bucket(
 		resp_file_content, filename: str, content_type: str
 ) -> str:
+	"""The upload runs off the event loop, see `common.temp_bucket`."""
 	if not filename:
 		raise HTTPException(
 			status_code=400, detail="Invalid request, missing filename."
@@ -129,10 +221,10 @@ def upload_resp_file_content_to_bucket(
 	filename = sanitize_filename(filename)
 	blob_name = f"temp/{unique_id}/{filename}"
 
-	if ENV_MODE != "local":
-		storage_client = storage.Client()
-		bucket = storage_client.bucket(TEMP_API_FILES_BUCKET)
-		blob = bucket.blob(blob_name)
-		blob.upload_from_string(resp_file_content, content_type=content_type)
+	await upload_to_temp_bucket(
+		content=resp_file_content,
+		blob_name=blob_name,
+		content_type=content_type,
+	)
 
-	return urljoin(BUKET_BASE_URL, blob_name)
+	return get_temp_bucket_public_url(blob_name)
@@ -0,0 +1,106 @@
+"""
+The OpenAPI documents are built from `app.openapi()` once per worker, in the
+FastAPI lifespan, and served as pre-serialized bytes with an ETag so that
+clients polling them (ex: the OpenAI GPT actions) get a 304 back.
+
+A variant is a function that receives the full schema and returns the
+document to serve, register it with `@openapi_variant(name)`. The variants
+must not modify the full schema, use `filter_openapi_schema`.
+"""
+import copy
+import json
+import hashlib
+from typing import Callable, NamedTuple
+
+from fastapi import FastAPI, Request, Response
+
+from core import settings
+from common.other import clean_openapi_schemas
+
+
+class CachedDocument(NamedTuple):
+	body: bytes
+	etag: str
+
+
+# {name: function(full schema) -> variant schema}
+OPENAPI_VARIANT_BUILDERS: dict[str, Callable[[dict], dict]] = {}
+# {name: variant schema}
+OPENAPI_VARIANTS: dict[str, dict] = {}
+# {name: serialized variant}
+OPENAPI_DOCUMENTS: dict[str, CachedDocument] = {}
+
+
+def openapi_variant(name: str):
+	def decorator(builder: Callable[[dict], dict]):
+		OPENAPI_VARIANT_BUILDERS[name] = builder
+		return builder
+	return decorator
+
+
+def serialize_document(content: dict) -> CachedDocument:
+	# same output as JSONResponse
+	body = json.dumps(
+		content,
+		ensure_ascii=False,
+		allow_nan=False,
+		indent=None,
+		separators=(",", ":"),
+	).encode("utf-8")
+	return CachedDocument(
+		body=body, etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+	)
+
+
+def filter_openapi_schema(openapi_schema: dict, filtered_paths: dict) -> dict:
+	"""
+	Returns a copy of the schema with only `filtered_paths` and the component
+	schemas they reference.
+	"""
+	filtered_schema = copy.deepcopy({**openapi_schema, "paths": filtered_paths})
+	if "schemas" in filtered_schema.get("components", {}):
+		filtered_schema["components"]["schemas"] = clean_openapi_schemas(
+			openapi_schema=filtered_schema,
+			filtered_paths=filtered_schema["paths"],
+		)
+	return filtered_schema
+
+
+def build_openapi_documents(app: FastAPI) -> None:
+	openapi_schema = app.openapi()
+	for name, builder in OPENAPI_VARIANT_BUILDERS.items():
+		OPENAPI_VARIANTS[name] = builder(openapi_schema)
+		OPENAPI_DOCUMENTS[name] = serialize_document(OPENAPI_VARIANTS[name])
+
+
+def get_openapi_variant(app: FastAPI, name: str) -> dict:
+	"""Do not modify the returned schema, it is shared by all requests."""
+	if name not in OPENAPI_VARIANTS:
+		build_openapi_documents(app)
+	return OPENAPI_VARIANTS[name]
+
+
+def get_openapi_document(app: FastAPI, name: str) -> CachedDocument:
+	if name not in OPENAPI_DOCUMENTS:
+		build_openapi_documents(app)
+	return OPENAPI_DOCUMENTS[name]
+
+
+def document_response(request: Request, document: CachedDocument) -> Response:
+	headers = {
+		"ETag": document.etag,
+		"Cache-Control": f"public, max-age={settings.OPENAPI_CACHE_MAX_AGE}",
+	}
+	if_none_match = request.headers.get("If-None-Match")
+	if if_none_match:
+		etags = {
+			etag.strip().removeprefix("W/") for etag in if_none_match.split(",")
+		}
+		if "*" in etags or document.etag in etags:
+			return Response(status_code=304, headers=headers)
+
+	return Response(
+		content=document.body,
+		media_type="application/json",
+		headers=headers,
+	)
@@ -0,0 +1,54 @@
+"""
+Time spent in each phase of a request (auth, API call slot, file download,
+file validation, cost setup, Cloud Run call, cost teardown), collected by
+`common.metrics.RequestMetricsMiddleware`.
+
+The shared helpers are decorated with `@timed_phase(name)`, the durations are
+added to the `RequestTimings` of the request in the REQUEST_TIMINGS context
+variable. Outside a request (ex: async jobs) there is nothing to record and
+the decorator only costs a context variable lookup.
+"""
+import time
+import functools
+from typing import Optional
+from contextvars import ContextVar
+
+
+class RequestTimings:
+	__slots__ = ("phases", "upstream_status")
+
+	def __init__(self):
+		self.phases: dict[str, float] = {}
+		self.upstream_status: Optional[int] = None
+
+	def add(self, phase: str, seconds: float) -> None:
+		self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+REQUEST_TIMINGS: ContextVar[Optional[RequestTimings]] = ContextVar(
+	"REQUEST_TIMINGS", default=None
+)
+
+
+def timed_phase(phase: str):
+	"""Decorator for the async functions that make a phase of the request."""
+	def decorator(func):
+		@functools.wraps(func)
+		async def wrapper(*args, **kwargs):
+			timings = REQUEST_TIMINGS.get()
+			if timings is None:
+				return await func(*args, **kwargs)
+
+			start = time.perf_counter()
+			try:
+				return await func(*args, **kwargs)
+			finally:
+				timings.add(phase, time.perf_counter() - start)
+		return wrapper
+	return decorator
+
+
+def record_upstream_status(status_code: int) -> None:
+	timings = REQUEST_TIMINGS.get()
+	if timings is not None:
+		timings.upstream_status = status_code
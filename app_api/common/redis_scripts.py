@@ -0,0 +1,199 @@
+"""
+Lua scripts used only by App_API, the ones shared with the AI container live
+in `app_ai.cloud_run_container_app_ai.v1.common.redis_scripts`.
+"""
+from app_ai.cloud_run_container_app_ai.v1.common.redis_scripts import (
+	CREDIT_LEDGER_FOLD_LEGACY_LUA,
+)
+
+"""
+Takes one of the user's API call slots (a semaphore with leases).
+KEYS[1] slots sorted set {owner: lease expiry in ms},
+KEYS[2] metered subscription flag, KEYS[3] has active subscription flag.
+ARGV[1] owner token, ARGV[2] lease in ms, ARGV[3] slots without a
+subscription, ARGV[4] slots with a subscription, ARGV[5] slots with a
+metered subscription.
+Returns 1 if a slot was taken, 0 if all of them are in use.
+"""
+API_CALL_SLOT_ACQUIRE_LUA = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+-- leases of calls that crashed without releasing their slot
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+
+local slots = tonumber(ARGV[3])
+if redis.call("EXISTS", KEYS[2]) == 1 then
+	slots = tonumber(ARGV[5])
+elseif tonumber(redis.call("GET", KEYS[3]) or "0") ~= 0 then
+	slots = tonumber(ARGV[4])
+end
+
+if redis.call("ZCARD", KEYS[1]) >= slots then
+	return 0
+end
+
+redis.call("ZADD", KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+redis.call("PEXPIRE", KEYS[1], ARGV[2])
+return 1
+"""
+
+"""
+Extends the lease of an API call slot that is still held.
+KEYS[1] slots sorted set, ARGV[1] owner token, ARGV[2] lease in ms.
+Returns 1 if the lease was extended, 0 if the slot was already freed.
+"""
+API_CALL_SLOT_RENEW_LUA = """
+if not redis.call("ZSCORE", KEYS[1], ARGV[1]) then
+	return 0
+end
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+redis.call("ZADD", KEYS[1], "XX", now + tonumber(ARGV[2]), ARGV[1])
+redis.call("PEXPIRE", KEYS[1], ARGV[2])
+return 1
+"""
+
+"""
+GCRA rate limiter, a token bucket holding `limit` requests that refills at
+`limit` requests per `period`.
+KEYS[1] theoretical arrival time (ms), KEYS[2] metered subscription flag,
+KEYS[3] has active subscription flag.
+ARGV[1] period in ms, ARGV[2] limit without a subscription, ARGV[3] limit
+with a subscription, ARGV[4] limit with a metered subscription.
+Returns {allowed (1/0), limit, remaining, ms until the bucket is full,
+ms until the next request is allowed}
+"""
+RATE_LIMIT_GCRA_LUA = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local period = tonumber(ARGV[1])
+
+local limit = tonumber(ARGV[2])
+if redis.call("EXISTS", KEYS[2]) == 1 then
+	limit = tonumber(ARGV[4])
+elseif tonumber(redis.call("GET", KEYS[3]) or "0") ~= 0 then
+	limit = tonumber(ARGV[3])
+end
+
+local interval = period / limit
+local tat = math.max(tonumber(redis.call("GET", KEYS[1]) or now), now)
+local new_tat = tat + interval
+
+-- the times are rounded up to at least 1 ms: with a high limit the interval
+-- is lost in the precision of `now` and "PX 0" is an error
+local reset = math.max(1, math.ceil(new_tat - now))
+
+-- the bucket is empty, the request would arrive before it is allowed
+if new_tat - period > now then
+	return {
+		0, limit, 0, math.max(1, math.ceil(tat - now)),
+		math.max(1, math.ceil(new_tat - period - now)),
+	}
+end
+
+redis.call("SET", KEYS[1], string.format("%.3f", new_tat), "PX", reset)
+local remaining = math.floor((now + period - new_tat) / interval)
+return {1, limit, remaining, reset, 0}
+"""
+
+"""
+Checks and debits the user's credits in one step, for the calls that are
+charged up front (async jobs, batches). The bought credits are taken oldest
+purchase first, then the subscription credits while the subscription is
+active. KEYS as for CREDIT_LEDGER_BALANCE_LUA, ARGV[1] credits.
+Returns what was taken as a flat list {ledger id or "subscription", credits,
+...}, for CREDIT_REFUND_LUA, or 0 if the user doesn't have enough credits, in
+which case nothing was debited.
+"""
+CREDIT_RESERVE_LUA = CREDIT_LEDGER_FOLD_LEGACY_LUA + """
+fold_legacy_credits(KEYS[1], false)
+
+local remaining = tonumber(ARGV[1])
+
+local entries = {}
+local available = 0
+local flat = redis.call("HGETALL", KEYS[1])
+for i = 1, #flat, 2 do
+	entries[#entries + 1] = {flat[i], tonumber(flat[i + 1])}
+	available = available + tonumber(flat[i + 1])
+end
+table.sort(entries, function(a, b)
+	return tonumber(a[1]) < tonumber(b[1])
+end)
+
+local subscription = 0
+if tonumber(redis.call("GET", KEYS[3]) or "0") ~= 0 then
+	subscription = tonumber(redis.call("GET", KEYS[2]) or "0")
+end
+
+if available + subscription < remaining then
+	return 0
+end
+
+local taken = {}
+for _, entry in ipairs(entries) do
+	if remaining <= 0 then
+		break
+	end
+	local credits = math.min(entry[2], remaining)
+	if credits == entry[2] then
+		redis.call("HDEL", KEYS[1], entry[1])
+	else
+		redis.call("HINCRBY", KEYS[1], entry[1], -credits)
+	end
+	taken[#taken + 1] = entry[1]
+	taken[#taken + 1] = credits
+	remaining = remaining - credits
+end
+
+if remaining > 0 then
+	redis.call("DECRBY", KEYS[2], remaining)
+	taken[#taken + 1] = "subscription"
+	taken[#taken + 1] = remaining
+end
+
+return taken
+"""
+
+"""
+Gives back part of the credits taken by CREDIT_RESERVE_LUA, the last ones
+taken first (the subscription credits, then the newest purchase).
+KEYS[1] credit ledger, KEYS[2] subscription monthly credits remaining.
+ARGV[1] credits to give back, ARGV[2..] the list returned by the reservation.
+Returns the credits given back.
+"""
+CREDIT_REFUND_LUA = """
+local remaining = tonumber(ARGV[1])
+local refunded = 0
+
+for i = #ARGV - 1, 2, -2 do
+	if remaining <= 0 then
+		break
+	end
+	local credits = math.min(tonumber(ARGV[i + 1]), remaining)
+	if ARGV[i] == "subscription" then
+		redis.call("INCRBY", KEYS[2], credits)
+	else
+		redis.call("HINCRBY", KEYS[1], ARGV[i], credits)
+	end
+	remaining = remaining - credits
+	refunded = refunded + credits
+end
+
+return refunded
+"""
+
+"""
+Releases a lock only if it is still held by its owner, a lock that expired and
+was taken by another call is left alone.
+KEYS[1] lock, ARGV[1] owner token.
+Returns 1 if the lock was released.
+"""
+LOCK_RELEASE_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+	return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
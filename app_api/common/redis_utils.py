@@ -1,44 +1,167 @@
+import json
 import time
+import uuid
+import asyncio
+import inspect
 import logging
-from typing import Union
+from contextvars import ContextVar
+from typing import Union, Optional, Callable, Awaitable
 
 import redis.asyncio as redis
+from redis.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.commands.core import AsyncScript
 from fastapi import HTTPException, status
 
 from core import settings
+from common.phase_timer import timed_phase
+from schemas.billing import BillingContext
 from schemas.redis_db import (
 	REDIS_KEY_TTL_MAX,
 	REDIS_KEY_API_COST,
 	REDIS_KEY_LLM_COST,
-	REDIS_KEY_USER_API_CALLS_LOG,
+	REDIS_CHANNEL_COST_UPDATES,
+	REDIS_KEY_USER_API_CALLS_STREAM,
 	REDIS_KEY_USER_API_DAILY_CALLS,
-	REDIS_USER_API_CALL_LOCK,
-	REDIS_KEY_USER_CREDIT_BOUGHT,
+	REDIS_KEY_USER_API_CALL_SLOTS,
+	REDIS_KEY_USER_CREDIT_LEDGER,
 	REDIS_KEY_USER_API_DAILY_CALL_LIMIT,
 	REDIS_KEY_METERED_SUBSCRIPTION_USERS,
 	REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
 	REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER,
+	REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER,
+	REDIS_KEY_CREDITS_USED_PER_DAY_USERS,
+	REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER,
+	REDIS_CREDITS_USED_TIMELINE_MEMBER,
 	REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
 	REDIS_KEY_WHATSAPP_MSG_PER_MINUTE_RATE,
 	REDIS_KEY_WHATSAPP_MSG_PER_HOUR_RATE,
+	CREDIT_LEDGER_BALANCE_LUA,
+	CREDIT_LEDGER_DEBIT_LUA,
 )
 from common.other import generate_random_chars
+from common.redis_scripts import (
+	API_CALL_SLOT_ACQUIRE_LUA, API_CALL_SLOT_RENEW_LUA, CREDIT_RESERVE_LUA,
+	CREDIT_REFUND_LUA,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+class MeteredBlockingConnectionPool(redis.BlockingConnectionPool):
+	"""
+	BlockingConnectionPool that keeps track of how saturated the pool is.
+	A checkout "waits" when all `max_connections` are in use and it "times out"
+	when no connection was released in `timeout` seconds.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.checkouts = 0
+		self.waits = 0
+		self.timeouts = 0
+		self.peak_in_use = 0
+
+	async def get_connection(self, command_name, *keys, **options):
+		self.checkouts += 1
+		if not self.can_get_connection():
+			self.waits += 1
+			logger.warning(
+				f"Redis pool saturated ({self.max_connections} connections in "
+				f"use), waiting for a free connection."
+			)
+		try:
+			connection = await super().get_connection(
+				command_name, *keys, **options
+			)
+		except redis.ConnectionError as e:
+			if isinstance(e.__cause__, asyncio.TimeoutError):
+				self.timeouts += 1
+			raise e
+
+		self.peak_in_use = max(self.peak_in_use, len(self._in_use_connections))
+		return connection
+
+
+REDIS_POOL: Union[MeteredBlockingConnectionPool, None] = None
+# Lua source -> AsyncScript, the SHA is computed once and EVALSHA is used
+REDIS_SCRIPTS: dict[str, AsyncScript] = {}
+# (username, api_name, owner token, lease renewal task) of the API call slot
+# taken by the current request, each request runs in its own context
+API_CALL_SLOT: ContextVar[
+	Optional[tuple[str, str, str, asyncio.Task]]
+] = ContextVar("API_CALL_SLOT", default=None)
+# seconds between two tries while waiting for a free API call slot
+API_CALL_SLOT_POLL_INTERVAL = 0.1
+
+
+def init_redis_pool() -> MeteredBlockingConnectionPool:
+	"""
+	Creates the process-wide connection pool, it is called from the FastAPI
+	lifespan but also lazily by `get_redis_conn` in case the lifespan did not run.
+	"""
+	global REDIS_POOL
+	if REDIS_POOL is None:
+		REDIS_POOL = MeteredBlockingConnectionPool(
+			host=settings.REDIS_HOST,
+			port=settings.REDIS_PORT,
+			db=settings.REDIS_DB_DEFAULT,
+			max_connections=settings.REDIS_MAX_CONNECTIONS,
+			timeout=settings.REDIS_POOL_TIMEOUT,
+			socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+			socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+			socket_keepalive=True,
+			health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+			retry_on_timeout=True,
+			retry=Retry(
+				backoff=ExponentialBackoff(cap=0.5, base=0.05),
+				retries=settings.REDIS_RETRY_ATTEMPTS,
+			),
+		)
+	return REDIS_POOL
+
+
+async def close_redis_pool() -> None:
+	global REDIS_POOL
+	if REDIS_POOL is not None:
+		await REDIS_POOL.aclose()
+		REDIS_POOL = None
+
+
+def get_redis_pool_stats() -> dict:
+	if REDIS_POOL is None:
+		return {}
+
+	in_use = len(REDIS_POOL._in_use_connections)
+	return {
+		"max_connections": REDIS_POOL.max_connections,
+		"in_use_connections": in_use,
+		"idle_connections": len(REDIS_POOL._available_connections),
+		"peak_in_use_connections": REDIS_POOL.peak_in_use,
+		"saturation": round(in_use / REDIS_POOL.max_connections, 4),
+		"checkouts_total": REDIS_POOL.checkouts,
+		"checkout_waits_total": REDIS_POOL.waits,
+		"checkout_timeouts_total": REDIS_POOL.timeouts,
+	}
+
+
 async def get_redis_conn():
-	redis_conn = redis.Redis(
-		host=settings.REDIS_HOST,
-		port=settings.REDIS_PORT,
-		db=settings.REDIS_DB_DEFAULT,
-	)
-	try:
-		yield redis_conn
-	finally:
-		await redis_conn.close()
-		await redis_conn.connection_pool.disconnect()
+	"""
+	The client is bound to the shared pool, connections go back to the pool
+	after each command so there is nothing to close per request.
+	"""
+	yield redis.Redis(connection_pool=init_redis_pool())
+
+
+def get_redis_script(redis_conn: redis.Redis, lua: str) -> AsyncScript:
+	"""
+	Scripts are registered once per worker. Pass `client=redis_conn` when
+	calling them, they fall back to SCRIPT LOAD if Redis doesn't know the SHA.
+	"""
+	if lua not in REDIS_SCRIPTS:
+		REDIS_SCRIPTS[lua] = redis_conn.register_script(lua)
+	return REDIS_SCRIPTS[lua]
 
 
 async def get_redis_key_value(
@@ -57,96 +180,165 @@ async def count_matching_keys(redis_conn: redis.Redis, key_pattern: str):
 	return total_keys
 
 
-async def log_api_call(
-	redis_conn: redis.Redis,
+def queue_api_call_log(
+	pipeline: redis.client.Pipeline,
 	timestamp: int,
 	current_date: str,
 	username: str,
 	api_name: str,
 	success: bool = False,
 ) -> None:
-	await redis_conn.incr(
-		name=REDIS_KEY_USER_API_DAILY_CALLS.format(
-			username=username,
-			date=current_date,
-		),
-		amount=1,
+	"""Adds the commands of `log_api_call` to `pipeline`."""
+	daily_calls_key = REDIS_KEY_USER_API_DAILY_CALLS.format(
+		username=username,
+		date=current_date,
+	)
+	calls_stream_key = REDIS_KEY_USER_API_CALLS_STREAM.format(
+		username=username,
+		date=current_date,
 	)
 
+	pipeline.incr(name=daily_calls_key, amount=1)
 	# we need to set the TTL again, because incr resets it
-	await redis_conn.expire(
-		name=REDIS_KEY_USER_API_DAILY_CALLS.format(
-			date=current_date,
-			username=username,
-		),
-		time=REDIS_KEY_TTL_MAX,
+	pipeline.expire(name=daily_calls_key, time=REDIS_KEY_TTL_MAX)
+	pipeline.xadd(
+		name=calls_stream_key,
+		fields={
+			"api_name": api_name,
+			"timestamp": str(timestamp),
+			"success": int(success),
+		},
+		maxlen=settings.API_CALLS_STREAM_MAX_LEN,
+		approximate=True,
 	)
+	pipeline.expire(name=calls_stream_key, time=REDIS_KEY_TTL_MAX)
 
-	await redis_conn.set(
-		name=REDIS_KEY_USER_API_CALLS_LOG.format(
-			username=username,
-			timestamp=str(timestamp),
-			api_name=api_name,
-		),
-		value=int(success),
-		ex=REDIS_KEY_TTL_MAX,
+
+async def log_api_call(
+	redis_conn: redis.Redis,
+	timestamp: int,
+	current_date: str,
+	username: str,
+	api_name: str,
+	success: bool = False,
+) -> None:
+	"""
+	Increments the daily calls and appends the call to the user's daily calls
+	stream (capped at about API_CALLS_STREAM_MAX_LEN entries) in one round trip.
+	"""
+	pipeline = redis_conn.pipeline(transaction=False)
+	queue_api_call_log(
+		pipeline=pipeline,
+		timestamp=timestamp,
+		current_date=current_date,
+		username=username,
+		api_name=api_name,
+		success=success,
 	)
+	await pipeline.execute()
 
 
-async def sum_user_credits_bought(redis_conn: redis.Redis, username: str) -> int:
-	total_credits_bought = 0
-	truncated_key = (
-		REDIS_KEY_USER_CREDIT_BOUGHT.rpartition(":")[0].format(username=username)
-		+ ":*"
-	)  # wildcard to match all keys
+def _credit_ledger_keys(username: str) -> list[str]:
+	return [
+		REDIS_KEY_USER_CREDIT_LEDGER.format(username=username),
+		REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(username=username),
+		REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=username),
+	]
 
-	async for key in redis_conn.scan_iter(match=truncated_key):
-		purchase_value = await redis_conn.get(key)
-		if purchase_value is not None:
-			total_credits_bought += int(purchase_value)
 
-	return total_credits_bought
+async def get_user_credit_balance(
+	redis_conn: redis.Redis, username: str
+) -> tuple[int, int]:
+	"""
+	Returns (credits bought remaining, subscription monthly credits remaining)
+	in a single round trip. Subscription credits are 0 without an active
+	subscription.
+	"""
+	balance_script = get_redis_script(redis_conn, CREDIT_LEDGER_BALANCE_LUA)
+	credits_bought, subscription_credits = await balance_script(
+		keys=_credit_ledger_keys(username), client=redis_conn
+	)
+	return int(credits_bought), int(subscription_credits)
 
 
 async def decrement_user_bought_credits(
 	redis_conn: redis.Redis,
 	username: str,
 	api_cost: int,
-):
+	fallback_to_subscription: bool = False,
+	overdraw_subscription: bool = False,
+) -> int:
 	"""
 	This function will decrement the user's bought credits by the api_cost
-	amount. If the user has enough credits, it will decrement the credits
-	and return 0. If the user doesn't have enough credits, it will return
-	the remaining number of credits that the user needs to pay.
+	amount, oldest purchase first. If the user has enough credits, it will
+	decrement the credits and return 0. If the user doesn't have enough credits,
+	it will return the remaining number of credits that the user needs to pay.
+	With `fallback_to_subscription` the remainder is taken from the monthly
+	subscription credits in the same atomic script, with `overdraw_subscription`
+	all of it, even if they go below 0.
 	"""
-
-	key_pattern = REDIS_KEY_USER_CREDIT_BOUGHT.format(
-		username=username,
-		id="*",
-	)
-
-	keys = [key async for key in redis_conn.scan_iter(match=key_pattern)]
-	sorted_keys = sorted(
-		# sort keys based on 'id'
-		keys, key=lambda k: int(k.decode("utf-8").split(":")[-1])
+	debit_script = get_redis_script(redis_conn, CREDIT_LEDGER_DEBIT_LUA)
+	return int(
+		await debit_script(
+			keys=_credit_ledger_keys(username),
+			args=[
+				api_cost, 1, int(fallback_to_subscription), 0,
+				int(overdraw_subscription),
+			],
+			client=redis_conn,
+		)
 	)
 
-	for key in sorted_keys:
-		current_key_value = int(await redis_conn.get(key))
 
-		if current_key_value > api_cost:
-			await redis_conn.decr(key, api_cost)
-			return 0
-		else:
-			# if the current key value is less than the api_cost
-			# decrement the api_cost and delete the key
-			api_cost -= current_key_value
-			await redis_conn.delete(key)
+def queue_credits_used_log(
+	pipeline: redis.client.Pipeline,
+	username: str,
+	api_name: str,
+	api_cost: int,
+	current_date: str,
+	timestamp: int,
+) -> None:
+	"""Adds the commands of `log_credits_used_per_api_endpoint_by_user`."""
+	random_char = generate_random_chars()
+
+	if settings.REDIS_USAGE_COUNTERS_MODE in ("legacy", "dual"):
+		pipeline.set(
+			name=REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.format(
+				date=current_date,
+				username=username,
+				api_name=api_name,
+				timestamp=timestamp,
+				random_char=random_char,
+			),
+			value=api_cost,
+			ex=REDIS_KEY_TTL_MAX,
+		)
 
-			if api_cost <= 0:
-				return 0
+	if settings.REDIS_USAGE_COUNTERS_MODE in ("dual", "counters"):
+		day_key = REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER.format(
+			username=username, date=current_date
+		)
+		users_key = REDIS_KEY_CREDITS_USED_PER_DAY_USERS.format(date=current_date)
+		timeline_key = REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER.format(
+			username=username, date=current_date
+		)
+		pipeline.hincrby(day_key, f"{api_name}:credits", api_cost)
+		pipeline.hincrby(day_key, f"{api_name}:calls", 1)
+		pipeline.sadd(users_key, username)
+		pipeline.zadd(
+			timeline_key,
+			{
+				REDIS_CREDITS_USED_TIMELINE_MEMBER.format(
+					timestamp=timestamp,
+					api_name=api_name,
+					credits=api_cost,
+					random_char=random_char,
+				): timestamp
+			},
+		)
+		for key in (day_key, users_key, timeline_key):
+			pipeline.expire(key, REDIS_KEY_TTL_MAX)
 
-	return api_cost
 
 
 async def log_credits_used_per_api_endpoint_by_user(
@@ -157,123 +349,286 @@ async def log_credits_used_per_api_endpoint_by_user(
 	current_date: str,
 	timestamp: int,
 ):
-	key = REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.format(
-		date=current_date,
+	"""
+	Depending on `REDIS_USAGE_COUNTERS_MODE` stores one legacy key per call
+	and/or increments the per day counters of the user, in one transaction.
+	"""
+	pipeline = redis_conn.pipeline(transaction=True)
+	queue_credits_used_log(
+		pipeline=pipeline,
 		username=username,
 		api_name=api_name,
+		api_cost=api_cost,
+		current_date=current_date,
 		timestamp=timestamp,
-		random_char=generate_random_chars(),
-	)
-	await redis_conn.set(
-		name=key,
-		value=api_cost,
-		ex=REDIS_KEY_TTL_MAX,
 	)
+	await pipeline.execute()
+
+
+async def listen_to_channel(
+	redis_conn: redis.Redis,
+	channel: str,
+	on_message: Callable[[bytes], Union[None, Awaitable[None]]],
+	on_subscribe: Callable[[], Awaitable[None]],
+) -> None:
+	"""
+	Calls `on_message` with the data of every message published on `channel`
+	until it is cancelled, resubscribing if the connection drops. Messages
+	published while we were not subscribed are lost, so `on_subscribe` is
+	awaited after every (re)subscribe to load the full state.
+	"""
+	while True:
+		pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+		try:
+			await pubsub.subscribe(channel)
+			await on_subscribe()
+			while True:
+				message = await pubsub.get_message(
+					ignore_subscribe_messages=True, timeout=1.0
+				)
+				if message and message["type"] == "message":
+					result = on_message(message["data"])
+					if inspect.isawaitable(result):
+						await result
+		except asyncio.CancelledError:
+			raise
+		except Exception as e:
+			logger.error(f"Subscription to `{channel}` failed, retrying: {e}")
+			await asyncio.sleep(1)
+		finally:
+			await pubsub.aclose()
+
+
+class CostCache:
+	"""
+	In-process copy of the `api_cost:*` and `llm_cost:*` keys so that requests
+	don't go to Redis for cost lookups. It is loaded at startup, updated by the
+	messages Django publishes on REDIS_CHANNEL_COST_UPDATES when an `API` or a
+	`CostOfLLMAppAI` is saved or deleted, and fully reloaded every
+	COST_CACHE_REFRESH_INTERVAL seconds in case a message was missed.
+	"""
+
+	def __init__(self):
+		self.api_costs: dict[str, int] = {}
+		self.llm_costs: dict[str, int] = {}
+		self.loaded_at: float = 0
+		self._tasks: list[asyncio.Task] = []
+
+	@staticmethod
+	async def _load_costs(
+		redis_conn: redis.Redis, key_pattern: str
+	) -> dict[str, int]:
+		keys = [
+			key async for key in redis_conn.scan_iter(match=key_pattern, count=1000)
+		]
+		if not keys:
+			return {}
+
+		costs = {}
+		for key, value in zip(keys, await redis_conn.mget(keys)):
+			if value is None or not value.isdigit():
+				logger.error(f"Redis key `{key.decode()}` has no valid cost.")
+				continue
+			costs[key.decode().split(":", 1)[1]] = int(value)
+		return costs
+
+	async def load(self, redis_conn: redis.Redis) -> None:
+		self.api_costs = await self._load_costs(
+			redis_conn, REDIS_KEY_API_COST.format(api_name="*")
+		)
+		self.llm_costs = await self._load_costs(
+			redis_conn, REDIS_KEY_LLM_COST.format(name="*")
+		)
+		self.loaded_at = time.monotonic()
+
+	def apply_update(self, data: Union[bytes, str]) -> None:
+		"""data: {"table": "api_cost" | "llm_cost", "name": str, "cost": int | null}"""
+		update = json.loads(data)
+		costs = {"api_cost": self.api_costs, "llm_cost": self.llm_costs}[
+			update["table"]
+		]
+		if update.get("cost") is None:
+			costs.pop(update["name"], None)
+		else:
+			costs[update["name"]] = int(update["cost"])
+
+	async def _listen(self, redis_conn: redis.Redis) -> None:
+		await listen_to_channel(
+			redis_conn=redis_conn,
+			channel=REDIS_CHANNEL_COST_UPDATES,
+			on_message=self.apply_update,
+			on_subscribe=lambda: self.load(redis_conn),
+		)
+
+	async def _refresh(self, redis_conn: redis.Redis) -> None:
+		while True:
+			await asyncio.sleep(settings.COST_CACHE_REFRESH_INTERVAL)
+			try:
+				await self.load(redis_conn)
+			except Exception as e:
+				logger.error(f"Could not refresh the cost cache: {e}")
+
+	async def start(self, redis_conn: redis.Redis) -> None:
+		try:
+			await self.load(redis_conn)
+		except Exception as e:
+			logger.error(f"Could not load the cost cache: {e}")
+
+		self._tasks = [
+			asyncio.create_task(self._listen(redis_conn)),
+			asyncio.create_task(self._refresh(redis_conn)),
+		]
+
+	async def stop(self) -> None:
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks = []
+
+
+COST_CACHE = CostCache()
+
+
+async def init_cost_cache() -> None:
+	await COST_CACHE.start(redis.Redis(connection_pool=init_redis_pool()))
+
+
+async def close_cost_cache() -> None:
+	await COST_CACHE.stop()
 
 
 async def get_api_cost(
 	redis_conn: redis.Redis, api_name: str
 ) -> Union[int, None]:
+	api_cost = COST_CACHE.api_costs.get(api_name)
+	if api_cost is not None:
+		return api_cost
+
+	# the cache was not loaded or the API was added after the last update
 	api_cost = await redis_conn.get(REDIS_KEY_API_COST.format(api_name=api_name))
 
 	if not api_cost:
 		return None
 
-	return int(api_cost.decode())
+	COST_CACHE.api_costs[api_name] = int(api_cost.decode())
+	return COST_CACHE.api_costs[api_name]
+
+
+async def get_billing_context(
+	redis_conn: redis.Redis,
+	username: str,
+	api_name: str,
+	current_date: str,
+) -> BillingContext:
+	"""
+	Reads the daily call limit and usage, the metered flag and the user's
+	credits in a single pipelined round trip, the API cost comes from the
+	`COST_CACHE`. The `check_*` functions below evaluate the snapshot locally
+	when it is passed to them.
+	"""
+	api_cost = await get_api_cost(redis_conn=redis_conn, api_name=api_name)
+
+	pipeline = redis_conn.pipeline(transaction=False)
+	pipeline.get(REDIS_KEY_USER_API_DAILY_CALL_LIMIT.format(username=username))
+	pipeline.get(
+		REDIS_KEY_USER_API_DAILY_CALLS.format(
+			username=username,
+			date=current_date,
+		)
+	)
+	pipeline.get(REDIS_KEY_METERED_SUBSCRIPTION_USERS.format(username=username))
+	pipeline.hvals(REDIS_KEY_USER_CREDIT_LEDGER.format(username=username))
+	pipeline.get(REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=username))
+	pipeline.get(
+		REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(username=username)
+	)
+	(
+		api_daily_call_limit,
+		api_daily_calls,
+		is_metered,
+		credits_bought,
+		has_active_sub,
+		subscriptions_monthly_credit_remaining,
+	) = await pipeline.execute()
+
+	return BillingContext(
+		api_cost=api_cost,
+		api_daily_call_limit=(
+			int(api_daily_call_limit) if api_daily_call_limit else None
+		),
+		api_daily_calls=int(api_daily_calls) if api_daily_calls else 0,
+		is_metered=bool(is_metered),
+		credits_bought_remaining=sum(int(x) for x in credits_bought),
+		subscriptions_monthly_credit_remaining=(
+			int(subscriptions_monthly_credit_remaining)
+			if has_active_sub and int(has_active_sub)
+			and subscriptions_monthly_credit_remaining
+			else 0
+		),
+	)
 
 
 async def get_all_llm_costs(redis_conn: redis.Redis) -> dict:
-	llm_costs_keys = [
-		k.decode()
-		for k in await redis_conn.keys(REDIS_KEY_LLM_COST.format(name="*"))
-	]
-	if not llm_costs_keys:
-		return {}
+	if not COST_CACHE.loaded_at:
+		await COST_CACHE.load(redis_conn)
 
-	# for each key, get the value
-	llm_costs = {}
-	for key in llm_costs_keys:
-		# make sure that the value is an integer
-		value = int(await redis_conn.get(key))
-		llm_costs[key.split(":")[-1]] = value
-	return llm_costs
+	return dict(COST_CACHE.llm_costs)
 
 
 async def check_if_user_has_exceeded_daily_api_call_limit(
 	redis_conn: redis.Redis,
 	username: str,
 	current_date: str,
+	billing_context: Optional[BillingContext] = None,
+	calls: int = 1,
 ) -> None:
-	user_api_daily_call_limit = await redis_conn.get(
-		name=REDIS_KEY_USER_API_DAILY_CALL_LIMIT.format(username=username)
-	)
+	"""`calls` is the number of API calls about to be made (ex: a batch)."""
+	if billing_context:
+		user_api_daily_call_limit = billing_context.api_daily_call_limit
+		user_api_daily_calls = billing_context.api_daily_calls
+	else:
+		user_api_daily_call_limit, user_api_daily_calls = await redis_conn.mget(
+			REDIS_KEY_USER_API_DAILY_CALL_LIMIT.format(username=username),
+			REDIS_KEY_USER_API_DAILY_CALLS.format(
+				username=username,
+				date=current_date,
+			),
+		)
 
 	if not user_api_daily_call_limit:
 		logger.error(f"Daily API call limit not found for user {username}.")
 		raise HTTPException(status_code=500, detail="Something went wrong.")
 
-	user_api_daily_calls = await redis_conn.get(
-		name=REDIS_KEY_USER_API_DAILY_CALLS.format(
-			username=username,
-			date=current_date,
-		)
-	)
-
-	if user_api_daily_calls and (
-		int(user_api_daily_calls.decode())
-		>= int(user_api_daily_call_limit.decode())
-	):
+	if int(user_api_daily_calls or 0) + calls > int(user_api_daily_call_limit):
 		logger.info(f"Daily API calls exceeded by user {username}.")
 		raise HTTPException(status_code=401, detail="Daily API calls exceeded.")
-	
-	
-async def get_user_subscriptions_monthly_credit_remaining(
-	redis_conn: redis.Redis, username: str
-) -> int:
-	has_active_sub = await redis_conn.get(
-		REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=username)
-	)
-	
-	has_active_sub = int(has_active_sub.decode()) if has_active_sub else 0
-	if not has_active_sub:
-		return 0
-	
-	subscriptions_monthly_credit_remaining = await redis_conn.get(
-		REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
-			username=username
-		)
-	)
-	subscriptions_monthly_credit_remaining = (
-		int(subscriptions_monthly_credit_remaining.decode())
-		if subscriptions_monthly_credit_remaining
-		else 0
-	)
-	return subscriptions_monthly_credit_remaining
 
 
 async def check_if_user_has_enough_credits(
-	redis_conn: redis.Redis, username: str, api_cost: int
+	redis_conn: redis.Redis,
+	username: str,
+	api_cost: int,
+	billing_context: Optional[BillingContext] = None,
 ):
 	"""
 	How it works, main steps:
-	1. Check if the user has an active subscription
-	2. If the user has an active subscription, check if the user has enough
-		monthly credits remaining
-	3. If the user doesn't have an active subscription, check if the user has
-		enough bought credits
-	4. If the user has enough credits, decrement the credits
-	5. If the user doesn't have enough credits, raise an HTTPException
-	"""
-	credits_bought_remaining = await sum_user_credits_bought(
-		redis_conn=redis_conn,
-		username=username,
-	)
-	subscriptions_monthly_credit_remaining = (
-		await get_user_subscriptions_monthly_credit_remaining(
-			redis_conn=redis_conn,
-			username=username,
+	1. Sum the bought credits left in the user's credit ledger
+	2. If the user has an active subscription, add the monthly credits remaining
+	3. If the user doesn't have enough credits, raise an HTTPException
+	Without a `billing_context` the balance is read with one Lua script, the
+	credits are decremented later by `update_user_credits`.
+	"""
+	if billing_context:
+		credits_bought_remaining = billing_context.credits_bought_remaining
+		subscriptions_monthly_credit_remaining = (
+			billing_context.subscriptions_monthly_credit_remaining
+		)
+	else:
+		credits_bought_remaining, subscriptions_monthly_credit_remaining = (
+			await get_user_credit_balance(
+				redis_conn=redis_conn, username=username
+			)
 		)
-	)
 
 	if api_cost > (
 		subscriptions_monthly_credit_remaining + credits_bought_remaining
@@ -284,8 +639,13 @@ async def check_if_user_has_enough_credits(
 
 
 async def check_if_user_has_metered_subscription(
-	redis_conn: redis.Redis, username: str
+	redis_conn: redis.Redis,
+	username: str,
+	billing_context: Optional[BillingContext] = None,
 ) -> bool:
+	if billing_context:
+		return billing_context.is_metered
+
 	has_metered_subscription = await redis_conn.get(
 		REDIS_KEY_METERED_SUBSCRIPTION_USERS.format(username=username)
 	)
@@ -300,44 +660,132 @@ async def update_user_credits(
 	redis_conn: redis.Redis,
 	api_cost: int,
 ) -> None:
-	remaining_api_cost = await decrement_user_bought_credits(
+	# can do this because we already checked if the user has enough credits
+	# with `check_if_user_has_enough_credits`, if the balance changed in between
+	# the subscription credits go below 0 and the next calls are refused
+	await decrement_user_bought_credits(
 		redis_conn=redis_conn,
 		username=username,
 		api_cost=api_cost,
+		fallback_to_subscription=True,
+		overdraw_subscription=True,
+	)
+
+
+async def reserve_user_credits(
+	redis_conn: redis.Redis, username: str, credits: int
+) -> list[str]:
+	"""
+	Debits `credits` up front for the calls that are billed later (async jobs,
+	batches), the check and the debit are one script so concurrent calls can't
+	spend the same credits. Raises a 401 if the user doesn't have them.
+	Returns the reservation, what to give back from with `refund_user_credits`.
+	"""
+	if credits <= 0:
+		return []
+
+	reserve_script = get_redis_script(redis_conn, CREDIT_RESERVE_LUA)
+	taken = await reserve_script(
+		keys=_credit_ledger_keys(username), args=[credits], client=redis_conn
 	)
+	if not taken:
+		raise HTTPException(
+			status_code=401, detail=settings.NOT_ENOUGH_CREDITS_MSG
+		)
+	return [
+		value.decode() if isinstance(value, bytes) else str(value)
+		for value in taken
+	]
 
-	if remaining_api_cost == 0:
+
+def get_reserved_credits(reservation: list[str]) -> int:
+	return sum(int(credits) for credits in reservation[1::2])
+
+
+async def refund_user_credits(
+	redis_conn: redis.Redis,
+	username: str,
+	credits: int,
+	reservation: list[str],
+) -> None:
+	"""Gives back the `credits` of a reservation that were not used."""
+	credits = min(credits, get_reserved_credits(reservation))
+	if credits <= 0:
 		return
 
-	# can do this because we already checked if the user has enough credits
-	# with `check_if_user_has_enough_credits`
-	await redis_conn.decr(
-		name=REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
-			username=username
-		),
-		amount=remaining_api_cost,
+	refund_script = get_redis_script(redis_conn, CREDIT_REFUND_LUA)
+	await refund_script(
+		keys=_credit_ledger_keys(username)[:2],
+		args=[credits, *reservation],
+		client=redis_conn,
 	)
 
 
+async def _renew_api_call_slot(
+	redis_conn: redis.Redis, username: str, owner: str
+) -> None:
+	"""
+	Extends the lease of the slot every third of USER_API_CALL_SLOT_LEASE until
+	it is released (the task is cancelled), so a call that runs longer than the
+	lease keeps its slot.
+	"""
+	renew_slot = get_redis_script(redis_conn, API_CALL_SLOT_RENEW_LUA)
+	deadline = time.monotonic() + settings.USER_API_CALL_SLOT_MAX_HOLD
+	while time.monotonic() < deadline:
+		await asyncio.sleep(settings.USER_API_CALL_SLOT_LEASE / 3)
+		try:
+			if not await renew_slot(
+				keys=[REDIS_KEY_USER_API_CALL_SLOTS.format(username=username)],
+				args=[owner, settings.USER_API_CALL_SLOT_LEASE * 1000],
+				client=redis_conn,
+			):
+				return
+		except Exception as e:
+			logger.warning(f"Could not renew the API call slot {owner}: {e}")
+
+	logger.warning(
+		f"API call slot {owner} of user {username} held for more than "
+		f"{settings.USER_API_CALL_SLOT_MAX_HOLD} seconds, it is no longer renewed."
+	)
+
+
+@timed_phase("api_call_slot")
 async def set_user_api_call_lock(
 	redis_conn: redis.Redis, username: str, api_name: str
 ) -> None:
-	redis_user_lock_key = REDIS_USER_API_CALL_LOCK.format(
-		username=username,
-	)
+	"""
+	Takes one of the user's API call slots (USER_API_CALL_SLOTS* by plan),
+	waiting up to USER_API_CALL_SLOT_WAIT seconds for one to be released,
+	otherwise raises a 429. The slot is leased for USER_API_CALL_SLOT_LEASE
+	seconds, renewed while the call runs, and remembered in the request's
+	context for `release_user_api_call_lock`.
+	"""
+	owner = f"{api_name}:{uuid.uuid4().hex}"
+	acquire_slot = get_redis_script(redis_conn, API_CALL_SLOT_ACQUIRE_LUA)
+	deadline = time.monotonic() + settings.USER_API_CALL_SLOT_WAIT
 
 	try:
-		if await redis_conn.get(redis_user_lock_key):
-			raise HTTPException(
-				status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-				detail="Too many requests.",
-			)
-
-		await redis_conn.set(
-			name=redis_user_lock_key,
-			value=api_name,
-			ex=30,
-		)
+		while not await acquire_slot(
+			keys=[
+				REDIS_KEY_USER_API_CALL_SLOTS.format(username=username),
+				REDIS_KEY_METERED_SUBSCRIPTION_USERS.format(username=username),
+				REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=username),
+			],
+			args=[
+				owner,
+				settings.USER_API_CALL_SLOT_LEASE * 1000,
+				settings.USER_API_CALL_SLOTS,
+				settings.USER_API_CALL_SLOTS_SUBSCRIPTION,
+				settings.USER_API_CALL_SLOTS_METERED,
+			],
+			client=redis_conn,
+		):
+			if time.monotonic() >= deadline:
+				raise HTTPException(
+					status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+					detail="Too many requests.",
+				)
+			await asyncio.sleep(API_CALL_SLOT_POLL_INTERVAL)
 	except HTTPException as e:
 		raise e
 	except Exception as e:
@@ -347,17 +795,28 @@ async def set_user_api_call_lock(
 			detail="Something went wrong.",
 		)
 
+	API_CALL_SLOT.set((
+		username, api_name, owner,
+		asyncio.create_task(_renew_api_call_slot(redis_conn, username, owner)),
+	))
+
 
 async def release_user_api_call_lock(
 	redis_conn: redis.Redis, username: str, api_name: str
 ) -> None:
-	redis_user_lock_key = REDIS_USER_API_CALL_LOCK.format(
-		username=username,
-	)
+	"""
+	Frees the slot taken by this request, if `set_user_api_call_lock` failed
+	there is nothing to release.
+	"""
+	slot = API_CALL_SLOT.get()
+	if not slot or slot[:2] != (username, api_name):
+		return
 
-	redis_api_name = await redis_conn.get(redis_user_lock_key)
-	if redis_api_name and redis_api_name.decode() == api_name:
-		await redis_conn.delete(redis_user_lock_key)
+	API_CALL_SLOT.set(None)
+	slot[3].cancel()
+	await redis_conn.zrem(
+		REDIS_KEY_USER_API_CALL_SLOTS.format(username=username), slot[2]
+	)
 
 
 async def rate_limit_twilio_whatsapp_msg(
@@ -0,0 +1,215 @@
+"""
+Cache of the upstream results of the deterministic endpoints, the ones with
+`other["cache"] = True` (the output only depends on the files and the params).
+
+The key is the SHA-256 of the cache version (RESULT_CACHE_VERSION, by default
+the App_API VERSION, so a release starts with an empty cache), the target URL
+(it has the API version), the canonical params / form data and the files
+(name, content type and content).
+A hit is returned by `async_request` without calling the Cloud Run target, the
+views bill it like any other call.
+
+Backends (RESULT_CACHE_BACKEND):
+- "disk": files in RESULT_CACHE_DIR shared by the workers of an instance, the
+  least recently used are removed above RESULT_CACHE_MAX_BYTES;
+- "bucket": the temp bucket, its lifecycle rule removes the old entries;
+- "": no cache, the default.
+Entries older than RESULT_CACHE_TTL are ignored by both.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+from pathlib import Path
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from core import settings
+from common.temp_bucket import upload_to_temp_bucket, download_from_temp_bucket
+
+
+logger = logging.getLogger("APP_API_"+__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+CACHE_VERSION = settings.RESULT_CACHE_VERSION or (
+	Path(__file__).resolve().parents[1] / "VERSION"
+).read_text().strip()
+
+# (status code 200) body, headers
+CachedResult = tuple[bytes, dict]
+
+
+def _hash_fileobj(fileobj) -> str:
+	"""Reads the file from the start and rewinds it for the upload."""
+	digest = hashlib.sha256()
+	fileobj.seek(0)
+	while chunk := fileobj.read(HASH_CHUNK_SIZE):
+		digest.update(chunk)
+	fileobj.seek(0)
+	return digest.hexdigest()
+
+
+async def get_result_cache_key(
+		url: str,
+		files: list[tuple[str, str, str, object]],
+		params: Optional[dict] = None,
+		data: Optional[dict] = None,
+		json_body: Optional[dict] = None,
+) -> str:
+	"""files: [(field name, filename, content type, bytes or file object)]"""
+	file_keys = []
+	for field_name, filename, content_type, content in files:
+		if isinstance(content, (bytes, str)):
+			content_hash = hashlib.sha256(
+				content.encode() if isinstance(content, str) else content
+			).hexdigest()
+		else:
+			content_hash = await run_in_threadpool(_hash_fileobj, content)
+		file_keys.append([field_name, filename, content_type, content_hash])
+
+	request_key = json.dumps(
+		{
+			"version": CACHE_VERSION,
+			"url": url,
+			"params": params or {},
+			"data": data or {},
+			"json": json_body or {},
+			"files": file_keys,
+		},
+		sort_keys=True,
+		default=str,
+	)
+	return hashlib.sha256(request_key.encode()).hexdigest()
+
+
+def _pack(body: bytes, headers: dict) -> bytes:
+	meta = json.dumps({"created_at": time.time(), "headers": headers})
+	return meta.encode() + b"\n" + body
+
+
+def _unpack(packed: bytes) -> Optional[CachedResult]:
+	meta, body = packed.split(b"\n", 1)
+	meta = json.loads(meta)
+	if time.time() - meta["created_at"] > settings.RESULT_CACHE_TTL:
+		return None
+	return body, meta["headers"]
+
+
+class DiskResultCache:
+	"""
+	One file per entry, written atomically so the workers of the instance can
+	share the directory. The mtime is the last use, before this worker writes
+	more than a tenth of the size limit `_evict` removes the oldest entries to
+	make room, the directory stays below the limit (per worker writing).
+	"""
+
+	def __init__(self, cache_dir: str, max_bytes: int):
+		self.cache_dir = Path(cache_dir)
+		self.max_bytes = max_bytes
+		self._written_bytes = 0
+
+	def _get_path(self, key: str) -> Path:
+		return self.cache_dir / key[:2] / key
+
+	def _get(self, key: str) -> Optional[CachedResult]:
+		path = self._get_path(key)
+		try:
+			cached = _unpack(path.read_bytes())
+			if cached is None:
+				path.unlink(missing_ok=True)
+			else:
+				os.utime(path)
+			return cached
+		except FileNotFoundError:
+			return None
+
+	def _set(self, key: str, packed: bytes) -> None:
+		if self._written_bytes + len(packed) > self.max_bytes // 10:
+			self._written_bytes = 0
+			self._evict(len(packed))
+		self._written_bytes += len(packed)
+
+		path = self._get_path(key)
+		os.makedirs(path.parent, exist_ok=True)
+		tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+		tmp_path.write_bytes(packed)
+		os.replace(tmp_path, path)
+
+	def _evict(self, incoming_bytes: int = 0) -> None:
+		entries = []
+		for path in self.cache_dir.glob("*/*"):
+			try:
+				stat = path.stat()
+			except FileNotFoundError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+
+		# down to 90% with the new entry, the next tenth is written without
+		# listing the directory again
+		total_bytes = sum(size for _, size, _ in entries) + incoming_bytes
+		for _, size, path in sorted(entries):
+			if total_bytes <= self.max_bytes * 0.9:
+				break
+			path.unlink(missing_ok=True)
+			total_bytes -= size
+
+	async def get(self, key: str) -> Optional[CachedResult]:
+		return await run_in_threadpool(self._get, key)
+
+	async def set(self, key: str, body: bytes, headers: dict) -> None:
+		await run_in_threadpool(self._set, key, _pack(body, headers))
+
+
+class BucketResultCache:
+	@staticmethod
+	def _get_blob_name(key: str) -> str:
+		return f"result_cache/{key}"
+
+	async def get(self, key: str) -> Optional[CachedResult]:
+		try:
+			packed = await download_from_temp_bucket(self._get_blob_name(key))
+		except Exception:  # not found
+			return None
+		return _unpack(packed)
+
+	async def set(self, key: str, body: bytes, headers: dict) -> None:
+		await upload_to_temp_bucket(
+			content=_pack(body, headers),
+			blob_name=self._get_blob_name(key),
+			content_type="application/octet-stream",
+		)
+
+
+def _build_result_cache():
+	if settings.RESULT_CACHE_BACKEND == "disk":
+		return DiskResultCache(
+			cache_dir=settings.RESULT_CACHE_DIR,
+			max_bytes=settings.RESULT_CACHE_MAX_BYTES,
+		)
+	elif settings.RESULT_CACHE_BACKEND == "bucket":
+		return BucketResultCache()
+	return None
+
+
+RESULT_CACHE = _build_result_cache()
+
+
+async def get_cached_result(key: str) -> Optional[CachedResult]:
+	if RESULT_CACHE is None:
+		return None
+	try:
+		return await RESULT_CACHE.get(key)
+	except Exception as e:
+		logger.error(f"Could not read the result cache: {e}")
+		return None
+
+
+async def set_cached_result(key: str, body: bytes, headers: dict) -> None:
+	if RESULT_CACHE is None or len(body) > settings.RESULT_CACHE_MAX_ITEM_BYTES:
+		return
+	try:
+		await RESULT_CACHE.set(key, body, headers)
+	except Exception as e:
+		logger.error(f"Could not write the result cache: {e}")
@@ -0,0 +1,301 @@
+"""
+Files kept for a while for the users (ex: the result of an async job) live in
+the TEMP_API_FILES_BUCKET.
+
+Backends (TEMP_API_FILES_BACKEND):
+- "gcs": the bucket, with the instance credentials (ADC). The service account
+  key is only used to sign the URLs. The Google Cloud Storage client is
+  blocking, so the calls run in the thread pool. Files of
+  TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD bytes or more (up to
+  TEMP_API_FILES_PARALLEL_UPLOAD_MAX_BYTES) are uploaded in chunks sent at the
+  same time;
+- "local": files in TEMP_API_FILES_LOCAL_DIR, the default in local mode and
+  for the benchmarks.
+
+The big files (the inputs and results of the jobs) are not loaded in memory:
+`upload_file_to_temp_bucket` and `download_file_from_temp_bucket` copy them
+from and to file objects, `upload_stream_to_temp_bucket` uploads the chunks of
+a response as they arrive, in TEMP_API_FILES_UPLOAD_CHUNK_SIZE parts.
+
+The signed URLs are reused while they are valid for at least half of
+TEMP_API_FILES_SIGNED_URL_EXPIRATION, a job polled every second is signed once.
+"""
+import io
+import os
+import time
+import shutil
+import logging
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Optional, Union
+from urllib.parse import urljoin
+
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
+from google.oauth2.service_account import Credentials
+from starlette.concurrency import run_in_threadpool
+
+from core import settings
+
+
+logger = logging.getLogger("APP_API_"+__name__)
+
+# {blob name: (signed URL, reuse it until this time.time())}
+_SIGNED_URLS: dict[str, tuple[str, float]] = {}
+SIGNED_URLS_MAX_SIZE = 10000
+
+
+def _get_file_size(fileobj: BinaryIO) -> int:
+	"""Bytes left to read, the position is kept."""
+	position = fileobj.tell()
+	size = fileobj.seek(0, os.SEEK_END) - position
+	fileobj.seek(position)
+	return size
+
+
+class LocalTempStorage:
+	def __init__(self, local_dir: str):
+		self.root = Path(local_dir).resolve()
+
+	def _get_path(self, blob_name: str) -> Path:
+		path = (self.root / blob_name).resolve()
+		if self.root not in path.parents:
+			raise ValueError(f"Invalid blob name: {blob_name}")
+		return path
+
+	def upload(self, content: bytes, blob_name: str, content_type: str) -> None:
+		path = self._get_path(blob_name)
+		os.makedirs(path.parent, exist_ok=True)
+		path.write_bytes(content)
+
+	def upload_file(
+			self, fileobj: BinaryIO, blob_name: str, content_type: str
+	) -> None:
+		with self.open_writer(blob_name, content_type) as f:
+			shutil.copyfileobj(fileobj, f)
+
+	def open_writer(self, blob_name: str, content_type: str) -> BinaryIO:
+		path = self._get_path(blob_name)
+		os.makedirs(path.parent, exist_ok=True)
+		return open(path, "wb")
+
+	def abort_writer(self, writer: BinaryIO, blob_name: str) -> None:
+		writer.close()
+		self.delete(blob_name)
+
+	def download(self, blob_name: str) -> bytes:
+		return self._get_path(blob_name).read_bytes()
+
+	def download_to_file(self, blob_name: str, fileobj: BinaryIO) -> None:
+		with open(self._get_path(blob_name), "rb") as f:
+			shutil.copyfileobj(f, fileobj)
+
+	def delete(self, blob_name: str) -> None:
+		self._get_path(blob_name).unlink(missing_ok=True)
+
+	def get_signed_url(self, blob_name: str) -> str:
+		return self._get_path(blob_name).as_uri()
+
+
+class GCSTempStorage:
+	def __init__(self, bucket_name: str):
+		self.bucket_name = bucket_name
+		self._client: Optional[storage.Client] = None
+		self._signing_credentials: Optional[Credentials] = None
+
+	def _get_bucket(self) -> storage.Bucket:
+		if self._client is None:
+			self._client = storage.Client()
+		return self._client.bucket(self.bucket_name)
+
+	def _get_signing_credentials(self) -> Credentials:
+		# the instance credentials have no private key to sign the URLs with
+		if self._signing_credentials is None:
+			self._signing_credentials = Credentials.from_service_account_info(
+				settings.GCF_SERVICE_ACCOUNT_JSON
+			)
+		return self._signing_credentials
+
+	@staticmethod
+	def _is_parallel_upload(size: int) -> bool:
+		return (
+			settings.TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD
+			<= size
+			<= settings.TEMP_API_FILES_PARALLEL_UPLOAD_MAX_BYTES
+		)
+
+	@staticmethod
+	def _upload_chunks_concurrently(
+			fileobj: BinaryIO, blob: storage.Blob, content_type: str
+	) -> None:
+		# the chunks are uploaded from a file, each worker reads its own part.
+		# On Cloud Run /tmp is in memory, the file is a second copy
+		with tempfile.NamedTemporaryFile() as f:
+			shutil.copyfileobj(fileobj, f)
+			f.flush()
+			transfer_manager.upload_chunks_concurrently(
+				f.name,
+				blob,
+				content_type=content_type,
+				chunk_size=settings.TEMP_API_FILES_UPLOAD_CHUNK_SIZE,
+				max_workers=settings.TEMP_API_FILES_UPLOAD_WORKERS,
+				worker_type=transfer_manager.THREAD,
+			)
+
+	def upload(self, content: bytes, blob_name: str, content_type: str) -> None:
+		blob = self._get_bucket().blob(blob_name)
+		if self._is_parallel_upload(len(content)):
+			self._upload_chunks_concurrently(
+				io.BytesIO(content), blob, content_type
+			)
+		else:
+			blob.upload_from_string(content, content_type=content_type)
+
+	def upload_file(
+			self, fileobj: BinaryIO, blob_name: str, content_type: str
+	) -> None:
+		"""Above 8 MB a resumable upload, one chunk in memory at a time."""
+		blob = self._get_bucket().blob(
+			blob_name, chunk_size=settings.TEMP_API_FILES_UPLOAD_CHUNK_SIZE
+		)
+		size = _get_file_size(fileobj)
+		if self._is_parallel_upload(size):
+			self._upload_chunks_concurrently(fileobj, blob, content_type)
+		else:
+			blob.upload_from_file(fileobj, size=size, content_type=content_type)
+
+	def open_writer(self, blob_name: str, content_type: str) -> BinaryIO:
+		return self._get_bucket().blob(blob_name).open(
+			"wb",
+			chunk_size=settings.TEMP_API_FILES_UPLOAD_CHUNK_SIZE,
+			content_type=content_type,
+		)
+
+	def abort_writer(self, writer: BinaryIO, blob_name: str) -> None:
+		# the resumable upload is never finalized, so no object is created
+		pass
+
+	def download(self, blob_name: str) -> bytes:
+		return self._get_bucket().blob(blob_name).download_as_bytes()
+
+	def download_to_file(self, blob_name: str, fileobj: BinaryIO) -> None:
+		self._get_bucket().blob(blob_name).download_to_file(fileobj)
+
+	def delete(self, blob_name: str) -> None:
+		self._get_bucket().blob(blob_name).delete()
+
+	def get_signed_url(self, blob_name: str) -> str:
+		return self._get_bucket().blob(blob_name).generate_signed_url(
+			version="v4",
+			expiration=timedelta(
+				seconds=settings.TEMP_API_FILES_SIGNED_URL_EXPIRATION
+			),
+			method="GET",
+			credentials=self._get_signing_credentials(),
+		)
+
+
+_STORAGE: Optional[Union[LocalTempStorage, GCSTempStorage]] = None
+
+
+def get_temp_storage() -> Union[LocalTempStorage, GCSTempStorage]:
+	global _STORAGE
+	if _STORAGE is None:
+		if settings.TEMP_API_FILES_BACKEND == "local":
+			_STORAGE = LocalTempStorage(settings.TEMP_API_FILES_LOCAL_DIR)
+		elif settings.TEMP_API_FILES_BACKEND == "gcs":
+			_STORAGE = GCSTempStorage(settings.TEMP_API_FILES_BUCKET)
+		else:
+			raise ValueError(
+				f"Unknown TEMP_API_FILES_BACKEND "
+				f"`{settings.TEMP_API_FILES_BACKEND}`"
+			)
+	return _STORAGE
+
+
+async def upload_to_temp_bucket(
+		content: bytes, blob_name: str, content_type: str
+) -> None:
+	await run_in_threadpool(
+		get_temp_storage().upload, content, blob_name, content_type
+	)
+
+
+async def upload_file_to_temp_bucket(
+		fileobj: BinaryIO, blob_name: str, content_type: str
+) -> None:
+	"""Uploads the rest of `fileobj`, read in chunks."""
+	await run_in_threadpool(
+		get_temp_storage().upload_file, fileobj, blob_name, content_type
+	)
+
+
+async def upload_stream_to_temp_bucket(
+		chunks: AsyncIterator[bytes], blob_name: str, content_type: str
+) -> None:
+	"""
+	Uploads the chunks as they arrive, about TEMP_API_FILES_UPLOAD_CHUNK_SIZE
+	bytes are buffered. Nothing is stored if `chunks` fails.
+	"""
+	temp_storage = get_temp_storage()
+	writer = await run_in_threadpool(
+		temp_storage.open_writer, blob_name, content_type
+	)
+	buffer = bytearray()
+	try:
+		async for chunk in chunks:
+			buffer += chunk
+			if len(buffer) >= settings.TEMP_API_FILES_UPLOAD_CHUNK_SIZE:
+				await run_in_threadpool(writer.write, buffer)
+				buffer.clear()
+		await run_in_threadpool(writer.write, buffer)
+		await run_in_threadpool(writer.close)
+	except BaseException:
+		await run_in_threadpool(temp_storage.abort_writer, writer, blob_name)
+		raise
+
+
+async def download_from_temp_bucket(blob_name: str) -> bytes:
+	return await run_in_threadpool(get_temp_storage().download, blob_name)
+
+
+async def download_file_from_temp_bucket(
+		blob_name: str, fileobj: BinaryIO
+) -> None:
+	"""Writes the file to `fileobj` in chunks."""
+	await run_in_threadpool(
+		get_temp_storage().download_to_file, blob_name, fileobj
+	)
+
+
+async def delete_from_temp_bucket(blob_name: str) -> None:
+	_SIGNED_URLS.pop(blob_name, None)
+	await run_in_threadpool(get_temp_storage().delete, blob_name)
+
+
+async def get_temp_bucket_signed_url(blob_name: str) -> str:
+	cached = _SIGNED_URLS.get(blob_name)
+	if cached is not None and cached[1] > time.time():
+		return cached[0]
+
+	signed_url = await run_in_threadpool(
+		get_temp_storage().get_signed_url, blob_name
+	)
+	if len(_SIGNED_URLS) >= SIGNED_URLS_MAX_SIZE:
+		now = time.time()
+		for key, (_, reuse_until) in list(_SIGNED_URLS.items()):
+			if reuse_until <= now:
+				_SIGNED_URLS.pop(key, None)
+		if len(_SIGNED_URLS) >= SIGNED_URLS_MAX_SIZE:
+			_SIGNED_URLS.clear()
+	_SIGNED_URLS[blob_name] = (
+		signed_url,
+		time.time() + settings.TEMP_API_FILES_SIGNED_URL_EXPIRATION / 2,
+	)
+	return signed_url
+
+
+def get_temp_bucket_public_url(blob_name: str) -> str:
+	"""The file's link through BUKET_BASE_URL, as given to the OpenAI GPTs."""
+	return urljoin(settings.BUKET_BASE_URL, blob_name)
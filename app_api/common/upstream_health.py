@@ -0,0 +1,170 @@
+"""
+Per worker health of the Cloud Run targets, used by `async_request`.
+
+- Circuit breaker: after CLOUD_RUN_BREAKER_FAILURES failures in a row the
+  target is "open" and the calls fail fast with a 503 for
+  CLOUD_RUN_BREAKER_OPEN_SECONDS. It is then "half_open": one probe call goes
+  through, it closes the circuit if it succeeds or opens it again if not.
+- Retry budget: the retries (and hedged requests) of a target can't be more
+  than about CLOUD_RUN_RETRY_BUDGET_RATIO of its calls, so the retries don't
+  pile up on a target that is already overloaded.
+- Latency: the p95 of the last successful calls, the delay before a hedged
+  request is sent.
+
+A failure is a connection error, a timeout or a 429/502/503/504 response, the
+other status codes come from the container itself so it is up.
+"""
+import math
+import time
+import random
+from collections import deque
+from http import HTTPStatus
+from typing import Optional
+
+from core import settings
+
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+CIRCUIT_STATES = (CLOSED, HALF_OPEN, OPEN)
+
+FAILURE_STATUS_CODES = {
+	HTTPStatus.TOO_MANY_REQUESTS.value,
+	HTTPStatus.BAD_GATEWAY.value,
+	HTTPStatus.SERVICE_UNAVAILABLE.value,
+	HTTPStatus.GATEWAY_TIMEOUT.value,
+}
+LATENCY_SAMPLES = 200
+
+
+class UpstreamHealth:
+	def __init__(self, target: str):
+		self.target = target
+		self.state = CLOSED
+		self.consecutive_failures = 0
+		self.opened_at = 0.0
+		self.probe_in_flight = False
+		self.retry_tokens = float(settings.CLOUD_RUN_RETRY_BUDGET_MAX)
+		self._latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+
+		self.requests = 0
+		self.failures = 0
+		self.retries = 0
+		self.hedges = 0
+		self.hedge_wins = 0
+		self.rejected = 0
+
+	def allow_request(self) -> bool:
+		"""False if the call should fail fast, the circuit is open."""
+		if self.state == OPEN:
+			if time.monotonic() - self.opened_at < (
+					settings.CLOUD_RUN_BREAKER_OPEN_SECONDS
+			):
+				self.rejected += 1
+				return False
+			self.state = HALF_OPEN
+
+		if self.state == HALF_OPEN:
+			if self.probe_in_flight:
+				self.rejected += 1
+				return False
+			self.probe_in_flight = True
+
+		self.requests += 1
+		self.retry_tokens = min(
+			self.retry_tokens + settings.CLOUD_RUN_RETRY_BUDGET_RATIO,
+			settings.CLOUD_RUN_RETRY_BUDGET_MAX,
+		)
+		return True
+
+	def retry_after(self) -> int:
+		"""Seconds until the circuit lets a probe through."""
+		return max(
+			1,
+			math.ceil(
+				self.opened_at + settings.CLOUD_RUN_BREAKER_OPEN_SECONDS
+				- time.monotonic()
+			),
+		)
+
+	def record_success(self, latency: float) -> None:
+		self._latencies.append(latency)
+		self.consecutive_failures = 0
+		self.probe_in_flight = False
+		self.state = CLOSED
+
+	def record_failure(self) -> None:
+		self.failures += 1
+		self.consecutive_failures += 1
+		self.probe_in_flight = False
+		if (
+				self.state == HALF_OPEN or
+				self.consecutive_failures >= settings.CLOUD_RUN_BREAKER_FAILURES
+		):
+			self.state = OPEN
+			self.opened_at = time.monotonic()
+
+	def end_call(self) -> None:
+		"""A half-open probe that ended without a result (ex: cancelled)."""
+		self.probe_in_flight = False
+
+	def take_retry_token(self) -> bool:
+		if self.state != CLOSED or self.retry_tokens < 1:
+			return False
+		self.retry_tokens -= 1
+		return True
+
+	def get_retry_delay(self, attempt: int) -> float:
+		"""Exponential backoff with full jitter."""
+		return random.uniform(
+			0,
+			min(
+				settings.CLOUD_RUN_RETRY_MAX_DELAY,
+				settings.CLOUD_RUN_RETRY_BASE_DELAY * 2 ** attempt,
+			),
+		)
+
+	def get_latency_p95(self) -> Optional[float]:
+		if len(self._latencies) < 20:
+			return None
+		latencies = sorted(self._latencies)
+		return latencies[int(len(latencies) * 0.95) - 1]
+
+	def get_hedge_delay(self) -> float:
+		p95 = self.get_latency_p95()
+		if p95 is None:
+			return settings.CLOUD_RUN_HEDGE_MAX_DELAY
+		return min(
+			max(p95, settings.CLOUD_RUN_HEDGE_MIN_DELAY),
+			settings.CLOUD_RUN_HEDGE_MAX_DELAY,
+		)
+
+	def stats(self) -> dict:
+		return {
+			"state": self.state,
+			"consecutive_failures": self.consecutive_failures,
+			"retry_budget": round(self.retry_tokens, 2),
+			"latency_p95_seconds": self.get_latency_p95(),
+			"requests_total": self.requests,
+			"failures_total": self.failures,
+			"retries_total": self.retries,
+			"hedges_total": self.hedges,
+			"hedge_wins_total": self.hedge_wins,
+			"rejected_total": self.rejected,
+		}
+
+
+# {"https://app-pdf-v1-xyz.a.run.app": UpstreamHealth}
+UPSTREAM_HEALTH: dict[str, UpstreamHealth] = {}
+
+
+def get_upstream_health(origin: str) -> UpstreamHealth:
+	health = UPSTREAM_HEALTH.get(origin)
+	if health is None:
+		health = UPSTREAM_HEALTH[origin] = UpstreamHealth(origin)
+	return health
+
+
+def get_upstream_health_stats() -> dict:
+	return {
+		origin: health.stats() for origin, health in UPSTREAM_HEALTH.items()
+	}
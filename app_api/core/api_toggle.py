@@ -0,0 +1,105 @@
+"""
+Allow-list used by the `check_api_toggle` middleware.
+
+It is compiled once per worker from `core.urls` into a frozenset so every
+request is a single hash lookup. Endpoints can be switched off at runtime by
+adding their `api_url` to REDIS_KEY_DISABLED_API_ENDPOINTS and publishing on
+REDIS_CHANNEL_API_TOGGLE_UPDATES (see `python manage.py toggle_api_endpoint`
+in the Web App), the workers then recompile the allow-list.
+"""
+import asyncio
+import logging
+
+import redis.asyncio as redis
+
+from core.urls import urls
+from common.batch import BATCH_URL_PREFIX
+from common.redis_utils import init_redis_pool, listen_to_channel
+from schemas.redis_db import (
+    REDIS_KEY_DISABLED_API_ENDPOINTS,
+    REDIS_CHANNEL_API_TOGGLE_UPDATES,
+)
+
+logger = logging.getLogger("APP_API_" + __name__)
+
+STATIC_ALLOWED_ENDPOINTS = frozenset({
+    "/",
+    "/doc",
+    "/openapi.json",
+    "/metrics",
+    "/favicon.ico",
+    "9e68c24da9f5fd56991c.worker.js.map",
+})
+
+
+def build_allowed_endpoints(
+        disabled_endpoints: frozenset[str] = frozenset(),
+) -> frozenset[str]:
+    """Disabling an endpoint also disables its batch URL, see `common.batch`."""
+    allowed_endpoints = set(STATIC_ALLOWED_ENDPOINTS)
+    for app_name, app_versions in urls.items():
+        for app_version, app_endpoints in app_versions.items():
+            for app_endpoint, data in app_endpoints.items():
+                if not data.is_active or data.api_url in disabled_endpoints:
+                    continue
+                allowed_endpoints.add(data.api_url)
+                if (data.other or {}).get("batch"):
+                    allowed_endpoints.add(BATCH_URL_PREFIX + data.api_url)
+    return frozenset(allowed_endpoints)
+
+
+class APIToggle:
+    def __init__(self):
+        self.disabled_endpoints: frozenset[str] = frozenset()
+        self.allowed_endpoints: frozenset[str] = build_allowed_endpoints()
+        self._task = None
+
+    def is_allowed(self, relative_path: str) -> bool:
+        return relative_path in self.allowed_endpoints
+
+    async def load(self, redis_conn: redis.Redis) -> None:
+        disabled_endpoints = frozenset(
+            endpoint.decode() for endpoint in
+            await redis_conn.smembers(REDIS_KEY_DISABLED_API_ENDPOINTS)
+        )
+        # swap the reference, requests in flight keep using the old set
+        self.allowed_endpoints = build_allowed_endpoints(disabled_endpoints)
+        self.disabled_endpoints = disabled_endpoints
+
+        if disabled_endpoints:
+            logger.warning(
+                f"Disabled API endpoints: {sorted(disabled_endpoints)}"
+            )
+
+    async def start(self, redis_conn: redis.Redis) -> None:
+        try:
+            await self.load(redis_conn)
+        except Exception as e:
+            logger.error(f"Could not load the disabled API endpoints: {e}")
+
+        self._task = asyncio.create_task(
+            listen_to_channel(
+                redis_conn=redis_conn,
+                channel=REDIS_CHANNEL_API_TOGGLE_UPDATES,
+                on_message=lambda data: self.load(redis_conn),
+                on_subscribe=lambda: self.load(redis_conn),
+            )
+        )
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+API_TOGGLE = APIToggle()
+
+
+async def init_api_toggle() -> None:
+    await API_TOGGLE.start(redis.Redis(connection_pool=init_redis_pool()))
+
+
+async def close_api_toggle() -> None:
+    await API_TOGGLE.stop()
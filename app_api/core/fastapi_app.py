@@ -1,9 +1,10 @@
+import hmac
 import logging
 
 from fastapi import Request
 from fastapi.openapi.utils import get_openapi
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse
 from fastapi.openapi.docs import get_swagger_ui_html
 from starlette.middleware.cors import CORSMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
@@ -12,9 +13,20 @@ from core.routes import *
 from uvicorn_config import log_config_gcp
 from core.main import app
 from core import settings
-from core.urls import urls
+from core.api_toggle import API_TOGGLE
 from core.tracing import setup_fastapi_tracing
-from common.other import clean_openapi_schemas
+from common.idempotency import idempotency_middleware
+from common.metrics import (
+    METRICS_MEDIA_TYPE,
+    RequestMetricsMiddleware,
+    render_metrics,
+)
+from common.openapi_cache import (
+    openapi_variant,
+    document_response,
+    get_openapi_document,
+    filter_openapi_schema,
+)
 
 
 if settings.ENV_MODE != "local":
@@ -45,11 +57,17 @@ def custom_openapi():
         "altText": "DoodleOps Logo",
     }
 
-    return openapi_schema
+    # the full schema, built once, the served variants are filtered copies
+    # (see `common.openapi_cache`)
+    app.openapi_schema = openapi_schema
+    return app.openapi_schema
 
 
 app.openapi = custom_openapi
 
+# added before CORS so the replayed responses still get the CORS headers
+app.middleware("http")(idempotency_middleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.ALLOW_ORIGINS,
@@ -90,6 +108,7 @@ async def custom_404_handler(request: Request, exc: StarletteHTTPException):
         return JSONResponse(
             status_code=exc.status_code,
             content={"detail": exc.detail},
+            headers=getattr(exc, "headers", None),
         )
 
 
@@ -97,31 +116,36 @@ async def custom_404_handler(request: Request, exc: StarletteHTTPException):
 async def check_api_toggle(request: Request, call_next):
     """
     This middleware checks if the endpoint is allowed to be called.
-    It's used to toggle the API on and off.
+    It's used to toggle the API on and off, see `core.api_toggle`.
     """
     relative_path = request.url.path.replace(settings.FASTAPI_BASE_URL, "")
 
-    allowed_endpoints = {
-        data.api_url
-        for app_name, app_versions in urls.items()
-        for app_version, app_endpoints in app_versions.items()
-        for app_endpoint, data in app_endpoints.items()
-        if data.is_active
-    } | {
-        "/",
-        "/doc",
-        "/openapi.json",
-        "/favicon.ico",
-        "9e68c24da9f5fd56991c.worker.js.map",
-    }
-
-    if settings.ENV_MODE == "prod" and relative_path not in allowed_endpoints:
+    if (
+        settings.ENV_MODE == "prod" and
+        not API_TOGGLE.is_allowed(relative_path)
+    ):
         logger.warning(f"Endpoint {relative_path} is not allowed")
         return JSONResponse(status_code=403, content={"detail": "Forbidden"})
     response = await call_next(request)
     return response
 
 
+@app.middleware("http")
+async def add_rate_limit_headers(request: Request, call_next):
+    """Set by the `access_management.rate_limit` router dependency."""
+    response = await call_next(request)
+    rate_limit_headers = getattr(request.state, "rate_limit_headers", None)
+    if rate_limit_headers:
+        response.headers.update(rate_limit_headers)
+    return response
+
+
+# added last so it is the outermost middleware and times the whole request
+app.add_middleware(
+    RequestMetricsMiddleware, is_known_endpoint=API_TOGGLE.is_allowed
+)
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(*args):
     return JSONResponse(
@@ -130,10 +154,8 @@ async def validation_exception_handler(*args):
     )
 
 
-# create openapi.json view
-@app.get("/openapi.json", include_in_schema=False)
-async def get_openapi_endpoint(request: Request):
-    openapi_schema = request.app.openapi()
+@openapi_variant("public")
+def build_public_openapi(openapi_schema: dict) -> dict:
     filtered_paths = {}
     for route_path, path_item in openapi_schema["paths"].items():
         if (
@@ -142,16 +164,18 @@ async def get_openapi_endpoint(request: Request):
         ):
             filtered_paths[route_path] = path_item
 
-    openapi_schema["paths"] = filtered_paths
-
-    pruned_schemas = clean_openapi_schemas(
-        openapi_schema=openapi_schema,
-        filtered_paths=filtered_paths,
+    return filter_openapi_schema(
+        openapi_schema=openapi_schema, filtered_paths=filtered_paths
     )
 
-    openapi_schema["components"]["schemas"] = pruned_schemas
 
-    return JSONResponse(content=openapi_schema)
+# create openapi.json view
+@app.get("/openapi.json", include_in_schema=False)
+async def get_openapi_endpoint(request: Request):
+    return document_response(
+        request=request,
+        document=get_openapi_document(app=request.app, name="public"),
+    )
 
 
 @app.get("/doc", include_in_schema=False)
@@ -161,6 +185,27 @@ def custom_redoc_ui():
     )
 
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(request: Request):
+    """Prometheus scrape endpoint, see `common.metrics`."""
+    if settings.METRICS_TOKEN:
+        authorized = hmac.compare_digest(
+            request.headers.get("Authorization", ""),
+            f"Bearer {settings.METRICS_TOKEN}",
+        )
+    else:
+        authorized = settings.ENV_MODE == "local"
+
+    if not authorized:
+        return HTMLResponse(
+            content=open("templates/404.html").read(), status_code=404
+        )
+
+    return PlainTextResponse(
+        content=render_metrics(), media_type=METRICS_MEDIA_TYPE
+    )
+
+
 @app.get("/swagger", include_in_schema=False)
 def custom_swagger_ui():
     if settings.ENV_MODE != "local":
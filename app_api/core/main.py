@@ -1,3 +1,37 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
-app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
+from common.redis_utils import (
+    init_redis_pool,
+    close_redis_pool,
+    init_cost_cache,
+    close_cost_cache,
+)
+from common.cloud_run import init_upstream_clients, close_upstream_clients
+from core.api_toggle import init_api_toggle, close_api_toggle
+from common.openapi_cache import build_openapi_documents
+from common.jobs import init_job_workers, close_job_workers
+from common.openai.fastapi_transaltion import close_download_client
+from common.external_resources import close_pubsub_publisher
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_redis_pool()
+    await init_cost_cache()
+    await init_api_toggle()
+    init_upstream_clients()
+    init_job_workers()
+    build_openapi_documents(app)
+    yield
+    await close_job_workers()
+    await close_upstream_clients()
+    await close_download_client()
+    await close_pubsub_publisher()
+    await close_api_toggle()
+    await close_cost_cache()
+    await close_redis_pool()
+
+
+app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None, lifespan=lifespan)
@@ -4,6 +4,8 @@ from views.v1.route import v1_default_view_router
 
 default_views = [
 	"views.v1.view_user_credits",
+	"views.v1.view_job_status",
+	"views.v1.view_batch",
 ]
 for v in default_views:
 	importlib.import_module(v)
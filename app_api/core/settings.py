@@ -81,16 +81,84 @@ DB_Base.metadata.create_all(bind=engine)
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
 REDIS_DB_DEFAULT = os.getenv("REDIS_DB_DEFAULT")
+
+# one connection pool is shared by all the requests handled by a worker
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+# seconds a request waits for a free connection before failing
+REDIS_POOL_TIMEOUT = int(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(
+	os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "2")
+)
+# idle connections are PINGed before reuse if older than this (seconds)
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+REDIS_RETRY_ATTEMPTS = int(os.getenv("REDIS_RETRY_ATTEMPTS", "2"))
+# how the credits used per API call are stored, see `redis_schemas`:
+# "legacy" one key per call, "counters" per day hashes and timelines,
+# "dual" writes both and still reads the legacy keys (while migrating), switch
+# every app to "counters" once `migrate_usage_counters` has backfilled them
+REDIS_USAGE_COUNTERS_MODE = os.getenv("REDIS_USAGE_COUNTERS_MODE", "dual")
+# API calls a user can make at the same time, by plan
+USER_API_CALL_SLOTS = int(os.getenv("USER_API_CALL_SLOTS", "1"))
+USER_API_CALL_SLOTS_SUBSCRIPTION = int(
+	os.getenv("USER_API_CALL_SLOTS_SUBSCRIPTION", "2")
+)
+USER_API_CALL_SLOTS_METERED = int(os.getenv("USER_API_CALL_SLOTS_METERED", "5"))
+# a slot is freed after this many seconds even if the call did not release it
+# (ex: the instance was stopped)
+USER_API_CALL_SLOT_LEASE = int(os.getenv("USER_API_CALL_SLOT_LEASE", "30"))
+# the lease of a slot is extended while its call runs, at most for this many
+# seconds (ex: a long batch)
+USER_API_CALL_SLOT_MAX_HOLD = int(
+	os.getenv("USER_API_CALL_SLOT_MAX_HOLD", "3600")
+)
+# seconds a call waits for a free slot before getting a 429, 0 doesn't wait
+USER_API_CALL_SLOT_WAIT = float(os.getenv("USER_API_CALL_SLOT_WAIT", "0"))
+# requests per `period` seconds a user can make to an API, by plan. An endpoint
+# can set its own in `other["rate_limit"]`, or `False` for no limit.
+RATE_LIMIT_DEFAULT = {
+	"period": 60,
+	"free": int(os.getenv("RATE_LIMIT_PER_MINUTE", "20")),
+	"subscription": int(os.getenv("RATE_LIMIT_PER_MINUTE_SUBSCRIPTION", "60")),
+	"metered": int(os.getenv("RATE_LIMIT_PER_MINUTE_METERED", "300")),
+}
+# max entries (approximately) kept in a user's daily API calls stream
+API_CALLS_STREAM_MAX_LEN = int(os.getenv("API_CALLS_STREAM_MAX_LEN", "10000"))
+# the API / LLM cost cache is also updated through pub/sub, this is a safety net
+COST_CACHE_REFRESH_INTERVAL = int(os.getenv("COST_CACHE_REFRESH_INTERVAL", "300"))
 # ------------ REDIS end
 
 # ------------ CRYPTO start
 CRYPT_SECRET_KEY_WEB = os.getenv("CRYPT_SECRET_KEY_WEB")
 CRYPT_SECRET_KEY_G_CLOUD_RUN = os.getenv("CRYPT_SECRET_KEY_G_CLOUD_RUN")
 EXPECTED_TOKEN_CLOUD_RUN = os.getenv("EXPECTED_TOKEN_CLOUD_RUN")
+# the token sent to the Cloud Run containers is reused for this many seconds,
+# keep it well below SERVICE_TOKEN_MAX_AGE of the containers
+SERVICE_TOKEN_REFRESH_INTERVAL = int(
+	os.getenv("SERVICE_TOKEN_REFRESH_INTERVAL", "300")
+)
+# seconds a worker keeps a resolved API token, a revoked token keeps working
+# on that worker for at most this long
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "30"))
+# seconds a worker remembers that a token is invalid
+TOKEN_CACHE_NEGATIVE_TTL = int(os.getenv("TOKEN_CACHE_NEGATIVE_TTL", "10"))
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", "10000"))
 # ------------ CRYPTO end
 
 # ------------ OpenAI start
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# the openaiFileIdRefs of a request are downloaded at the same time on one
+# shared client, see `common.openai.fastapi_transaltion`
+OPENAI_FILE_DOWNLOAD_TIMEOUT = float(
+	os.getenv("OPENAI_FILE_DOWNLOAD_TIMEOUT", "30")
+)
+OPENAI_FILE_DOWNLOAD_MAX_CONNECTIONS = int(
+	os.getenv("OPENAI_FILE_DOWNLOAD_MAX_CONNECTIONS", "50")
+)
+# downloaded files bigger than this are spooled to disk instead of memory
+OPENAI_FILE_SPOOL_MAX_BYTES = int(
+	os.getenv("OPENAI_FILE_SPOOL_MAX_BYTES", str(1024 * 1024))
+)
 # ------------ OpenAI end
 
 # ------------ CLOUD RUN APPs start
@@ -123,6 +191,33 @@ if ENV_MODE == "local":
 	for key in CLOUD_RUN_APPs.keys():
 		CLOUD_RUN_APPs[key][
 			"base_url"] = f"{CLOUD_RUN_APPs[key]['base_url']}:8080"
+
+# one keep-alive client per Cloud Run target, see `common.cloud_run`
+CLOUD_RUN_HTTP2 = os.getenv("CLOUD_RUN_HTTP2", "true").lower() == "true"
+CLOUD_RUN_MAX_CONNECTIONS = int(os.getenv("CLOUD_RUN_MAX_CONNECTIONS", "100"))
+CLOUD_RUN_MAX_KEEPALIVE_CONNECTIONS = int(
+	os.getenv("CLOUD_RUN_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+CLOUD_RUN_KEEPALIVE_EXPIRY = float(os.getenv("CLOUD_RUN_KEEPALIVE_EXPIRY", "30"))
+CLOUD_RUN_CONNECT_TIMEOUT = float(os.getenv("CLOUD_RUN_CONNECT_TIMEOUT", "10"))
+# default request timeout, overridden per endpoint with `other["timeout"]`
+CLOUD_RUN_DEFAULT_TIMEOUT = 60
+# circuit breaker, retries and hedged requests, see `common.upstream_health`
+CLOUD_RUN_BREAKER_FAILURES = int(os.getenv("CLOUD_RUN_BREAKER_FAILURES", "5"))
+CLOUD_RUN_BREAKER_OPEN_SECONDS = float(
+	os.getenv("CLOUD_RUN_BREAKER_OPEN_SECONDS", "30")
+)
+CLOUD_RUN_RETRY_ATTEMPTS = int(os.getenv("CLOUD_RUN_RETRY_ATTEMPTS", "2"))
+CLOUD_RUN_RETRY_BASE_DELAY = float(os.getenv("CLOUD_RUN_RETRY_BASE_DELAY", "0.2"))
+CLOUD_RUN_RETRY_MAX_DELAY = float(os.getenv("CLOUD_RUN_RETRY_MAX_DELAY", "2"))
+# retries (and hedged requests) allowed per call, and how many can be saved up
+CLOUD_RUN_RETRY_BUDGET_RATIO = float(
+	os.getenv("CLOUD_RUN_RETRY_BUDGET_RATIO", "0.1")
+)
+CLOUD_RUN_RETRY_BUDGET_MAX = int(os.getenv("CLOUD_RUN_RETRY_BUDGET_MAX", "10"))
+# a hedged request is sent after the p95 latency of the target, within these
+CLOUD_RUN_HEDGE_MIN_DELAY = float(os.getenv("CLOUD_RUN_HEDGE_MIN_DELAY", "0.5"))
+CLOUD_RUN_HEDGE_MAX_DELAY = float(os.getenv("CLOUD_RUN_HEDGE_MAX_DELAY", "5"))
 # ------------ CLOUD RUN APPs end
 
 # ------------ LANGUAGE CODES start
@@ -140,8 +235,114 @@ with open(
 # ------------ TEMP Bucket
 TEMP_API_FILES_BUCKET = os.getenv("TEMP_API_FILES_BUCKET")
 BUKET_BASE_URL = os.getenv("BUKET_BASE_URL")
+# in local mode the files are written to this directory instead of the bucket
+TEMP_API_FILES_LOCAL_DIR = os.getenv(
+	"TEMP_API_FILES_LOCAL_DIR", "/tmp/doodleops_temp_api_files"
+)
+# seconds the signed URLs of the files in the bucket are valid
+TEMP_API_FILES_SIGNED_URL_EXPIRATION = int(
+	os.getenv("TEMP_API_FILES_SIGNED_URL_EXPIRATION", "3600")
+)
+# "gcs" or "local" (files in TEMP_API_FILES_LOCAL_DIR), see `common.temp_bucket`
+TEMP_API_FILES_BACKEND = os.getenv(
+	"TEMP_API_FILES_BACKEND", "local" if ENV_MODE == "local" else "gcs"
+)
+# files this big are uploaded in chunks of TEMP_API_FILES_UPLOAD_CHUNK_SIZE,
+# TEMP_API_FILES_UPLOAD_WORKERS at a time
+TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD = int(
+	os.getenv(
+		"TEMP_API_FILES_PARALLEL_UPLOAD_THRESHOLD", str(32 * 1024 * 1024)
+	)
+)
+# bigger files are not uploaded in parallel: the parallel upload copies the
+# file to /tmp, which is memory on Cloud Run
+TEMP_API_FILES_PARALLEL_UPLOAD_MAX_BYTES = int(
+	os.getenv(
+		"TEMP_API_FILES_PARALLEL_UPLOAD_MAX_BYTES", str(128 * 1024 * 1024)
+	)
+)
+# also the part size of the streamed uploads, a multiple of 256 KB
+TEMP_API_FILES_UPLOAD_CHUNK_SIZE = int(
+	os.getenv("TEMP_API_FILES_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))
+)
+TEMP_API_FILES_UPLOAD_WORKERS = int(
+	os.getenv("TEMP_API_FILES_UPLOAD_WORKERS", "8")
+)
 # ------------ TEMP Bucket end
 
+# ------------ JOBS start
+# jobs are run by this many asyncio workers per process, 0 only enqueues them
+# (ex: when a separate instance runs the workers). App_API runs on Cloud Run
+# with `cpu_idle = true`: the workers only get CPU while the instance serves
+# requests and the instance can be stopped at any time, the jobs of a stopped
+# worker are put back in the queue by the reaper
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))
+# jobs a user can have queued or running at the same time
+JOBS_MAX_ACTIVE_PER_USER = int(os.getenv("JOBS_MAX_ACTIVE_PER_USER", "5"))
+# seconds a job can wait for its Cloud Run target, instead of the request timeout
+JOBS_UPSTREAM_TIMEOUT = int(os.getenv("JOBS_UPSTREAM_TIMEOUT", "900"))
+# seconds a job (status, inputs and result) is kept
+JOBS_TTL = int(os.getenv("JOBS_TTL", "86400"))
+# seconds a worker blocks on the queue, keep it below REDIS_SOCKET_TIMEOUT
+JOBS_QUEUE_POLL_TIMEOUT = int(os.getenv("JOBS_QUEUE_POLL_TIMEOUT", "2"))
+JOBS_WEBHOOK_TIMEOUT = int(os.getenv("JOBS_WEBHOOK_TIMEOUT", "10"))
+# a worker refreshes its heartbeat every third of this many seconds, when it
+# is gone the reaper (every JOBS_REAPER_INTERVAL seconds) takes back its jobs
+JOBS_WORKER_HEARTBEAT_TTL = int(os.getenv("JOBS_WORKER_HEARTBEAT_TTL", "120"))
+JOBS_REAPER_INTERVAL = int(os.getenv("JOBS_REAPER_INTERVAL", "60"))
+# times a job taken back by the reaper is queued again before it fails
+JOBS_MAX_RETRIES = int(os.getenv("JOBS_MAX_RETRIES", "1"))
+# the inputs of a running job are kept in memory up to this size, on disk above
+JOBS_FILE_SPOOL_MAX_BYTES = int(
+	os.getenv("JOBS_FILE_SPOOL_MAX_BYTES", str(1024 * 1024))
+)
+# ------------ JOBS end
+
+# ------------ BATCH start
+# files a batch can have and how many of them are sent to the target at once
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "100"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# ------------ BATCH end
+
+# ------------ RESULT CACHE start
+# "disk", "bucket" or "" (the default) to disable it, see
+# `common.result_cache`. On Cloud Run /tmp is in memory, the "disk" cache
+# counts against the instance memory limit
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "")
+RESULT_CACHE_DIR = os.getenv(
+	"RESULT_CACHE_DIR", "/tmp/doodleops_result_cache"
+)
+RESULT_CACHE_MAX_BYTES = int(
+	os.getenv("RESULT_CACHE_MAX_BYTES", str(128 * 1024 * 1024))
+)
+RESULT_CACHE_MAX_ITEM_BYTES = int(
+	os.getenv("RESULT_CACHE_MAX_ITEM_BYTES", str(20 * 1024 * 1024))
+)
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "86400"))
+# part of the cache keys, the App_API VERSION when empty. Change it to drop the
+# cached results when a Cloud Run container is deployed on its own
+RESULT_CACHE_VERSION = os.getenv("RESULT_CACHE_VERSION", "")
+# ------------ RESULT CACHE end
+
+# ------------ IDEMPOTENCY start
+# seconds the response of a call with an `Idempotency-Key` is replayed for
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+# the lock expires if the worker dies, it should outlive the longest call
+IDEMPOTENCY_LOCK_TTL = int(os.getenv("IDEMPOTENCY_LOCK_TTL", "600"))
+# seconds a duplicate waits for the first call before getting a 409
+IDEMPOTENCY_WAIT_TIMEOUT = int(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "60"))
+# bigger response bodies are stored in the temp bucket instead of Redis
+IDEMPOTENCY_MAX_INLINE_BYTES = int(
+	os.getenv("IDEMPOTENCY_MAX_INLINE_BYTES", str(512 * 1024))
+)
+# ------------ IDEMPOTENCY end
+
+# ------------ METRICS start
+# bearer token of the `/metrics` scraper, without it the endpoint only works
+# in local mode
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# ------------ METRICS end
+
 # ------------ Twilio
 COUNTRY_CODE_PHONE_RESTRICTION = os.getenv(
 	"COUNTRY_CODE_PHONE_RESTRICTION",
@@ -154,6 +355,22 @@ MAX_MSGS_PER_MINUTE = 5
 MAX_MSGS_PER_HOUR = 60
 
 GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID")
+# the WhatsApp messages are published in batches, a batch is sent when it has
+# this many messages or bytes, or after this many seconds
+PUBSUB_BATCH_MAX_MESSAGES = int(os.getenv("PUBSUB_BATCH_MAX_MESSAGES", "100"))
+PUBSUB_BATCH_MAX_BYTES = int(os.getenv("PUBSUB_BATCH_MAX_BYTES", "1000000"))
+PUBSUB_BATCH_MAX_LATENCY = float(os.getenv("PUBSUB_BATCH_MAX_LATENCY", "0.01"))
+# the messages of a phone number are published with an ordering key, only
+# useful once the Eventarc subscription has message ordering enabled (it does
+# not in Terraform)
+PUBSUB_MESSAGE_ORDERING = (
+	os.getenv("PUBSUB_MESSAGE_ORDERING", "false").lower() == "true"
+)
+# seconds the local publisher waits for its pushes when the app stops
+PUBSUB_LOCAL_STOP_TIMEOUT = float(os.getenv("PUBSUB_LOCAL_STOP_TIMEOUT", "10"))
+# in local mode the messages are pushed to the AI container, with "false" they
+# are only kept in memory (ex: benchmarks)
+PUBSUB_LOCAL_PUSH = os.getenv("PUBSUB_LOCAL_PUSH", "true").lower() == "true"
 # ------------ Twilio end
 
 # ------------ OpenAPI and Hide private API paths
@@ -166,4 +383,7 @@ HIDE_PRIVATE_API_PATHS = (
 )
 with open("templates/ReDoc.html") as f:
 	RE_DOC_HTML = f.read()
+# the OpenAPI documents are served with an ETag, clients may reuse them
+# without asking again for this many seconds
+OPENAPI_CACHE_MAX_AGE = int(os.getenv("OPENAPI_CACHE_MAX_AGE", "300"))
 # ------------ OpenAPI end
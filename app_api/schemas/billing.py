@@ -0,0 +1,17 @@
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+class BillingContext(BaseModel):
+    """
+    Snapshot of everything needed to decide if a user can make an API call,
+    read from Redis in one round trip by `get_billing_context`.
+    """
+    api_cost: Optional[int]
+    api_daily_call_limit: Optional[int]
+    api_daily_calls: int = 0
+    is_metered: bool = False
+    credits_bought_remaining: int = 0
+    # 0 if the user doesn't have an active subscription
+    subscriptions_monthly_credit_remaining: int = 0
@@ -0,0 +1,23 @@
+from typing import Optional, Literal
+
+from pydantic import BaseModel
+
+
+class JobOptions(BaseModel):
+    """Sent by the client as headers, see `common.jobs.get_job_options`."""
+    respond_async: bool = False
+    webhook_url: Optional[str] = None
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    api_name: str
+    status: Literal["queued", "running", "succeeded", "failed"]
+    created_at: int  # timestamps
+    finished_at: Optional[int] = None
+    # signed URL of the result, only when the job succeeded
+    result_url: Optional[str] = None
+    filename: Optional[str] = None
+    # only when the job failed
+    status_code: Optional[int] = None
+    error: Optional[str] = None
@@ -1,7 +1,16 @@
 from app_ai.cloud_run_container_app_ai.v1.common.redis_schemas import (
     REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
     REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER,
-    REDIS_KEY_USER_CREDIT_BOUGHT
+    REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER,
+    REDIS_KEY_CREDITS_USED_PER_DAY_USERS,
+    REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER,
+    REDIS_CREDITS_USED_TIMELINE_MEMBER,
+    REDIS_KEY_USER_CREDIT_LEDGER,
+    REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
+)
+from app_ai.cloud_run_container_app_ai.v1.common.redis_scripts import (
+    CREDIT_LEDGER_BALANCE_LUA,
+    CREDIT_LEDGER_DEBIT_LUA,
 )
 
 REDIS_KEY_TTL_MAX = 60 * 60 * 24 * 31 * 6  # 6 months
@@ -13,18 +22,36 @@ REDIS_OPENAI_OAUTH_USER_GENERATED_TOKEN = "token:openai_oauth:{token}:username"
 # for metering api calls
 REDIS_KEY_API_COST = "api_cost:{api_name}"
 
-REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION = "user_has_active_subscription:{username}"
-
 REDIS_KEY_USER_API_DAILY_CALL_LIMIT = "user_api_daily_call_limit:{username}"
 
 # we store the Number of calls made per day per user
 REDIS_KEY_USER_API_DAILY_CALLS = "user_api_daily_calls:{username}:{date}"
-# we store which API endpoint was called and if it was a success or not (0/1)
-REDIS_KEY_USER_API_CALLS_LOG = (
-    "user_api_calls_log:{username}:{api_name}:{" "timestamp}"
-)
-# we lock the user from making more than one api call at a time
-REDIS_USER_API_CALL_LOCK = "user_is_making_api_call:{username}"
+# capped stream of the calls made by a user in a day, one entry per call:
+# {"api_name": .., "timestamp": .., "success": 0/1}
+REDIS_KEY_USER_API_CALLS_STREAM = "user_api_calls_stream:{username}:{date}"
+# we limit the number of API calls a user makes at the same time, sorted set
+# {owner token: lease expiry in ms}, see API_CALL_SLOT_ACQUIRE_LUA
+REDIS_KEY_USER_API_CALL_SLOTS = "user_api_call_slots:{username}"
+
+# theoretical arrival time (ms) of the user's next request to an API, see
+# RATE_LIMIT_GCRA_LUA
+REDIS_KEY_USER_API_RATE_LIMIT = "user_api_rate_limit:{username}:{api_name}"
+
+# hash with the status of an async job, see `common.jobs`, and the list of the
+# job ids waiting for a worker
+REDIS_KEY_API_JOB = "api_job:{job_id}"
+REDIS_KEY_API_JOBS_QUEUE = "api_jobs_queue"
+# list of the job ids a worker took from the queue, and the heartbeat of the
+# worker's process, `worker_id` is "{instance_id}:{index}"
+REDIS_KEY_API_JOBS_PROCESSING = "api_jobs_processing:{worker_id}"
+REDIS_KEY_API_JOBS_INSTANCE = "api_jobs_instance:{instance_id}"
+# sorted set {job id: lease expiry in ms} of the user's queued and running jobs
+REDIS_KEY_USER_API_JOB_SLOTS = "user_api_job_slots:{username}"
+
+# a call with an `Idempotency-Key` header holds the lock while it runs, its
+# response is then kept in the result hash, see `common.idempotency`
+REDIS_KEY_IDEMPOTENCY_LOCK = "idempotency_lock:{username}:{key}"
+REDIS_KEY_IDEMPOTENCY_RESULT = "idempotency_result:{username}:{key}"
 
 # we only store value 1 for the key
 REDIS_KEY_METERED_SUBSCRIPTION_USERS = "metered_subscription_users:{username}"
@@ -37,3 +64,11 @@ REDIS_KEY_WHATSAPP_MSG_PER_HOUR_RATE = (
     "whatsapp_msg_per_hour_rate:{number}:{current_hour}"
 )
 REDIS_KEY_LLM_COST = "llm_cost:{name}"
+# Django publishes {"table": "api_cost" | "llm_cost", "name": .., "cost": ..}
+# when a cost changes, `cost: null` when it was deleted
+REDIS_CHANNEL_COST_UPDATES = "cost_updates"
+
+# set of `api_url`s (ex: "/pdf/v1/rotate") switched off at runtime, Django
+# publishes on the channel after changing it so every worker reloads the set
+REDIS_KEY_DISABLED_API_ENDPOINTS = "disabled_api_endpoints"
+REDIS_CHANNEL_API_TOGGLE_UPDATES = "api_toggle_updates"
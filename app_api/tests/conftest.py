@@ -0,0 +1,72 @@
+import fakeredis
+import httpx
+import pytest
+
+UPSTREAM_ORIGIN = "http://cloud-run.test"
+
+
+@pytest.fixture
+def anyio_backend():
+	return "asyncio"
+
+
+@pytest.fixture
+def redis_server():
+	return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_conn(redis_server):
+	"""In memory Redis that runs the Lua scripts (fakeredis[lua])."""
+	return fakeredis.FakeRedis(server=redis_server)
+
+
+@pytest.fixture
+def async_redis_conn(redis_server):
+	"""`redis.asyncio` client on the same data as `redis_conn`."""
+	return fakeredis.FakeAsyncRedis(server=redis_server)
+
+
+class FakeUpstream:
+	"""
+	Cloud Run target at UPSTREAM_ORIGIN: answers with `status_codes` in order
+	(the last one repeats), an exception in the list is raised instead.
+	"""
+
+	def __init__(self):
+		self.status_codes: list = [200]
+		self.requests: list[httpx.Request] = []
+
+	def handle(self, request: httpx.Request) -> httpx.Response:
+		self.requests.append(request)
+		status_code = self.status_codes[
+			min(len(self.requests), len(self.status_codes)) - 1
+		]
+		if isinstance(status_code, Exception):
+			raise status_code
+		# a stream, like the real transports, `content` would be read already
+		return httpx.Response(
+			status_code,
+			stream=httpx.ByteStream(f"result {len(self.requests)}".encode()),
+			headers={"content-type": "image/png"},
+		)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+	"""`async_request` calls to UPSTREAM_ORIGIN go to a `FakeUpstream`."""
+	from common import cloud_run, upstream_health
+
+	fake_upstream = FakeUpstream()
+	monkeypatch.setitem(
+		cloud_run.UPSTREAM_CLIENTS,
+		UPSTREAM_ORIGIN,
+		httpx.AsyncClient(
+			base_url=UPSTREAM_ORIGIN,
+			transport=httpx.MockTransport(fake_upstream.handle),
+		),
+	)
+	# {url: other}, the `other` of the endpoints
+	monkeypatch.setattr(cloud_run, "_TARGET_OTHER", {})
+	monkeypatch.setattr(upstream_health, "UPSTREAM_HEALTH", {})
+	return fake_upstream
@@ -0,0 +1,168 @@
+import io
+import json
+import zipfile
+
+import pytest
+from starlette.datastructures import Headers, UploadFile
+from starlette.responses import Response
+
+from core import settings
+from common import batch
+from common.file_validation import FileSizeLimitExceeded
+from common.redis_utils import reserve_user_credits
+from schemas.urls import CloudRunAPIEndpoint
+
+pytestmark = pytest.mark.anyio
+
+LEDGER_KEY = "user_credit_ledger:alice"
+API_COST = 3
+URL_DATA = CloudRunAPIEndpoint(
+	api_url="/pdf/v1/rotate",
+	url_target="http://pdf.local/v1/rotate",
+	other={"media_type": ["application/pdf"]},
+)
+
+
+def upload(filename: str, content_type: str = "application/pdf") -> UploadFile:
+	return UploadFile(
+		file=io.BytesIO(b"%PDF"),
+		filename=filename,
+		headers=Headers({"content-type": content_type}),
+	)
+
+
+@pytest.fixture
+def cloud_run(monkeypatch):
+	"""The Cloud Run target, answers by the name of the file."""
+	calls = []
+
+	async def async_request(url, method, file, params):
+		calls.append(file.filename)
+		if file.filename.startswith("big"):
+			raise FileSizeLimitExceeded("File too large. Max size is 1 MB.")
+		elif file.filename.startswith("bad"):
+			return Response(b'{"detail": "Invalid page."}', status_code=400)
+		elif file.filename.startswith("fail"):
+			return Response(b"", status_code=503)
+		return Response(
+			b"rotated " + file.filename.encode(),
+			headers={"content-disposition": f"filename={file.filename}"},
+			media_type="application/pdf",
+		)
+
+	async def read_response_body(resp):
+		return resp.body
+
+	async def upload_to_temp_bucket(content, blob_name, content_type):
+		pass
+
+	async def get_temp_bucket_signed_url(blob_name):
+		return f"https://bucket.local/{blob_name}"
+
+	monkeypatch.setattr(batch, "async_request", async_request)
+	monkeypatch.setattr(batch, "read_response_body", read_response_body)
+	monkeypatch.setattr(batch, "upload_to_temp_bucket", upload_to_temp_bucket)
+	monkeypatch.setattr(
+		batch, "get_temp_bucket_signed_url", get_temp_bucket_signed_url
+	)
+	monkeypatch.setattr(settings, "API_COST_BAD_REQUEST", 1)
+	return calls
+
+
+async def run_batch(
+		async_redis_conn, files: list[UploadFile], as_ndjson: bool = False
+) -> list[bytes]:
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+	reservation = await reserve_user_credits(
+		redis_conn=async_redis_conn,
+		username="alice",
+		credits=API_COST * len(files),
+	)
+	results = batch.start_batch(
+		redis_conn=async_redis_conn,
+		files=files,
+		params={"pages_to_rotate_right": "1"},
+		upload_results=as_ndjson,
+		username="alice",
+		api_name="pdf/v1/rotate",
+		url_data=URL_DATA,
+		api_cost=API_COST,
+		is_metered=False,
+		current_date="16-10-2026",
+		timestamp=1,
+		reservation=reservation,
+	)
+	stream = batch.stream_ndjson if as_ndjson else batch.stream_zip
+	return [chunk async for chunk in stream(results)]
+
+
+async def remaining_credits(async_redis_conn) -> int:
+	return int(await async_redis_conn.hget(LEDGER_KEY, "1"))
+
+
+async def test_each_item_is_charged_once(async_redis_conn, cloud_run):
+	files = [upload("a.pdf"), upload("bad.pdf"), upload("fail.pdf")]
+	await run_batch(async_redis_conn, files)
+
+	assert sorted(cloud_run) == ["a.pdf", "bad.pdf", "fail.pdf"]
+	# 200 + 400, the 503 is given back
+	assert await remaining_credits(async_redis_conn) == 100 - API_COST - 1
+
+
+async def test_not_billed_batch_is_refunded(
+		async_redis_conn, cloud_run, monkeypatch
+):
+	async def cost_teardown_batch(**kwargs):
+		raise ConnectionError("Redis is down")
+
+	monkeypatch.setattr(batch, "cost_teardown_batch", cost_teardown_batch)
+	await run_batch(async_redis_conn, [upload("a.pdf")])
+
+	assert await remaining_credits(async_redis_conn) == 100
+
+
+async def test_local_rejections_are_not_charged(async_redis_conn, cloud_run):
+	files = [upload("a.txt", content_type="text/plain"), upload("big.pdf")]
+	chunks = await run_batch(async_redis_conn, files, as_ndjson=True)
+
+	items = [json.loads(line) for line in b"".join(chunks).splitlines()]
+	status_codes = {item["index"]: item["status_code"] for item in items}
+	assert status_codes == {0: 400, 1: 413}
+	assert cloud_run == ["big.pdf"]
+	assert await remaining_credits(async_redis_conn) == 100
+
+
+async def test_zip_has_the_results_and_the_manifest(
+		async_redis_conn, cloud_run
+):
+	files = [upload("a.pdf"), upload("bad.pdf")]
+	chunks = await run_batch(async_redis_conn, files)
+
+	with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+		assert sorted(zf.namelist()) == ["0000_a.pdf", "manifest.ndjson"]
+		assert zf.read("0000_a.pdf") == b"rotated a.pdf"
+		manifest = [
+			json.loads(line) for line in zf.read("manifest.ndjson").splitlines()
+		]
+
+	assert manifest == [
+		{
+			"index": 0, "filename": "a.pdf", "status_code": 200,
+			"result_filename": "a.pdf", "file": "0000_a.pdf",
+		},
+		{
+			"index": 1, "filename": "bad.pdf", "status_code": 400,
+			"error": "Invalid page.",
+		},
+	]
+
+
+async def test_ndjson_has_a_link_per_result(async_redis_conn, cloud_run):
+	chunks = await run_batch(async_redis_conn, [upload("a.pdf")], as_ndjson=True)
+
+	assert len(chunks) == 1
+	item = json.loads(chunks[0])
+	assert item["status_code"] == 200
+	assert item["result_url"].startswith("https://bucket.local/batch/")
+	assert item["result_url"].endswith("/0/a.pdf")
+	assert "content" not in item
@@ -0,0 +1,52 @@
+from common.redis_scripts import CREDIT_RESERVE_LUA
+from app_ai.cloud_run_container_app_ai.v1.common.redis_scripts import (
+	CREDIT_LEDGER_BALANCE_LUA, CREDIT_LEDGER_DEBIT_LUA,
+)
+
+LEDGER_KEY = "user_credit_ledger:alice"
+SUBSCRIPTION_KEY = "subscriptions_monthly_credit_remaining:alice"
+ACTIVE_KEY = "user_has_active_subscription:alice"
+KEYS = [LEDGER_KEY, SUBSCRIPTION_KEY, ACTIVE_KEY]
+
+
+def set_legacy_credits(redis_conn) -> None:
+	"""Credits bought before the ledger, not migrated yet."""
+	redis_conn.set("user_credit_bought:alice:7", 10)
+	redis_conn.set("user_credit_bought:alice:3", 4)
+	# other users, "alice:x" and "alicex"
+	redis_conn.set("user_credit_bought:alice:x:9", 100)
+	redis_conn.set("user_credit_bought:alicex:9", 100)
+
+
+def test_balance_reads_the_legacy_keys(redis_conn):
+	set_legacy_credits(redis_conn)
+	balance = redis_conn.register_script(CREDIT_LEDGER_BALANCE_LUA)
+
+	assert balance(keys=KEYS) == [14, 0]
+	assert redis_conn.hgetall(LEDGER_KEY) == {b"3": b"4", b"7": b"10"}
+	assert not redis_conn.exists("user_credit_bought:alice:7")
+	assert redis_conn.exists("user_credit_bought:alice:x:9")
+	assert redis_conn.exists("user_credit_bought:alicex:9")
+	# folded once, the next reads don't scan
+	assert redis_conn.exists("user_credit_ledger_folded:alice")
+	assert balance(keys=KEYS) == [14, 0]
+
+
+def test_debit_uses_the_legacy_keys_before_the_subscription(redis_conn):
+	set_legacy_credits(redis_conn)
+	redis_conn.set(SUBSCRIPTION_KEY, 5)
+	redis_conn.set(ACTIVE_KEY, 1)
+	debit = redis_conn.register_script(CREDIT_LEDGER_DEBIT_LUA)
+
+	# cost, use bought, fall back to the subscription, check, overdraw
+	assert debit(keys=KEYS, args=[6, 1, 1, 0, 1]) == 0
+	assert redis_conn.hgetall(LEDGER_KEY) == {b"7": b"8"}
+	assert redis_conn.get(SUBSCRIPTION_KEY) == b"5"
+
+
+def test_reserve_uses_the_legacy_keys(redis_conn):
+	set_legacy_credits(redis_conn)
+	reserve = redis_conn.register_script(CREDIT_RESERVE_LUA)
+
+	assert reserve(keys=KEYS, args=[12]) == [b"3", 4, b"7", 8]
+	assert redis_conn.hgetall(LEDGER_KEY) == {b"7": b"2"}
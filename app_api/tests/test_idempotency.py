@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import FastAPI, Request, Response
+
+from common import idempotency
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def client(async_redis_conn, monkeypatch):
+	"""App with one billed endpoint behind `idempotency_middleware`."""
+	calls = []
+	app = FastAPI()
+	app.middleware("http")(idempotency.idempotency_middleware)
+
+	@app.post("/convert")
+	async def convert(request: Request):
+		calls.append(await request.body())
+		await asyncio.sleep(0.1)
+		response = Response(b"converted", media_type="application/pdf")
+		response.set_cookie("a", "1")
+		response.set_cookie("b", "2")
+		response.headers["RateLimit-Remaining"] = "9"
+		return response
+
+	async def verify_token(req, redis_conn):
+		return SimpleNamespace(username="alice")
+
+	monkeypatch.setattr(
+		idempotency, "init_redis_pool", lambda: async_redis_conn.connection_pool
+	)
+	monkeypatch.setattr(idempotency, "verify_token", verify_token)
+	monkeypatch.setattr(idempotency, "POLL_INTERVAL", 0.01)
+
+	client = httpx.AsyncClient(
+		transport=httpx.ASGITransport(app=app), base_url="http://test"
+	)
+	client.calls = calls
+	return client
+
+
+def post(client, body: bytes = b'{"pages": 1}', key: str = "key-1"):
+	return client.post(
+		"/convert", content=body, headers={"Idempotency-Key": key}
+	)
+
+
+async def test_concurrent_calls_run_once(client):
+	first, second = await asyncio.gather(post(client), post(client))
+
+	assert len(client.calls) == 1
+	assert first.content == second.content == b"converted"
+	assert [
+		resp.headers.get("Idempotent-Replayed") for resp in (first, second)
+	].count("true") == 1
+
+
+async def test_different_body_is_rejected(client):
+	assert (await post(client)).status_code == 200
+
+	resp = await post(client, body=b'{"pages": 2}')
+	assert resp.status_code == 422
+	assert len(client.calls) == 1
+
+	# another key is another call
+	assert (await post(client, key="key-2")).status_code == 200
+	assert len(client.calls) == 2
+
+
+async def test_replay_keeps_the_repeated_headers(client):
+	first = await post(client)
+	replayed = await post(client)
+
+	for resp in (first, replayed):
+		assert resp.headers.get_list("set-cookie") == [
+			"a=1; Path=/; SameSite=lax", "b=2; Path=/; SameSite=lax",
+		]
+	assert first.headers["RateLimit-Remaining"] == "9"
+	# set again by `add_rate_limit_headers` when the rate limit ran
+	assert "RateLimit-Remaining" not in replayed.headers
+	assert replayed.headers["Idempotent-Replayed"] == "true"
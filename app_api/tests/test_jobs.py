@@ -0,0 +1,167 @@
+import io
+import json
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import Headers, UploadFile
+
+from core import settings
+from common import jobs, temp_bucket
+from schemas.auth import TokenData
+from schemas.jobs import JobOptions
+from views.v1.view_job_status import view_job_status
+
+pytestmark = pytest.mark.anyio
+
+API_NAME = "app_pdf/v1/view_pdf_convert_to_image"
+API_COST = 3
+LEDGER_KEY = "user_credit_ledger:alice"
+
+
+@pytest.fixture(autouse=True)
+def setup_jobs(async_redis_conn, monkeypatch, tmp_path):
+	"""Local temp bucket, flat API cost and a converter for API_NAME."""
+	monkeypatch.setattr(settings, "TEMP_API_FILES_BACKEND", "local")
+	monkeypatch.setattr(settings, "TEMP_API_FILES_LOCAL_DIR", str(tmp_path))
+	monkeypatch.setattr(temp_bucket, "_STORAGE", None)
+
+	async def cost_setup(**kwargs):
+		return API_COST, False
+
+	async def convert(job, files):
+		_, (filename, fileobj, _) = files[0]
+		content = fileobj.read()
+		if content == b"broken":
+			raise HTTPException(status_code=500, detail="Internal server error.")
+
+		async def body():
+			yield b"converted "
+			if content == b"cut":
+				raise ConnectionError("The connection was closed.")
+			yield filename.encode()
+
+		return StreamingResponse(
+			body(),
+			media_type="image/png",
+			headers={"content-disposition": 'attachment; filename="a.png"'},
+		)
+
+	monkeypatch.setattr(jobs, "cost_setup", cost_setup)
+	monkeypatch.setitem(jobs.JOB_HANDLERS, API_NAME, convert)
+
+
+def token(username: str) -> TokenData:
+	return TokenData(
+		access_token="token", username=username, generated_by="user", ttl=None
+	)
+
+
+async def submit(async_redis_conn, username="alice", content=b"%PDF") -> str:
+	resp = await jobs.submit_job(
+		redis_conn=async_redis_conn,
+		token_data=token(username),
+		api_name=API_NAME,
+		job_options=JobOptions(respond_async=True),
+		files=[(
+			"file",
+			UploadFile(
+				file=io.BytesIO(content),
+				filename="a.pdf",
+				headers=Headers({"content-type": "application/pdf"}),
+			),
+		)],
+		max_size_mb=1,
+	)
+	assert resp.status_code == 202
+	return json.loads(resp.body)["job_id"]
+
+
+async def remaining_credits(async_redis_conn) -> int:
+	return int(await async_redis_conn.hget(LEDGER_KEY, "1") or 0)
+
+
+async def test_submit_reserves_the_credits(async_redis_conn):
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+	job_id = await submit(async_redis_conn)
+
+	assert await remaining_credits(async_redis_conn) == 100 - API_COST
+	job = await jobs.get_job(async_redis_conn, job_id)
+	assert job["status"] == jobs.JOB_STATUS_QUEUED
+	blob_name = json.loads(job["inputs"])[0]["blob_name"]
+	assert await temp_bucket.download_from_temp_bucket(blob_name) == b"%PDF"
+
+
+async def test_job_is_charged_once(async_redis_conn):
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+	job_id = await submit(async_redis_conn)
+
+	await jobs.run_job(async_redis_conn, job_id)
+	job = await jobs.get_job(async_redis_conn, job_id)
+	assert job["status"] == jobs.JOB_STATUS_SUCCEEDED
+	assert await temp_bucket.download_from_temp_bucket(
+		job["result_blob_name"]
+	) == b"converted a.pdf"
+
+	# picked up again (ex: by the reaper) and then failed, nothing changes
+	await jobs.run_job(async_redis_conn, job_id)
+	await jobs._refund_job(async_redis_conn, job)
+	assert await remaining_credits(async_redis_conn) == 100 - API_COST
+
+
+async def test_failed_job_is_refunded(async_redis_conn):
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+	job_id = await submit(async_redis_conn, content=b"broken")
+
+	await jobs.run_job(async_redis_conn, job_id)
+	job = await jobs.get_job(async_redis_conn, job_id)
+	assert job["status"] == jobs.JOB_STATUS_FAILED
+	assert job["status_code"] == "500"
+	assert await remaining_credits(async_redis_conn) == 100
+
+
+async def test_result_is_not_stored_if_the_stream_fails(
+		async_redis_conn, tmp_path
+):
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+	job_id = await submit(async_redis_conn, content=b"cut")
+
+	await jobs.run_job(async_redis_conn, job_id)
+	job = await jobs.get_job(async_redis_conn, job_id)
+	assert job["status"] == jobs.JOB_STATUS_FAILED
+	assert not [path for path in tmp_path.rglob("*") if path.is_file()]
+
+
+async def test_other_users_job_is_not_found(async_redis_conn):
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+	job_id = await submit(async_redis_conn)
+
+	job_status = await view_job_status(
+		job_id=job_id,
+		token_data=token("alice"),
+		redis_conn=async_redis_conn,
+	)
+	assert job_status.status == jobs.JOB_STATUS_QUEUED
+
+	with pytest.raises(HTTPException) as error:
+		await view_job_status(
+			job_id=job_id,
+			token_data=token("bob"),
+			redis_conn=async_redis_conn,
+		)
+	assert error.value.status_code == 404
+
+
+async def test_at_most_five_active_jobs(async_redis_conn, monkeypatch):
+	monkeypatch.setattr(settings, "JOBS_MAX_ACTIVE_PER_USER", 5)
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+	job_ids = [await submit(async_redis_conn) for _ in range(5)]
+
+	with pytest.raises(HTTPException) as error:
+		await submit(async_redis_conn)
+	assert error.value.status_code == 429
+	assert await remaining_credits(async_redis_conn) == 100 - 5 * API_COST
+
+	# a finished job frees its slot
+	await jobs.run_job(async_redis_conn, job_ids[0])
+	await submit(async_redis_conn)
@@ -0,0 +1,48 @@
+import pytest
+
+from common.redis_scripts import RATE_LIMIT_GCRA_LUA
+
+RATE_LIMIT_KEY = "user_api_rate_limit:alice:pdf/v1/rotate"
+METERED_KEY = "metered_subscription_users:alice"
+SUBSCRIPTION_KEY = "user_has_active_subscription:alice"
+PERIOD_MS = 60 * 1000
+
+
+@pytest.fixture
+def check_rate_limit(redis_conn):
+	script = redis_conn.register_script(RATE_LIMIT_GCRA_LUA)
+
+	def check(limit: int) -> list[int]:
+		return script(
+			keys=[RATE_LIMIT_KEY, METERED_KEY, SUBSCRIPTION_KEY],
+			args=[PERIOD_MS, limit, limit, limit],
+		)
+
+	check.redis_conn = redis_conn
+	return check
+
+
+def test_high_per_minute_limit(check_rate_limit):
+	# the interval (0.06 µs) is lost in the precision of the time in ms
+	for _ in range(3):
+		allowed, limit, remaining, reset_ms, retry_after_ms = (
+			check_rate_limit(10**9)
+		)
+		assert allowed == 1
+		assert limit == 10**9
+		assert reset_ms >= 1
+		assert retry_after_ms == 0
+
+	# the key expires (after 1 ms) instead of staying forever
+	assert check_rate_limit.redis_conn.pttl(RATE_LIMIT_KEY) != -1
+
+
+def test_over_the_limit(check_rate_limit):
+	for _ in range(2):
+		assert check_rate_limit(2)[0] == 1
+
+	allowed, _, remaining, reset_ms, retry_after_ms = check_rate_limit(2)
+	assert allowed == 0
+	assert remaining == 0
+	assert 1 <= reset_ms <= PERIOD_MS
+	assert 1 <= retry_after_ms <= PERIOD_MS / 2
@@ -0,0 +1,94 @@
+import io
+
+import pytest
+from starlette.datastructures import Headers, UploadFile
+
+from common import cloud_run, result_cache
+from common.cloud_run import async_request, read_response_body
+from common.cost_management import cost_teardown
+from tests.conftest import UPSTREAM_ORIGIN
+
+pytestmark = pytest.mark.anyio
+
+URL = UPSTREAM_ORIGIN + "/v1/convert"
+LEDGER_KEY = "user_credit_ledger:alice"
+API_COST = 2
+
+
+@pytest.fixture(autouse=True)
+def disk_cache(upstream, monkeypatch, tmp_path):
+	cloud_run._TARGET_OTHER[URL] = {"cache": True}
+	monkeypatch.setattr(
+		result_cache, "RESULT_CACHE",
+		result_cache.DiskResultCache(str(tmp_path), max_bytes=1024 * 1024),
+	)
+
+
+def upload(content: bytes = b"image") -> UploadFile:
+	return UploadFile(
+		file=io.BytesIO(content),
+		filename="a.png",
+		headers=Headers({"content-type": "image/png"}),
+	)
+
+
+async def call(params: dict = None, content: bytes = b"image"):
+	return await async_request(
+		url=URL,
+		file=upload(content),
+		params=params or {"format": "webp"},
+		headers={"authorization": "test"},
+	)
+
+
+async def call_and_bill(async_redis_conn) -> tuple[bytes, str]:
+	"""The flow of a view: call, bill, then send the body."""
+	resp = await cost_teardown(
+		redis_conn=async_redis_conn,
+		resp_type="file",
+		resp=await call(),
+		username="alice",
+		api_name="app_images/v1/convert",
+		api_cost=API_COST,
+		current_date="16-10-2026",
+		timestamp=1,
+	)
+	return await read_response_body(resp), resp.headers.get("x-cache")
+
+
+async def test_miss_then_hit(upstream):
+	first = await call()
+	assert first.headers.get("x-cache") is None
+	assert await read_response_body(first) == b"result 1"
+
+	second = await call()
+	assert second.headers["x-cache"] == "HIT"
+	assert await read_response_body(second) == b"result 1"
+	assert second.headers["content-type"] == "image/png"
+	assert len(upstream.requests) == 1
+
+
+async def test_another_input_is_a_miss(upstream):
+	await read_response_body(await call())
+	await read_response_body(await call(params={"format": "jpeg"}))
+	await read_response_body(await call(content=b"other image"))
+
+	assert len(upstream.requests) == 3
+
+
+async def test_error_is_not_cached(upstream):
+	upstream.status_codes = [400, 200]
+	assert (await call()).status_code == 400
+
+	resp = await call()
+	assert resp.headers.get("x-cache") is None
+	assert len(upstream.requests) == 2
+
+
+async def test_hit_is_billed(async_redis_conn, upstream):
+	await async_redis_conn.hset(LEDGER_KEY, mapping={"1": 100})
+
+	assert await call_and_bill(async_redis_conn) == (b"result 1", None)
+	assert await call_and_bill(async_redis_conn) == (b"result 1", "HIT")
+	assert len(upstream.requests) == 1
+	assert int(await async_redis_conn.hget(LEDGER_KEY, "1")) == 100 - 2 * API_COST
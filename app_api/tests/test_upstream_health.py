@@ -0,0 +1,77 @@
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from core import settings
+from common import cloud_run
+from common.cloud_run import async_request, read_response_body
+from common.upstream_health import CLOSED, OPEN, get_upstream_health
+from tests.conftest import UPSTREAM_ORIGIN
+
+pytestmark = pytest.mark.anyio
+
+ROTATE_URL = UPSTREAM_ORIGIN + "/v1/rotate"
+MERGE_URL = UPSTREAM_ORIGIN + "/v1/merge"
+
+
+@pytest.fixture(autouse=True)
+def targets(upstream, monkeypatch):
+	"""Rotate can be retried, merge can't (it has no `idempotent`)."""
+	cloud_run._TARGET_OTHER[ROTATE_URL] = {"idempotent": True}
+	monkeypatch.setattr(settings, "CLOUD_RUN_RETRY_BASE_DELAY", 0)
+	monkeypatch.setattr(settings, "CLOUD_RUN_BREAKER_FAILURES", 3)
+	monkeypatch.setattr(settings, "CLOUD_RUN_BREAKER_OPEN_SECONDS", 30)
+
+
+async def call(url: str):
+	return await async_request(
+		url=url, json={"pages": [1]}, headers={"authorization": "test"}
+	)
+
+
+async def test_retry_on_503(upstream):
+	upstream.status_codes = [503, 200]
+	resp = await call(ROTATE_URL)
+
+	assert resp.status_code == 200
+	assert await read_response_body(resp) == b"result 2"
+	assert len(upstream.requests) == 2
+
+
+async def test_connection_error_is_retried(upstream):
+	upstream.status_codes = [httpx.ConnectError("refused"), 200]
+	resp = await call(MERGE_URL)
+
+	assert resp.status_code == 200
+	assert len(upstream.requests) == 2
+
+
+async def test_merge_is_not_retried(upstream):
+	upstream.status_codes = [503, 200]
+	resp = await call(MERGE_URL)
+
+	assert resp.status_code == 503
+	assert len(upstream.requests) == 1
+
+
+async def test_open_circuit_fails_fast(upstream):
+	upstream.status_codes = [503]
+	for _ in range(settings.CLOUD_RUN_BREAKER_FAILURES):
+		assert (await call(MERGE_URL)).status_code == 503
+	assert get_upstream_health(UPSTREAM_ORIGIN).state == OPEN
+
+	with pytest.raises(HTTPException) as error:
+		await call(MERGE_URL)
+	assert error.value.status_code == 503
+	assert 1 <= int(error.value.headers["Retry-After"]) <= 30
+	assert len(upstream.requests) == settings.CLOUD_RUN_BREAKER_FAILURES
+
+
+async def test_half_open_probe_closes_the_circuit(upstream, monkeypatch):
+	upstream.status_codes = [503, 503, 503, 200]
+	for _ in range(settings.CLOUD_RUN_BREAKER_FAILURES):
+		await call(MERGE_URL)
+
+	monkeypatch.setattr(settings, "CLOUD_RUN_BREAKER_OPEN_SECONDS", 0)
+	assert (await call(MERGE_URL)).status_code == 200
+	assert get_upstream_health(UPSTREAM_ORIGIN).state == CLOSED
@@ -6,4 +6,12 @@ default_urls = {
 		url_target="",
 		is_active=True,
 	),
+	"view_job_status_v1": CloudRunAPIEndpoint(
+		api_url="/jobs/v1/status",
+		url_target="",
+		is_active=True,
+		method="GET",
+		# clients poll it, it is free
+		other={"rate_limit": {"free": 60, "subscription": 120, "metered": 600}},
+	),
 }
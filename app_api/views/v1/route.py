@@ -1,3 +1,7 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 
-v1_default_view_router = APIRouter(tags=["Default"])
+from access_management.rate_limit import rate_limit
+
+v1_default_view_router = APIRouter(
+    tags=["Default"], dependencies=[Depends(rate_limit)]
+)
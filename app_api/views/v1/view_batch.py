@@ -0,0 +1,135 @@
+import logging
+from datetime import datetime
+
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from starlette.datastructures import UploadFile
+
+from core import settings
+from schemas.auth import TokenData
+from access_management.api_auth import verify_token
+from common.cost_management import cost_setup
+from common.redis_utils import (
+	get_redis_conn, set_user_api_call_lock, release_user_api_call_lock,
+	reserve_user_credits,
+)
+from common.batch import (
+	BATCH_URL_PREFIX, NDJSON_MEDIA_TYPE, ZIP_MEDIA_TYPE,
+	get_batch_endpoint, start_batch, stream_ndjson, stream_zip,
+)
+from views.v1.route import v1_default_view_router
+
+
+logger = logging.getLogger("APP_API_DEFAULT"+__name__)
+
+
+async def get_batch_files(request: Request) -> list:
+	"""Upload files in the `files` form field, or a JSON `openaiFileIdRefs`."""
+	if request.headers.get("content-type", "").startswith("application/json"):
+		try:
+			file_refs = (await request.json()).get("openaiFileIdRefs")
+		except ValueError:
+			file_refs = None
+		if not isinstance(file_refs, list) or not all(
+				isinstance(file_ref, dict) for file_ref in file_refs
+		):
+			raise HTTPException(
+				status_code=status.HTTP_400_BAD_REQUEST,
+				detail="Invalid request, missing openaiFileIdRefs."
+			)
+		return file_refs
+
+	form = await request.form(max_files=settings.BATCH_MAX_FILES + 1)
+	return [
+		file for file in form.getlist("files") if isinstance(file, UploadFile)
+	]
+
+
+@v1_default_view_router.post(
+	BATCH_URL_PREFIX + "/{api_url:path}", include_in_schema=True,
+	description=(
+		"Calls an API for many files at once, ex: `/batch/pdf/v1/rotate`. Send "
+		"the files as `files` (multipart) or as JSON `openaiFileIdRefs`, the "
+		"query params are passed to every call. The response is a ZIP with "
+		"the results and a `manifest.ndjson`, or with "
+		f"`Accept: {NDJSON_MEDIA_TYPE}` one JSON line per file with a link to "
+		"its result. Only the files that did not fail are charged."
+	),
+)
+async def view_batch(
+		request: Request,
+		api_url: str,
+		token_data: TokenData = Depends(verify_token),
+		redis_conn=Depends(get_redis_conn),
+):
+	endpoint = get_batch_endpoint("/" + api_url)
+	if endpoint is None:
+		raise HTTPException(status_code=404, detail="Not found.")
+	api_name, url_data = endpoint
+
+	files = await get_batch_files(request)
+	if not files:
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Invalid request, missing files."
+		)
+	elif len(files) > settings.BATCH_MAX_FILES:
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail=f"A batch can have at most {settings.BATCH_MAX_FILES} files."
+		)
+
+	date_time_now = datetime.now()
+	current_date = datetime.now().strftime("%d-%m-%Y")
+	timestamp = int(date_time_now.timestamp())
+
+	# one slot for the whole batch, released by `run_batch`
+	await set_user_api_call_lock(
+		redis_conn=redis_conn, username=token_data.username, api_name=api_name
+	)
+	try:
+		api_cost, is_metered = await cost_setup(
+			redis_conn=redis_conn,
+			username=token_data.username,
+			api_name=api_name,
+			current_date=current_date,
+			calls=len(files),
+		)
+		# taken now so that parallel calls can't spend the same credits, the
+		# credits of the files that fail are given back by `run_batch`
+		reservation = None if is_metered else await reserve_user_credits(
+			redis_conn=redis_conn,
+			username=token_data.username,
+			credits=api_cost * len(files),
+		)
+	except Exception:
+		await release_user_api_call_lock(
+			redis_conn=redis_conn, username=token_data.username, api_name=api_name
+		)
+		raise
+
+	as_ndjson = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+	results = start_batch(
+		redis_conn=redis_conn,
+		files=files,
+		params=dict(request.query_params),
+		upload_results=as_ndjson,
+		username=token_data.username,
+		api_name=api_name,
+		url_data=url_data,
+		api_cost=api_cost,
+		is_metered=is_metered,
+		current_date=current_date,
+		timestamp=timestamp,
+		reservation=reservation,
+	)
+
+	if as_ndjson:
+		return StreamingResponse(
+			stream_ndjson(results), media_type=NDJSON_MEDIA_TYPE
+		)
+	return StreamingResponse(
+		stream_zip(results),
+		media_type=ZIP_MEDIA_TYPE,
+		headers={"content-disposition": 'attachment; filename="batch.zip"'},
+	)
@@ -0,0 +1,36 @@
+import logging
+
+from fastapi import Depends, HTTPException, Query
+
+from schemas.auth import TokenData
+from schemas.jobs import JobStatus
+from access_management.api_auth import verify_token
+from common.redis_utils import get_redis_conn
+from common.jobs import get_job, get_job_status
+from views.urls import default_urls
+from views.v1.route import v1_default_view_router
+
+
+logger = logging.getLogger("APP_API_DEFAULT"+__name__)
+
+
+@v1_default_view_router.get(
+	default_urls["view_job_status_v1"].api_url, include_in_schema=True,
+	response_model=JobStatus,
+	description=(
+		"Status of a job submitted with the `Prefer: respond-async` header, "
+		"`result_url` is a temporary link to the result once it succeeded."
+	),
+)
+async def view_job_status(
+		job_id: str = Query(..., max_length=32),
+		token_data: TokenData = Depends(verify_token),
+		redis_conn=Depends(get_redis_conn),
+):
+	job = await get_job(redis_conn=redis_conn, job_id=job_id)
+
+	# other users' jobs are not found either
+	if not job or job["username"] != token_data.username:
+		raise HTTPException(status_code=404, detail="Job not found.")
+
+	return await get_job_status(job)
@@ -9,13 +9,9 @@ from common.redis_utils import get_redis_conn
 from views.urls import default_urls
 from views.v1.route import v1_default_view_router
 from common.redis_utils import (
-	sum_user_credits_bought,
+	get_user_credit_balance,
 	check_if_user_has_metered_subscription,
 )
-from schemas.redis_db import (
-	REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
-	REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
-)
 
 
 logger = logging.getLogger("APP_API_DEFAULT"+__name__)
@@ -36,29 +32,12 @@ async def view_user_credits(
 	)
 
 	if not is_metered:
-		credits_bought_remaining = await sum_user_credits_bought(
-			redis_conn=redis_conn,
-			username=username,
-		)
-		has_active_sub = await redis_conn.get(
-			REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION.format(username=username)
-		)
-
-		has_active_sub = int(has_active_sub.decode()) if has_active_sub else 0
-
-		if has_active_sub:
-			subscriptions_monthly_credit_remaining = await redis_conn.get(
-				REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
-					username=username
-				)
+		credits_bought_remaining, subscriptions_monthly_credit_remaining = (
+			await get_user_credit_balance(
+				redis_conn=redis_conn,
+				username=username,
 			)
-			subscriptions_monthly_credit_remaining = (
-				int(subscriptions_monthly_credit_remaining.decode())
-				if subscriptions_monthly_credit_remaining
-				else 0
-			)
-		else:
-			subscriptions_monthly_credit_remaining = 0
+		)
 
 		user_credits = (
 				subscriptions_monthly_credit_remaining + credits_bought_remaining
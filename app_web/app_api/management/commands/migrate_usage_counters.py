@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from common.redis_logic.redis_utils import backfill_usage_counters
+from common.date_time_utils import (
+    convert_date_to_str,
+    get_dates_in_range,
+    get_previous_date_based_on_number_of_days,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the per day usage counters from the legacy one key per API "
+        "call layout, up to yesterday. Run it the day after every writer is "
+        "in `dual` mode (which still reads the legacy keys), then switch "
+        "REDIS_USAGE_COUNTERS_MODE to `counters` to read the counters."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=35,
+            help="number of past days to migrate",
+        )
+
+    def handle(self, *args, **kwargs):
+        dates = get_dates_in_range(
+            start_date=get_previous_date_based_on_number_of_days(
+                days_back=kwargs["days"]
+            ),
+            end_date=get_previous_date_based_on_number_of_days(days_back=1),
+        )
+        for date in dates:
+            date_str = convert_date_to_str(date)
+            number_of_keys = backfill_usage_counters(date_str=date_str)
+            print(f"{date_str}: migrated {number_of_keys} API calls.")
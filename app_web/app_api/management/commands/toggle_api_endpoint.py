@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from common.redis_logic.redis_utils import (
+    get_disabled_api_endpoints,
+    set_api_endpoint_disabled,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Switches App_API endpoints off (403) or back on at runtime, ex: "
+        "`python manage.py toggle_api_endpoint --disable /pdf/v1/rotate`. "
+        "Without arguments it lists the disabled endpoints."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--disable", nargs="+", default=[], metavar="API_URL",
+            help="api_url of the endpoints to disable",
+        )
+        parser.add_argument(
+            "--enable", nargs="+", default=[], metavar="API_URL",
+            help="api_url of the endpoints to enable again",
+        )
+
+    def handle(self, *args, **kwargs):
+        for api_url in kwargs["disable"]:
+            set_api_endpoint_disabled(api_url=api_url, disabled=True)
+        for api_url in kwargs["enable"]:
+            set_api_endpoint_disabled(api_url=api_url, disabled=False)
+
+        print(f"Disabled endpoints: {sorted(get_disabled_api_endpoints())}")
@@ -2,9 +2,11 @@ import uuid
 from django.db import models
 from django.core.exceptions import ValidationError
 
-from common.redis_logic.custom_redis import set_redis_key, delete_redis_key
+from common.redis_logic.custom_redis import (
+    set_redis_key, delete_redis_key, publish_redis_message
+)
 from common.redis_logic.redis_schemas import (
-    REDIS_KEY_API_COST, REDIS_KEY_LLM_COST
+    REDIS_KEY_API_COST, REDIS_KEY_LLM_COST, REDIS_CHANNEL_COST_UPDATES
 )
 
 
@@ -79,6 +81,20 @@ class API(models.Model):
             simple_value=str(self.cost),
         )
         super().save(*args, **kwargs)
+        publish_redis_message(
+            channel=REDIS_CHANNEL_COST_UPDATES,
+            message={"table": "api_cost", "name": self.name, "cost": self.cost},
+        )
+
+    # when deleting also delete the redis key
+    def delete(self, *args, **kwargs):
+        name = self.html_template_path.removesuffix(".html")
+        delete_redis_key(key=REDIS_KEY_API_COST.format(api_name=name))
+        super().delete(*args, **kwargs)
+        publish_redis_message(
+            channel=REDIS_CHANNEL_COST_UPDATES,
+            message={"table": "api_cost", "name": name, "cost": None},
+        )
 
     class Meta:
         verbose_name_plural = "APIs"
@@ -133,6 +149,13 @@ class CostOfLLMAppAI(models.Model):
             simple_value=str(self.cost),
         )
         super().save(*args, **kwargs)
+        publish_redis_message(
+            channel=REDIS_CHANNEL_COST_UPDATES,
+            message={
+                "table": "llm_cost", "name": self.redis_key_name,
+                "cost": self.cost,
+            },
+        )
 
     # when deleting also delete the redis key
     def delete(self, *args, **kwargs):
@@ -140,6 +163,12 @@ class CostOfLLMAppAI(models.Model):
             key=REDIS_KEY_LLM_COST.format(name=self.redis_key_name),
         )
         super().delete(*args, **kwargs)
+        publish_redis_message(
+            channel=REDIS_CHANNEL_COST_UPDATES,
+            message={
+                "table": "llm_cost", "name": self.redis_key_name, "cost": None,
+            },
+        )
 
     class Meta:
         verbose_name_plural = "Cost of LLMs APP AI"
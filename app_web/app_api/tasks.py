@@ -5,9 +5,6 @@ from celery import shared_task, group
 
 from app_api.models import APICounter
 from common.redis_logic.redis_utils import build_user_credits_used_dict
-from common.redis_logic.redis_schemas import (
-    REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER,
-)
 from common.other import chunked
 from common.date_time_utils import (
     get_dates_in_range,
@@ -44,7 +41,6 @@ def has_api_counter_discrepancies(
 
     found_errors = False
 
-    redis_key_name = REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.split(":")[0]
     start_date = get_previous_date_based_on_number_of_days(days_back=5)
     end_date = get_previous_date_based_on_number_of_days(days_back=2)
 
@@ -57,12 +53,9 @@ def has_api_counter_discrepancies(
 
     redis_data_dict = {}
     for str_date in string_dates:
-        redis_key_pattern = redis_key_name + f":{str_date}:*"
-
-        if username:
-            redis_key_pattern = redis_key_pattern.replace("*", f":{username}:*")
-
-        redis_data_dict = build_user_credits_used_dict(redis_key_pattern)
+        redis_data_dict.update(
+            build_user_credits_used_dict(date_str=str_date, username=username)
+        )
 
     for k, v in redis_data_dict.items():
         date_str, username, api_name = k.split(":")
@@ -111,7 +104,6 @@ def manual_store_api_counter_obj_for_billing_period(
     This is meant to be run manually in case we find log error discrepancies.
     This will take the data from Redis and store it in the database (APICounter).
     """
-    redis_key_name = REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.split(":")[0]
     try:
         start_date = convert_date_str_to_date(start_date_str)
         end_date = convert_date_str_to_date(end_date_str)
@@ -135,9 +127,9 @@ def manual_store_api_counter_obj_for_billing_period(
     redis_data_dict = {}
 
     for str_date in string_dates:
-        redis_key_pattern = redis_key_name + f":{str_date}:{username}:*"
-
-        redis_data_dict = build_user_credits_used_dict(redis_key_pattern)
+        redis_data_dict.update(
+            build_user_credits_used_dict(date_str=str_date, username=username)
+        )
 
     for k, v in redis_data_dict.items():
         date_str, username, api_name = k.split(":")
@@ -204,15 +196,11 @@ def cronjob_store_api_counter_obj_for_the_previous_day(
     For more details see: `send_subscription_item_metered_usage_to_stripe`.
     """
     previous_day = get_previous_day_date_as_str()
-    redis_key_pattern = (
-        REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.split(":")[0]
-        + f":{previous_day}:*"
-    )
-    if username:
-        redis_key_pattern = redis_key_pattern.replace("*", f":{username}:*")
-    
+
     # {"{date_str}:{username}:{api_name}": [credits_used, number_of_calls]}
-    redis_data_dict = build_user_credits_used_dict(redis_key_pattern)
+    redis_data_dict = build_user_credits_used_dict(
+        date_str=previous_day, username=username
+    )
 
     existing_api_counters = []
     api_counters_to_create = []
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from common.redis_logic.redis_utils import migrate_credits_bought_to_ledger
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the legacy credits bought keys that are left into the credit "
+        "ledger. Optional cleanup, the ledger scripts already move a user's "
+        "keys the first time they read the ledger. Safe to run more than once."
+    )
+
+    def handle(self, *args, **kwargs):
+        migrated = migrate_credits_bought_to_ledger()
+        print(f"We moved {migrated} credits bought keys to the credit ledger.")
@@ -24,9 +24,10 @@ from common.stripe_logic.stripe_handlers import (
 from common.stripe_logic.stripe_utils import (
     send_subscription_item_metered_usage_to_stripe,
 )
-from common.redis_logic.custom_redis import delete_redis_key
-from common.redis_logic.redis_utils import set_credits_for_customer_subscription
-from common.redis_logic.redis_schemas import REDIS_KEY_USER_CREDIT_BOUGHT
+from common.redis_logic.redis_utils import (
+    delete_credits_bought,
+    set_credits_for_customer_subscription,
+)
 from common.date_time_utils import get_current_date_time
 
 logger = logging.getLogger(__name__)
@@ -83,11 +84,8 @@ def remove_expired_credits():
     for cred_bought_obj in CustomerCreditsBought.objects.filter(
         expires__lte=get_current_date_time()
     ):
-        delete_redis_key(
-            key=REDIS_KEY_USER_CREDIT_BOUGHT.format(
-                username=cred_bought_obj.user.username,
-                id=cred_bought_obj.id,
-            )
+        delete_credits_bought(
+            cred_bought_obj.user.username, cred_bought_obj.id
         )
 
         cred_bought_obj.delete()
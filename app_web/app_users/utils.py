@@ -18,6 +18,8 @@ from app_financial.models import StripeSubscriptionItem, CustomerCreditsBought
 from app_financial.utils import soft_delete_user_subscription_item
 from common.redis_logic.redis_schemas import (
     REDIS_KEY_USER_GENERATED_TOKEN,
+    REDIS_KEY_USER_CREDIT_LEDGER,
+    REDIS_KEY_USER_CREDIT_LEDGER_FOLDED,
     REDIS_KEY_USER_CREDIT_BOUGHT,
     REDIS_KEY_USER_API_DAILY_CALL_LIMIT,
     REDIS_KEY_METERED_SUBSCRIPTION_USERS,
@@ -25,12 +27,17 @@ from common.redis_logic.redis_schemas import (
     REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
     REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
     REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER,
+    REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER,
+    REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER,
+    REDIS_KEY_USER_API_CALLS_STREAM,
     REDIS_KEY_USER_PHONE_NUMBER
 )
 from common.redis_logic.custom_redis import (
     set_redis_key, delete_redis_key, rename_redis_key,
 )
-from common.redis_logic.redis_utils import add_one_time_credits_to_customer
+from common.redis_logic.redis_utils import (
+    add_one_time_credits_to_customer, rename_usage_counters_user,
+)
 from common.exceptions import CustomValidationError, CustomRequestException
 from common.normalize import get_normalized_email
 from common.other import generate_random_string
@@ -254,11 +261,31 @@ def delete_user_and_connected_data(
         old_value=user_obj.username,
         new_value=anon_user_obj.username
     )
+    for template_key in (
+        REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER,
+        REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER,
+        REDIS_KEY_USER_API_CALLS_STREAM,
+    ):
+        rename_redis_key(
+            template_key=template_key.format(username="{old_value}", date="*"),
+            old_value=user_obj.username,
+            new_value=anon_user_obj.username
+        )
+    rename_usage_counters_user(
+        old_username=user_obj.username, new_username=anon_user_obj.username
+    )
 
+    delete_redis_key(
+        key=REDIS_KEY_USER_CREDIT_LEDGER.format(username=user_obj.username)
+    )
+    delete_redis_key(
+        key=REDIS_KEY_USER_CREDIT_LEDGER_FOLDED.format(username=user_obj.username)
+    )
     for cred_bought_obj in CustomerCreditsBought.objects.filter(user=user_obj):
+        # legacy key, if it was not moved to the ledger yet
         delete_redis_key(
             key=REDIS_KEY_USER_CREDIT_BOUGHT.format(
-                username=cred_bought_obj.user.username,
+                username=user_obj.username,
                 id=cred_bought_obj.id,
             )
         )
@@ -127,6 +127,17 @@ def get_redis_key(
         logger.error(e)
 
 
+def publish_redis_message(channel: str, message: dict) -> int:
+    """
+    Publish a JSON message on a Redis pub/sub channel
+        :param channel: the channel name
+        :param message: is a dictionary that will be sent as a JSON string
+        :return: the number of subscribers that received the message
+    """
+    with RedisClient() as client:
+        return client.publish(channel, json.dumps(message))
+
+
 def get_redis_keys_by_pattern(pattern: str) -> list:
     """
     Get redis keys by pattern
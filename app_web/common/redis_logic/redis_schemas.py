@@ -1,3 +1,5 @@
+REDIS_KEY_TTL_MAX = 60 * 60 * 24 * 31 * 6  # 6 months, same as App_API
+
 # for user authentication
 REDIS_KEY_USER_GENERATED_TOKEN = "token:user_generated:{token}:username"
 REDIS_OPENAI_OAUTH_USER_GENERATED_TOKEN = "token:openai_oauth:{token}:username"
@@ -5,18 +7,51 @@ REDIS_OPENAI_OAUTH_USER_GENERATED_TOKEN = "token:openai_oauth:{token}:username"
 # for metering api calls
 REDIS_KEY_LLM_COST = "llm_cost:{name}"
 REDIS_KEY_API_COST = "api_cost:{api_name}"
+# the FastAPI workers cache the costs, we publish
+# {"table": "api_cost" | "llm_cost", "name": .., "cost": ..} when a cost changes,
+# `cost: None` when it was deleted
+REDIS_CHANNEL_COST_UPDATES = "cost_updates"
+# set of `api_url`s (ex: "/pdf/v1/rotate") the FastAPI workers reject with 403,
+# publish on the channel after changing it so they reload the set
+REDIS_KEY_DISABLED_API_ENDPOINTS = "disabled_api_endpoints"
+REDIS_CHANNEL_API_TOGGLE_UPDATES = "api_toggle_updates"
 REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION = "user_has_active_subscription:{username}"
 
 REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING = (
     "subscriptions_monthly_credit_remaining:{username}"
 )
 REDIS_KEY_USER_API_DAILY_CALL_LIMIT = "user_api_daily_call_limit:{username}"
+# written by App_API, capped stream of the calls made by a user in a day:
+# {"api_name": .., "timestamp": .., "success": 0/1}
+REDIS_KEY_USER_API_CALLS_STREAM = "user_api_calls_stream:{username}:{date}"
+# legacy, one key per API call, written while REDIS_USAGE_COUNTERS_MODE is
+# "legacy" or "dual"
 REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER = (
     "credits_used_per_api_endpoint_by_user:{date}:{username}:{api_name}:"
     "{timestamp}:{random_char}"
 )
-# the {id} of the `CustomerCreditsBought` model
+"""
+Usage counters, written while REDIS_USAGE_COUNTERS_MODE is "dual" or "counters"
+credits_used_per_day:{username}:{date} -> hash
+    {"{api_name}:credits": 12, "{api_name}:calls": 3}
+credits_used_per_day_users:{date} -> set of the usernames with a hash that day
+credits_used_timeline:{username}:{date} -> sorted set, score is the timestamp
+    {"{timestamp}:{api_name}:{credits}:{random_char}": timestamp}
+"""
+REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER = "credits_used_per_day:{username}:{date}"
+REDIS_KEY_CREDITS_USED_PER_DAY_USERS = "credits_used_per_day_users:{date}"
+REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER = (
+    "credits_used_timeline:{username}:{date}"
+)
+REDIS_CREDITS_USED_TIMELINE_MEMBER = (
+    "{timestamp}:{api_name}:{credits}:{random_char}"
+)
+# hash {"<CustomerCreditsBought id>": <credits remaining>}, see redis_scripts
+REDIS_KEY_USER_CREDIT_LEDGER = "user_credit_ledger:{username}"
+# legacy, one key per `CustomerCreditsBought` {id}, moved into the ledger by
+# the ledger scripts, the flag is set once the user's keys were moved
 REDIS_KEY_USER_CREDIT_BOUGHT = "user_credit_bought:{username}:{id}"
+REDIS_KEY_USER_CREDIT_LEDGER_FOLDED = "user_credit_ledger_folded:{username}"
 
 # for stripe login
 # no need to delete this because the customer's email will e anonimized on Stripe
@@ -1,5 +1,6 @@
 import logging
 
+from django.conf import settings
 from django.db.models import Sum
 
 from app_api.models import APICounter
@@ -8,20 +9,36 @@ from app_financial.models import (
     CustomerCreditsBought,
     StripeSubscriptionItem,
 )
-from common.redis_logic.custom_redis import RedisClient, set_redis_key
+from common.redis_logic.custom_redis import (
+    RedisClient, set_redis_key, publish_redis_message
+)
 from common.redis_logic.redis_schemas import (
-    REDIS_KEY_USER_CREDIT_BOUGHT,
+    REDIS_KEY_USER_CREDIT_LEDGER,
     REDIS_KEY_USER_API_DAILY_CALL_LIMIT,
+    REDIS_KEY_USER_API_CALLS_STREAM,
     REDIS_KEY_METERED_SUBSCRIPTION_USERS,
+    REDIS_KEY_TTL_MAX,
     REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER,
+    REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER,
+    REDIS_KEY_CREDITS_USED_PER_DAY_USERS,
+    REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER,
+    REDIS_CREDITS_USED_TIMELINE_MEMBER,
     REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING,
     REDIS_KEY_USER_HAS_ACTIVE_SUBSCRIPTION,
+    REDIS_KEY_DISABLED_API_ENDPOINTS,
+    REDIS_CHANNEL_API_TOGGLE_UPDATES,
+)
+from common.redis_logic.redis_scripts import (
+    CREDIT_LEDGER_DEBIT_LUA,
+    CREDIT_LEDGER_FOLD_LUA,
 )
 from common.date_time_utils import (
     get_current_date_time,
     get_current_date_as_str,
     convert_date_str_to_date,
     convert_date_to_str,
+    get_dates_in_range,
+    get_previous_date_based_on_number_of_days,
 )
 from common.other import convert_cents_into_credit
 
@@ -48,13 +65,12 @@ def add_one_time_credits_to_customer(
         details=details,
     )
 
-    set_redis_key(
-        key=REDIS_KEY_USER_CREDIT_BOUGHT.format(
-            username=user_obj.username,
-            id=cred_bought_obj.id,
-        ),
-        simple_value=no_of_credits,
-    )
+    with RedisClient() as client:
+        client.hset(
+            REDIS_KEY_USER_CREDIT_LEDGER.format(username=user_obj.username),
+            str(cred_bought_obj.id),
+            no_of_credits,
+        )
     return no_of_credits
 
 
@@ -85,27 +101,63 @@ def set_credits_for_customer_subscription(
         )
 
 
+def _fold_legacy_credits_bought(
+    client, username: str, force: bool = False
+) -> int:
+    """Moves the legacy credits bought keys of the user into the ledger."""
+    fold_script = client.register_script(CREDIT_LEDGER_FOLD_LUA)
+    return fold_script(
+        keys=[REDIS_KEY_USER_CREDIT_LEDGER.format(username=username)],
+        args=[int(force)],
+    )
+
+
 def get_remaining_credits_bought(username: str) -> dict:
     """
     This function will return the number of credits a user has remaining from
-    their credit bought directly.
+    their credit bought directly. {CustomerCreditsBought pk: credits}
     """
-    key_pattern = REDIS_KEY_USER_CREDIT_BOUGHT.format(
-        username=username,
-        id="*",
-    )
+    with RedisClient() as client:
+        _fold_legacy_credits_bought(client=client, username=username)
+        ledger = client.hgetall(
+            REDIS_KEY_USER_CREDIT_LEDGER.format(username=username)
+        )
 
-    total_credits = {}
-    customer_credits_bought_pks = []
+    return {int(pk): int(credit_value) for pk, credit_value in ledger.items()}
+
+
+def delete_credits_bought(username: str, *ids: int) -> None:
+    """Removes the given `CustomerCreditsBought` ids from the credit ledger."""
+    if not ids:
+        return
     with RedisClient() as client:
-        for key in client.scan_iter(match=key_pattern):
-            pk = int(key.decode("utf-8").split(":")[-1])
-            customer_credits_bought_pks.append(pk)
-            credit_value = client.get(key)
-            if credit_value is not None:
-                total_credits[pk] = int(credit_value)
+        # a legacy key left behind would bring the credits back later
+        _fold_legacy_credits_bought(client=client, username=username)
+        client.hdel(
+            REDIS_KEY_USER_CREDIT_LEDGER.format(username=username),
+            *[str(pk) for pk in ids],
+        )
 
-    return total_credits
+
+def migrate_credits_bought_to_ledger() -> int:
+    """
+    Moves the legacy `user_credit_bought:{username}:{id}` keys left into the
+    per user credit ledger. The ledger scripts already do it the first time
+    they read a user's ledger, this is only a cleanup (ex: keys written by a
+    web worker that was not deployed yet), it can run at any time and more
+    than once. Expired credits are removed by `delete_credits_bought`.
+    Returns the number of keys migrated.
+    """
+    migrated = 0
+    usernames = CustomerCreditsBought.objects.filter(
+        expires__gt=get_current_date_time()
+    ).values_list("user__username", flat=True).distinct()
+    with RedisClient() as client:
+        for username in usernames:
+            migrated += _fold_legacy_credits_bought(
+                client=client, username=username, force=True
+            )
+    return migrated
 
 
 def get_remaining_monthly_subscription_credits(username: str) -> int:
@@ -128,12 +180,10 @@ def get_user_api_usage_for_current_day(
 ):
     """This is not for sending data to Stripe, it's for the user's dashboard."""
     date_str = get_current_date_as_str()
-    redis_key_pattern = (
-        REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.split(":")[0]
-        + f":{date_str}:{username}:*"
-    )
 
-    redis_data_dict = build_user_credits_used_dict(redis_key_pattern)
+    redis_data_dict = build_user_credits_used_dict(
+        date_str=date_str, username=username
+    )
 
     if APICounter.objects.filter(
         username=username,
@@ -168,7 +218,68 @@ def get_credits_used_dynamically(
     If before_timestamp and after_timestamp are none, it will return the
     total credits used for the given date.
     """
+    if settings.REDIS_USAGE_COUNTERS_MODE != "counters":
+        return _get_credits_used_dynamically_from_legacy_keys(
+            date=date,
+            username=username,
+            before_timestamp=before_timestamp,
+            after_timestamp=after_timestamp,
+        )
+
+    with RedisClient() as client:
+        members = client.zrangebyscore(
+            REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER.format(
+                username=username, date=date
+            ),
+            min=after_timestamp or "-inf",
+            max=before_timestamp or "+inf",
+        )
+
+    # member: "{timestamp}:{api_name}:{credits}:{random_char}"
+    return sum(int(member.rsplit(b":", 2)[1]) for member in members)
 
+
+def get_api_calls_log(
+    username: str, date_strs: list, count: int = None
+) -> dict:
+    """
+    Reads the API calls App_API logged for the user, newest first, one range
+    read per day in a single round trip.
+        :param date_strs: dates as "%d-%m-%Y"
+        :param count: max number of calls returned per day
+        :return: {date_str: [{"api_name": str, "timestamp": int,
+            "success": bool}, ...]}
+    """
+    with RedisClient() as client:
+        pipeline = client.pipeline(transaction=False)
+        for date_str in date_strs:
+            pipeline.xrevrange(
+                REDIS_KEY_USER_API_CALLS_STREAM.format(
+                    username=username, date=date_str
+                ),
+                count=count,
+            )
+        results = pipeline.execute()
+
+    return {
+        date_str: [
+            {
+                "api_name": fields[b"api_name"].decode(),
+                "timestamp": int(fields[b"timestamp"]),
+                "success": fields[b"success"] == b"1",
+            }
+            for _, fields in entries
+        ]
+        for date_str, entries in zip(date_strs, results)
+    }
+
+
+def _get_credits_used_dynamically_from_legacy_keys(
+    date: str,
+    username: str,
+    before_timestamp: int = None,
+    after_timestamp: int = None,
+) -> int:
     total_credits = 0
     with RedisClient() as client:
         base_key_pattern = (
@@ -179,43 +290,84 @@ def get_credits_used_dynamically(
                 username=username,
             )
         )
-        
-        list_of_keys = []
-        while True:
-            cursor, keys = client.scan(match=base_key_pattern, count=1000)
-
-            for k in keys:
-                k = k.decode("utf-8") if isinstance(k, bytes) else k
 
-                timestamp = int(k.split(":")[-2])
-
-                if (
-                    (  # check if the timestamp is within the range
-                        before_timestamp and after_timestamp
-                        and after_timestamp <= timestamp <= before_timestamp
-                    )
-                    or (before_timestamp and timestamp <= before_timestamp)
-                    or (after_timestamp and after_timestamp <= timestamp)
-                    or (not before_timestamp and not after_timestamp)
-                ):
-                    list_of_keys.append(k)
+        list_of_keys = []
+        for k in client.scan_iter(match=base_key_pattern, count=1000):
+            k = k.decode("utf-8") if isinstance(k, bytes) else k
+
+            timestamp = int(k.split(":")[-2])
+
+            if (
+                (  # check if the timestamp is within the range
+                    before_timestamp and after_timestamp
+                    and after_timestamp <= timestamp <= before_timestamp
+                )
+                or (before_timestamp and timestamp <= before_timestamp)
+                or (after_timestamp and after_timestamp <= timestamp)
+                or (not before_timestamp and not after_timestamp)
+            ):
+                list_of_keys.append(k)
 
-            if cursor == 0:
-                break
-        
         if list_of_keys:
             pipeline = client.pipeline()
             for k in list_of_keys:
                 pipeline.get(k)
             results = pipeline.execute()
-            
+
             if results:
                 total_credits = sum(int(x) for x in results)
-                
+
     return total_credits
 
 
-def build_user_credits_used_dict(redis_key_pattern: str) -> dict[str, list[int]]:
+def build_user_credits_used_dict(
+    date_str: str, username: str = ""
+) -> dict[str, list[int]]:
+    """
+    If username, it will only return the usage of that user for the date.
+    Returns: {"{date_str}:{username}:{api_name}": [credits_used, number_of_calls]}
+    """
+    if settings.REDIS_USAGE_COUNTERS_MODE != "counters":
+        return build_user_credits_used_dict_from_legacy_keys(
+            REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.split(":")[0]
+            + f":{date_str}:{username or '*'}:*"
+        )
+
+    with RedisClient() as client:
+        if username:
+            usernames = [username]
+        else:
+            usernames = sorted(
+                x.decode("utf-8")
+                for x in client.smembers(
+                    REDIS_KEY_CREDITS_USED_PER_DAY_USERS.format(date=date_str)
+                )
+            )
+
+        pipeline = client.pipeline(transaction=False)
+        for user in usernames:
+            pipeline.hgetall(
+                REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER.format(
+                    username=user, date=date_str
+                )
+            )
+        results = pipeline.execute()
+
+    redis_data_dict = {}
+    for user, day_counters in zip(usernames, results):
+        for field, value in day_counters.items():
+            # field: "{api_name}:credits" or "{api_name}:calls"
+            api_name, _, counter = field.decode("utf-8").rpartition(":")
+            simple_key = f"{date_str}:{user}:{api_name}"
+            counters = redis_data_dict.setdefault(simple_key, [0, 0])
+            counters[0 if counter == "credits" else 1] = int(value)
+
+    return redis_data_dict
+
+
+def build_user_credits_used_dict_from_legacy_keys(
+    redis_key_pattern: str
+) -> dict[str, list[int]]:
     """
     Returns: {"{date_str}:{username}:{api_name}": [credits_used, number_of_calls]}
     """
@@ -264,6 +416,97 @@ def build_user_credits_used_dict(redis_key_pattern: str) -> dict[str, list[int]]
     return redis_data_dict
 
 
+def backfill_usage_counters(date_str: str) -> int:
+    """
+    Rebuilds the usage counters of `date_str` from the legacy one key per call
+    layout. Safe to run more than once: the hashes are overwritten and the
+    timeline members reuse the legacy `random_char`.
+    Returns the number of legacy keys read.
+    """
+    key_pattern = (
+        REDIS_KEY_CREDITS_USED_PER_API_ENDPOINT_BY_USER.split(":")[0]
+        + f":{date_str}:*"
+    )
+    day_counters = {}  # {username: {field: value}}
+    timelines = {}  # {username: {member: timestamp}}
+    number_of_keys = 0
+
+    with RedisClient() as client:
+        for key in client.scan_iter(match=key_pattern, count=1000):
+            value = client.get(key)
+            key = key.decode("utf-8")
+            if value is None or key.count(":") != 5:
+                continue
+
+            number_of_keys += 1
+            _, _, username, api_name, timestamp, random_char = key.split(":")
+            credits_used = int(value)
+
+            counters = day_counters.setdefault(username, {})
+            counters[f"{api_name}:credits"] = (
+                counters.get(f"{api_name}:credits", 0) + credits_used
+            )
+            counters[f"{api_name}:calls"] = (
+                counters.get(f"{api_name}:calls", 0) + 1
+            )
+            timelines.setdefault(username, {})[
+                REDIS_CREDITS_USED_TIMELINE_MEMBER.format(
+                    timestamp=timestamp,
+                    api_name=api_name,
+                    credits=credits_used,
+                    random_char=random_char,
+                )
+            ] = int(timestamp)
+
+        pipeline = client.pipeline(transaction=True)
+        users_key = REDIS_KEY_CREDITS_USED_PER_DAY_USERS.format(date=date_str)
+        for username, counters in day_counters.items():
+            day_key = REDIS_KEY_CREDITS_USED_PER_DAY_BY_USER.format(
+                username=username, date=date_str
+            )
+            timeline_key = REDIS_KEY_CREDITS_USED_TIMELINE_BY_USER.format(
+                username=username, date=date_str
+            )
+            pipeline.hset(day_key, mapping=counters)
+            pipeline.zadd(timeline_key, timelines[username])
+            pipeline.sadd(users_key, username)
+            for key in (day_key, timeline_key, users_key):
+                pipeline.expire(key, REDIS_KEY_TTL_MAX)
+        pipeline.execute()
+
+    return number_of_keys
+
+
+def rename_usage_counters_user(old_username: str, new_username: str) -> None:
+    """
+    The per day hashes and timelines are renamed with `rename_redis_key`, this
+    updates the usernames stored in the `credits_used_per_day_users` sets of
+    the days that didn't expire yet.
+    """
+    dates = get_dates_in_range(
+        start_date=get_previous_date_based_on_number_of_days(
+            days_back=REDIS_KEY_TTL_MAX // (60 * 60 * 24)
+        ),
+        end_date=get_current_date_time(get_date=True),
+    )
+    users_keys = [
+        REDIS_KEY_CREDITS_USED_PER_DAY_USERS.format(date=convert_date_to_str(d))
+        for d in dates
+    ]
+
+    with RedisClient() as client:
+        pipeline = client.pipeline(transaction=False)
+        for users_key in users_keys:
+            pipeline.srem(users_key, old_username)
+        removed = pipeline.execute()
+
+        pipeline = client.pipeline(transaction=False)
+        for users_key, was_member in zip(users_keys, removed):
+            if was_member:
+                pipeline.sadd(users_key, new_username)
+        pipeline.execute()
+
+
 def get_credits_used_per_metered_subscription_item(
     subs_item_obj: StripeSubscriptionItem,
 ) -> int:
@@ -421,6 +664,27 @@ def set_user_subscription_active(username: str):
     )
 
 
+def _debit_credits(
+    username: str, no_of_credits: int, use_bought: bool, use_subscription: bool
+) -> None:
+    with RedisClient() as client:
+        debit_script = client.register_script(CREDIT_LEDGER_DEBIT_LUA)
+        remaining = debit_script(
+            keys=[
+                REDIS_KEY_USER_CREDIT_LEDGER.format(username=username),
+                REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
+                    username=username
+                ),
+            ],
+            args=[no_of_credits, int(use_bought), int(use_subscription), 1],
+        )
+
+    if remaining != 0:
+        msg = "Not enough credits to remove, the balance changed."
+        logger.error(msg)
+        raise ValueError(msg)
+
+
 def remove_credits_bought_directly(username: str, no_of_credits: int):
     if not no_of_credits or no_of_credits <= 0:
         msg = "Number of credits to remove must be a positive number."
@@ -436,17 +700,12 @@ def remove_credits_bought_directly(username: str, no_of_credits: int):
         logger.error(msg)
         raise ValueError(msg)
 
-    key_pattern = REDIS_KEY_USER_CREDIT_BOUGHT.format(username=username, id="*")
-
-    with RedisClient() as client:
-        for key in client.scan_iter(match=key_pattern):
-            credit_value = int(client.get(key))
-            if no_of_credits >= credit_value:
-                no_of_credits -= credit_value
-                client.delete(key)
-            else:
-                client.set(key, credit_value - no_of_credits)
-                break
+    _debit_credits(
+        username=username,
+        no_of_credits=no_of_credits,
+        use_bought=True,
+        use_subscription=False,
+    )
 
 
 def remove_credits_bought_using_subscription(username: str, no_of_credits: int):
@@ -466,9 +725,34 @@ def remove_credits_bought_using_subscription(username: str, no_of_credits: int):
         logger.error(msg)
         raise ValueError(msg)
 
-    set_redis_key(
-        key=REDIS_KEY_SUBSCRIPTIONS_MONTHLY_CREDIT_REMAINING.format(
-            username=username
-        ),
-        simple_value=total_credits_subscription - no_of_credits,
+    _debit_credits(
+        username=username,
+        no_of_credits=no_of_credits,
+        use_bought=False,
+        use_subscription=True,
+    )
+
+
+def get_disabled_api_endpoints() -> set:
+    with RedisClient() as client:
+        return {
+            endpoint.decode()
+            for endpoint in client.smembers(REDIS_KEY_DISABLED_API_ENDPOINTS)
+        }
+
+
+def set_api_endpoint_disabled(api_url: str, disabled: bool) -> None:
+    """
+    Switches an App_API endpoint off (403) or back on without a deploy.
+        :param api_url: as in App_API `core.urls`, ex: "/pdf/v1/rotate"
+    """
+    with RedisClient() as client:
+        if disabled:
+            client.sadd(REDIS_KEY_DISABLED_API_ENDPOINTS, api_url)
+        else:
+            client.srem(REDIS_KEY_DISABLED_API_ENDPOINTS, api_url)
+
+    publish_redis_message(
+        channel=REDIS_CHANNEL_API_TOGGLE_UPDATES,
+        message={"api_url": api_url, "disabled": disabled},
     )
@@ -208,6 +208,11 @@ STRIPE_PUBLISHABLE_KEY = get_env_variable("STRIPE_PUBLISHABLE_KEY")
 REDIS_HOST = get_env_variable("REDIS_HOST")
 REDIS_PORT = get_env_variable("REDIS_PORT")
 REDIS_DB_DEFAULT = get_env_variable("REDIS_DB_DEFAULT")
+# how the credits used per API call are stored, see `redis_schemas`:
+# "legacy" one key per call, "counters" per day hashes and timelines,
+# "dual" writes both and still reads the legacy keys (while migrating), switch
+# every app to "counters" once `migrate_usage_counters` has backfilled them
+REDIS_USAGE_COUNTERS_MODE = os.getenv("REDIS_USAGE_COUNTERS_MODE", "dual")
 # ------------ end of Redis
 
 